@@ -1,12 +1,13 @@
 from django.contrib import admin
-from .models import ChatRoom, Message, UserProfile
+from .models import ChatRoom, Message, MessageArchive, RoomReadState, UserProfile
 
 
 @admin.register(ChatRoom)
 class ChatRoomAdmin(admin.ModelAdmin):
-    list_display = ['name', 'created_at', 'updated_at']
+    list_display = ['name', 'message_count', 'member_count', 'last_message_at', 'created_at']
     search_fields = ['name', 'description']
     list_filter = ['created_at']
+    readonly_fields = ChatRoom.SUMMARY_FIELDS
 
 
 @admin.register(Message)
@@ -16,6 +17,19 @@ class MessageAdmin(admin.ModelAdmin):
     search_fields = ['content', 'user__username', 'room__name']
 
 
+@admin.register(MessageArchive)
+class MessageArchiveAdmin(admin.ModelAdmin):
+    list_display = ['room', 'day', 'message_count', 'first_timestamp', 'last_timestamp']
+    list_filter = ['day']
+    search_fields = ['room__name']
+
+
+@admin.register(RoomReadState)
+class RoomReadStateAdmin(admin.ModelAdmin):
+    list_display = ['user', 'room', 'unread_count', 'last_read_id', 'updated_at']
+    search_fields = ['user__username', 'room__name']
+
+
 @admin.register(UserProfile)
 class UserProfileAdmin(admin.ModelAdmin):
     list_display = ['user', 'is_online', 'last_seen']
@@ -0,0 +1,79 @@
+"""
+Admission control for WebSocket connects.
+
+Each worker admits a socket only if it holds fewer than
+``CHAT_MAX_CONNECTIONS`` open sockets and its connect bucket has a token; the
+bucket refills at ``CHAT_CONNECT_RATE`` per second up to
+``CHAT_CONNECT_BURST``. Either limit is off when set to 0.
+
+A rejected socket is accepted just long enough to be sent an ``overloaded``
+error frame with a ``retry_after`` hint in seconds, then closed with
+``CLOSE_OVERLOADED``. The hint is the earliest time the worker could take the
+socket plus a random share of ``CHAT_ADMISSION_RETRY_JITTER``, so a crowd
+rejected together comes back spread out rather than as a second storm.
+Rejection happens before the room lookup, presence or any other work.
+"""
+
+import random
+import time
+
+from django.conf import settings
+
+from . import metrics
+from .ratelimit import TokenBucket
+
+CLOSE_OVERLOADED = 4503
+
+admitted = metrics.Counter(
+    'chat_ws_admitted_total', 'WebSocket connects admitted')
+rejected = metrics.Counter(
+    'chat_ws_rejected_total', 'WebSocket connects turned away', labelnames=('reason',))
+rejected_full = rejected.labels('connections')
+rejected_rate = rejected.labels('rate')
+
+
+class Admission:
+    def __init__(self, max_connections=0, rate=0, burst=0, retry_after=1.0, jitter=0):
+        self.max_connections = max_connections
+        self.rate = rate
+        self.burst = burst
+        self.retry_after = retry_after
+        self.jitter = jitter
+        self.active = 0
+        self._bucket = TokenBucket(burst, time.monotonic())
+
+    def admit(self):
+        """Take a connection slot; return 0 if admitted, otherwise a retry-after hint in seconds."""
+        if self.max_connections and self.active >= self.max_connections:
+            rejected_full.inc()
+            return self.hint(self.retry_after)
+        if self.rate:
+            wait = self._bucket.take(self.rate, self.burst, time.monotonic())
+            if wait:
+                rejected_rate.inc()
+                return self.hint(wait)
+        self.active += 1
+        admitted.inc()
+        return 0
+
+    def release(self):
+        self.active -= 1
+
+    def hint(self, wait):
+        return round(wait + random.uniform(0, self.jitter), 3)
+
+
+_admission = None
+
+
+def get_admission():
+    global _admission
+    if _admission is None:
+        _admission = Admission(
+            max_connections=settings.CHAT_MAX_CONNECTIONS,
+            rate=settings.CHAT_CONNECT_RATE,
+            burst=settings.CHAT_CONNECT_BURST,
+            retry_after=settings.CHAT_ADMISSION_RETRY_AFTER,
+            jitter=settings.CHAT_ADMISSION_RETRY_JITTER,
+        )
+    return _admission
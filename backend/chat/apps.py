@@ -1,6 +1,12 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'chat' 
\ No newline at end of file
+    name = 'chat'
+
+    def ready(self):
+        from . import db, signals  # noqa: F401
+        from .search import repair_sqlite_index
+        post_migrate.connect(repair_sqlite_index, sender=self)
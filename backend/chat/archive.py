@@ -0,0 +1,178 @@
+"""
+Cold storage for old chat messages.
+
+``archive_messages`` moves every message older than ``CHAT_ARCHIVE_AFTER_DAYS``
+days out of ``Message`` into ``MessageArchive`` segments, one per room per UTC
+day, holding the day's messages as zlib-compressed JSON. Days are moved oldest
+first, each segment in one transaction with the delete of its rows, so a room's
+archived messages are always older than the ones still in ``Message``.
+
+History reads go through to the archive once they run out of hot rows (see
+``ArchiveKeysetPagination``), so clients page back across the boundary without
+noticing it. Segments keep only the user id of each message; names are looked
+up when a segment is read, and messages of users deleted since are dropped, as
+deleting the user would have done. Archived messages are not in the search
+index.
+"""
+
+import json
+import zlib
+from datetime import datetime, time, timedelta, timezone
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+
+from . import metrics
+from .models import Message, MessageArchive
+
+segments_read = metrics.Counter(
+    'chat_archive_segments_read_total', 'Archive segments decompressed for history reads')
+messages_archived = metrics.Counter(
+    'chat_messages_archived_total', 'Messages moved from the message table into the archive')
+
+# Rows deleted per statement when moving a day out of the message table
+DELETE_BATCH_SIZE = 500
+
+
+def encode_segment(rows):
+    """Compress ``(id, user_id, content, timestamp)`` rows, oldest first."""
+    payload = [[pk, user_id, content, timestamp.isoformat()] for pk, user_id, content, timestamp in rows]
+    return zlib.compress(json.dumps(payload, separators=(',', ':')).encode())
+
+
+def decode_segment(data):
+    payload = json.loads(zlib.decompress(data))
+    return [(pk, user_id, content, parse_datetime(timestamp)) for pk, user_id, content, timestamp in payload]
+
+
+def day_bounds(day):
+    start = datetime.combine(day, time.min, tzinfo=timezone.utc)
+    return start, start + timedelta(days=1)
+
+
+def archive_cutoff(days, now=None):
+    """Start of the UTC day ``days`` days ago; messages before it get archived."""
+    today = (now or datetime.now(timezone.utc)).astimezone(timezone.utc).date()
+    return day_bounds(today - timedelta(days=days))[0]
+
+
+def archive_room_day(room_id, day, cutoff):
+    """Move one room's messages for ``day`` (and before ``cutoff``) into its segment."""
+    start, end = day_bounds(day)
+    with transaction.atomic():
+        rows = list(
+            Message.objects.filter(room_id=room_id, timestamp__gte=start, timestamp__lt=min(end, cutoff))
+            .order_by('timestamp', 'id')
+            .values_list('id', 'user_id', 'content', 'timestamp')
+        )
+        if not rows:
+            return 0
+
+        segment = MessageArchive.objects.select_for_update().filter(room_id=room_id, day=day).first()
+        if segment is not None:
+            # A later run with a later cutoff can add to a day archived before
+            merged = {row[0]: row for row in decode_segment(segment.data)}
+            merged.update((row[0], row) for row in rows)
+            stored = sorted(merged.values(), key=lambda row: (row[3], row[0]))
+        else:
+            segment = MessageArchive(room_id=room_id, day=day)
+            stored = rows
+
+        segment.first_id, segment.first_timestamp = stored[0][0], stored[0][3]
+        segment.last_id, segment.last_timestamp = stored[-1][0], stored[-1][3]
+        segment.message_count = len(stored)
+        segment.data = encode_segment(stored)
+        segment.save()
+
+        ids = [row[0] for row in rows]
+        for i in range(0, len(ids), DELETE_BATCH_SIZE):
+            Message.objects.filter(id__in=ids[i:i + DELETE_BATCH_SIZE]).delete()
+
+    messages_archived.inc(len(rows))
+    return len(rows)
+
+
+def archive_room(room_id, cutoff):
+    """Archive a room's messages older than ``cutoff``, oldest day first. Returns the count."""
+    moved = 0
+    while True:
+        oldest = (
+            Message.objects.filter(room_id=room_id, timestamp__lt=cutoff)
+            .order_by('timestamp', 'id')
+            .values_list('timestamp', flat=True)
+            .first()
+        )
+        if oldest is None:
+            return moved
+        moved += archive_room_day(room_id, oldest.astimezone(timezone.utc).date(), cutoff)
+
+
+def _expand(room_id, rows):
+    """``(id, user_id, content, timestamp)`` rows as ``MESSAGE_HISTORY_FIELDS`` dicts."""
+    users = {
+        user['id']: user
+        for user in User.objects.filter(id__in={row[1] for row in rows})
+        .values('id', 'username', 'email', 'first_name', 'last_name')
+    }
+    expanded = []
+    for pk, user_id, content, timestamp in rows:
+        user = users.get(user_id)
+        if user is None:
+            continue
+        expanded.append({
+            'id': pk,
+            'room_id': room_id,
+            'content': content,
+            'timestamp': timestamp,
+            'user_id': user_id,
+            'user__username': user['username'],
+            'user__email': user['email'],
+            'user__first_name': user['first_name'],
+            'user__last_name': user['last_name'],
+        })
+    return expanded
+
+
+def archived_before(room_id, before, limit, after=None):
+    """
+    Up to ``limit`` archived messages of a room before the ``(timestamp, id)``
+    position ``before`` (and after ``after``, if given), newest first, as
+    ``MESSAGE_HISTORY_FIELDS`` rows. ``before`` of None starts from the newest.
+
+    Returns the rows and whether there are older ones.
+    """
+    segments = MessageArchive.objects.filter(room_id=room_id)
+    if before is not None:
+        segments = segments.filter(day__lte=before[0].astimezone(timezone.utc).date())
+    if after is not None:
+        segments = segments.filter(day__gte=after[0].astimezone(timezone.utc).date())
+
+    found = []
+    for data in segments.order_by('-day').values_list('data', flat=True).iterator(chunk_size=4):
+        segments_read.inc()
+        for row in reversed(decode_segment(data)):
+            position = (row[3], row[0])
+            if before is not None and position >= tuple(before):
+                continue
+            if after is not None and position <= tuple(after):
+                return _expand(room_id, found[:limit]), len(found) > limit
+            found.append(row)
+        # One row past the limit tells whether there are older ones
+        if len(found) > limit:
+            break
+    return _expand(room_id, found[:limit]), len(found) > limit
+
+
+def archived_after(room_id, after, limit):
+    """Up to ``limit`` archived messages of a room after ``after``, oldest first."""
+    segments = MessageArchive.objects.filter(
+        room_id=room_id, day__gte=after[0].astimezone(timezone.utc).date())
+
+    found = []
+    for data in segments.order_by('day').values_list('data', flat=True).iterator(chunk_size=4):
+        segments_read.inc()
+        found.extend(row for row in decode_segment(data) if (row[3], row[0]) > tuple(after))
+        if len(found) >= limit:
+            break
+    return _expand(room_id, found[:limit])
@@ -0,0 +1,164 @@
+"""
+Signed connection tokens for WebSocket auth.
+
+Session auth costs every WebSocket connect a session lookup and a ``User``
+fetch, both through sync-to-async threads, which is what a reconnect storm
+queues up behind. Instead, a logged-in client can mint a short-lived token with
+``POST /api/users/ws_token/`` and connect with ``?token=<token>``.
+
+The token is a ``django.core.signing`` HMAC over the user's id and username,
+timestamped and valid for ``CHAT_WS_TOKEN_MAX_AGE`` seconds, so
+``TokenAuthMiddleware`` checks it and builds a ``TokenUser`` without touching
+the database. Tokens are signed, not encrypted, and travel in query strings
+that end up in access logs, so they carry nothing else; the email and names
+are loaded the first time the user sends a message. Verified tokens are cached
+in-process, so the several sockets a client opens with one token (one per room,
+plus notifications) share a user.
+
+Connects without a token, or with one that is expired or fails verification,
+go through the usual session auth, so older clients keep working and a client
+holding a stale token is not locked out while it mints a new one.
+"""
+
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs
+
+from channels.auth import AuthMiddlewareStack
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import signing
+
+from . import metrics
+from .db import database_sync_to_async
+
+TOKEN_SALT = 'chat.ws-token'
+
+# Verified tokens kept per worker
+TOKEN_CACHE_SIZE = 10_000
+
+token_auth = metrics.Counter(
+    'chat_ws_token_auth_total', 'WebSocket connects by how they were authenticated',
+    labelnames=('result',))
+
+
+class TokenUser:
+    """The user a connection token was minted for; enough of ``User`` for the consumers."""
+
+    is_authenticated = True
+    is_anonymous = False
+    is_active = True
+
+    def __init__(self, id, username):
+        self.id = id
+        self.username = username
+        self.email = ''
+        self.first_name = ''
+        self.last_name = ''
+        self.details_loaded = False
+
+    async def load_details(self):
+        """Fill in the fields the token leaves out; a no-op once done."""
+        if self.details_loaded:
+            return
+        details = await database_sync_to_async(
+            User.objects.filter(id=self.id).values('email', 'first_name', 'last_name').first
+        )()
+        if details is not None:
+            self.email = details['email']
+            self.first_name = details['first_name']
+            self.last_name = details['last_name']
+        self.details_loaded = True
+
+    @property
+    def pk(self):
+        return self.id
+
+    def __str__(self):
+        return self.username
+
+    def __eq__(self, other):
+        return getattr(other, 'pk', None) == self.id and getattr(other, 'is_authenticated', False)
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+def mint_token(user):
+    """A connection token for ``user``."""
+    return signing.dumps({
+        'id': user.id,
+        'username': user.username,
+    }, salt=TOKEN_SALT, compress=True)
+
+
+class TokenCache:
+    def __init__(self, max_age, maxsize=TOKEN_CACHE_SIZE):
+        self.max_age = max_age
+        self.maxsize = maxsize
+        self._users = OrderedDict()
+
+    def get(self, token):
+        """The ``TokenUser`` for a valid token, else None. Raises ``SignatureExpired`` when stale."""
+        cached = self._users.get(token)
+        if cached is not None:
+            user, expires = cached
+            if expires > time.time():
+                self._users.move_to_end(token)
+                return user
+            del self._users[token]
+            raise signing.SignatureExpired('Connection token expired')
+
+        try:
+            fields = signing.loads(token, salt=TOKEN_SALT, max_age=self.max_age)
+        except signing.SignatureExpired:
+            raise
+        except signing.BadSignature:
+            return None
+        # Tokens end in ':<minted at>:<signature>'; cache until the token itself expires
+        issued = signing.b62_decode(token.rsplit(':', 2)[-2])
+
+        user = TokenUser(fields['id'], fields['username'])
+        self._users[token] = (user, issued + self.max_age)
+        while len(self._users) > self.maxsize:
+            self._users.popitem(last=False)
+        return user
+
+
+_cache = None
+
+
+def get_token_cache():
+    global _cache
+    if _cache is None:
+        _cache = TokenCache(settings.CHAT_WS_TOKEN_MAX_AGE)
+    return _cache
+
+
+class TokenAuthMiddleware:
+    """
+    Authenticates WebSocket connects from a ``?token=`` connection token,
+    and everything else with ``AuthMiddlewareStack``.
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.session_auth = AuthMiddlewareStack(inner)
+
+    async def __call__(self, scope, receive, send):
+        token = parse_qs(scope.get('query_string', b'').decode()).get('token', [''])[0]
+        if not token:
+            token_auth.labels('session').inc()
+            return await self.session_auth(scope, receive, send)
+
+        try:
+            user = get_token_cache().get(token)
+        except signing.SignatureExpired:
+            token_auth.labels('expired').inc()
+            return await self.session_auth(scope, receive, send)
+        if user is None:
+            token_auth.labels('invalid').inc()
+            return await self.session_auth(scope, receive, send)
+
+        token_auth.labels('token').inc()
+        return await self.inner(dict(scope, user=user), receive, send)
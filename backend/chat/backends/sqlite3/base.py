@@ -0,0 +1,18 @@
+"""
+SQLite backend that opens transactions with ``BEGIN IMMEDIATE``.
+
+Async database work runs on several pool threads (see ``chat.db``), so atomic
+blocks from different connections overlap. A deferred transaction that reads
+before it writes has to upgrade its lock, and SQLite fails that upgrade with
+"database is locked" straight away rather than waiting out ``busy_timeout``.
+Taking the write lock when the transaction begins makes concurrent writers
+wait their turn instead. Reads outside transactions are not affected and run
+alongside the writer under WAL.
+"""
+
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute('BEGIN IMMEDIATE')
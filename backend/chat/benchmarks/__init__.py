@@ -0,0 +1,12 @@
+"""
+Load generation for the chat WebSocket consumers.
+
+``manage.py loadtest`` drives thousands of simulated clients through the
+scenarios in ``scenarios`` and writes the results as JSON so runs can be
+compared. Clients either run in-process against the consumers through
+``channels.testing.WebsocketCommunicator`` (``clients.InProcessClient``) or
+connect over a real socket to a running server (``clients.SocketClient``).
+
+Latency is measured from just before a client sends a frame to the moment a
+recipient in the same load generator reads it, so both ends use one clock.
+"""
@@ -0,0 +1,81 @@
+import asyncio
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+
+from chat.protocol import DEFAULT_CODEC
+from chat.routing import websocket_urlpatterns
+
+# The consumers without the auth middleware; in-process clients put their user
+# straight into the scope
+application = URLRouter(websocket_urlpatterns)
+
+
+class InProcessClient:
+    """A simulated client talking to the consumers in this event loop."""
+
+    def __init__(self, path, user):
+        self.communicator = WebsocketCommunicator(application, path)
+        self.communicator.scope['user'] = user
+
+    async def connect(self, timeout=10):
+        connected, _ = await self.communicator.connect(timeout)
+        return connected
+
+    async def send(self, frame):
+        await self.communicator.send_to(text_data=DEFAULT_CODEC.encode(frame))
+
+    async def receive(self, timeout):
+        """Next frame from the consumer, or None on timeout or close."""
+        # Read the output queue directly: the communicator's own receive
+        # cancels the consumer when it times out
+        message = await asyncio.wait_for(self.communicator.output_queue.get(), timeout)
+        if message['type'] != 'websocket.send':
+            return None
+        return DEFAULT_CODEC.decode(message.get('text'), message.get('bytes'))
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class SocketClient:
+    """A simulated client connected to a running server over a real socket."""
+
+    def __init__(self, url, session_key=None):
+        self.url = url
+        self.session_key = session_key
+        self.websocket = None
+
+    async def connect(self, timeout=10):
+        try:
+            import websockets
+        except ImportError:
+            raise RuntimeError('Socket clients need the websockets package')
+        headers = {}
+        if self.session_key:
+            headers['Cookie'] = f'sessionid={self.session_key}'
+        try:
+            self.websocket = await websockets.connect(
+                self.url, additional_headers=headers, open_timeout=timeout, max_queue=None,
+            )
+        except (OSError, asyncio.TimeoutError, websockets.InvalidHandshake):
+            return False
+        return True
+
+    async def send(self, frame):
+        await self.websocket.send(DEFAULT_CODEC.encode(frame))
+
+    async def receive(self, timeout):
+        """Next frame from the server, or None once the socket is closed."""
+        import websockets
+        try:
+            data = await asyncio.wait_for(self.websocket.recv(), timeout)
+        except websockets.ConnectionClosed:
+            return None
+        if isinstance(data, bytes):
+            return DEFAULT_CODEC.decode(bytes_data=data)
+        return DEFAULT_CODEC.decode(data)
+
+    async def close(self):
+        if self.websocket is not None:
+            await self.websocket.close()
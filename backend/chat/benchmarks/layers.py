@@ -0,0 +1,21 @@
+from django.core.management.base import CommandError
+from django.utils.module_loading import import_string
+
+LAYERS = ('memory', 'unix', 'rabbitmq')
+
+
+def make_layer(name, capacity=100, socket_dir='/tmp/chat-channel-layer', rabbitmq_url=None):
+    """Build a fresh channel layer of the named kind, outside CHANNEL_LAYERS."""
+    if name == 'memory':
+        backend, config = 'channels.layers.InMemoryChannelLayer', {}
+    elif name == 'unix':
+        backend, config = 'chat.layers.UnixSocketChannelLayer', {'path': socket_dir}
+    elif name == 'rabbitmq':
+        backend, config = 'channels_rabbitmq.core.RabbitmqChannelLayer', {'host': rabbitmq_url}
+    else:
+        raise CommandError(f'Unknown layer {name!r}')
+    try:
+        layer_class = import_string(backend)
+    except ImportError as exc:
+        raise CommandError(f'Cannot load the {name} channel layer: {exc}')
+    return layer_class(capacity=capacity, **config)
@@ -0,0 +1,119 @@
+import asyncio
+import secrets
+import time
+
+from .stats import latency_summary
+
+
+def stamp(run, seq, payload):
+    """Message text carrying the run id, sequence number and send time."""
+    text = f'{run}:{seq}:{time.perf_counter_ns()}:'
+    return text + 'x' * max(payload - len(text), 0)
+
+
+def unstamp(run, text):
+    """Send time in seconds of a stamped message from this run, else None."""
+    if not isinstance(text, str) or not text.startswith(run + ':'):
+        return None
+    return int(text.split(':', 3)[2]) / 1e9
+
+
+async def connect_all(clients, concurrency=100):
+    """Connect clients in waves of ``concurrency``; return those that connected."""
+    connected = []
+    for start in range(0, len(clients), concurrency):
+        wave = clients[start:start + concurrency]
+        results = await asyncio.gather(*(client.connect() for client in wave))
+        connected.extend(client for client, ok in zip(wave, results) if ok)
+    return connected
+
+
+async def close_all(clients, concurrency=100):
+    for start in range(0, len(clients), concurrency):
+        await asyncio.gather(
+            *(client.close() for client in clients[start:start + concurrency]),
+            return_exceptions=True,
+        )
+
+
+async def measure_delivery(clients, send_all, messages, idle_timeout):
+    """
+    Run ``send_all(run)`` while every client listens for ``messages`` stamped
+    frames, and return throughput and send-to-deliver latency.
+    """
+    run = secrets.token_hex(4)
+    latencies = []
+    errors = 0
+    last_delivery = 0.0
+
+    async def listen(client):
+        nonlocal errors, last_delivery
+        received = 0
+        while received < messages:
+            try:
+                frame = await client.receive(idle_timeout)
+            except asyncio.TimeoutError:
+                return
+            if frame is None:
+                return
+            if frame.get('type') == 'error':
+                errors += 1
+                continue
+            sent_at = unstamp(run, frame.get('message'))
+            if sent_at is None:
+                continue
+            now = time.perf_counter()
+            latencies.append(now - sent_at)
+            last_delivery = max(last_delivery, now)
+            received += 1
+
+    listeners = [asyncio.ensure_future(listen(client)) for client in clients]
+    started = time.perf_counter()
+    await send_all(run)
+    sent = time.perf_counter()
+    await asyncio.gather(*listeners)
+
+    duration = max(last_delivery, sent) - started
+    expected = messages * len(clients)
+    return {
+        'messages': messages,
+        'deliveries': len(latencies),
+        'lost': expected - len(latencies),
+        'errors': errors,
+        'duration_s': round(duration, 4),
+        'messages_per_sec': round(messages / duration, 1),
+        'deliveries_per_sec': round(len(latencies) / duration, 1),
+        **latency_summary(latencies),
+    }
+
+
+async def chat_room(clients, messages, senders=10, payload=100, rate=0, idle_timeout=5.0):
+    """Members of one room send ``messages`` chat messages between them."""
+    senders = clients[:max(min(senders, len(clients)), 1)]
+
+    async def send_all(run):
+        interval = len(senders) / rate if rate else 0
+
+        async def sender(index, client):
+            for seq in range(index, messages, len(senders)):
+                await client.send({'message': stamp(run, seq, payload)})
+                if interval:
+                    await asyncio.sleep(interval)
+
+        await asyncio.gather(*(sender(index, client) for index, client in enumerate(senders)))
+
+    return await measure_delivery(clients, send_all, messages, idle_timeout)
+
+
+async def notifications(clients, layer, user_ids, messages, payload=100, rate=0, idle_timeout=5.0):
+    """Push ``messages`` notifications to every connected user through the channel layer."""
+
+    async def send_all(run):
+        for seq in range(messages):
+            event = {'type': 'notification_message', 'message': stamp(run, seq, payload)}
+            for user_id in user_ids:
+                await layer.group_send(f'user_{user_id}', event)
+            if rate:
+                await asyncio.sleep(1 / rate)
+
+    return await measure_delivery(clients, send_all, messages, idle_timeout)
@@ -0,0 +1,31 @@
+import math
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return None
+    rank = max(math.ceil(fraction * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def latency_summary(latencies):
+    """p50/p95/p99/max of latencies in seconds, reported in milliseconds."""
+    ordered = sorted(latencies)
+    summary = {}
+    for name, fraction in (('p50', 0.50), ('p95', 0.95), ('p99', 0.99), ('max', 1.0)):
+        value = percentile(ordered, fraction)
+        summary[f'{name}_ms'] = None if value is None else round(value * 1000, 3)
+    return summary
+
+
+def process_rss(pids):
+    """Resident set size in bytes summed over ``pids``, from /proc."""
+    total = 0
+    for pid in pids:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    total += int(line.split()[1]) * 1024
+                    break
+    return total
@@ -1,85 +1,314 @@
-import json
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from django.contrib.auth.models import User
-from .models import ChatRoom, Message, UserProfile
+from django.conf import settings
+from . import metrics
+from .admission import CLOSE_OVERLOADED, get_admission
+from .auth import TokenUser
+from .dedupe import MAX_CLIENT_MSG_ID, get_accepted_messages
+from .outbound import CLOSE_SLOW_CONSUMER, OutboundQueue
+from .persistence import MessageNotSaved, get_message_writer
+from .presence import get_presence
+from .protocol import DEFAULT_CODEC, chat_message_event, chat_message_frame, select_codec
+from .ratelimit import get_rate_limits
+from .recent import get_recent_messages
+from .rooms import aresolve_room
+from .serializers import encode_message
 
+connections = metrics.Gauge(
+    'chat_ws_connections', 'Open WebSocket connections', labelnames=('consumer',))
+chat_connections = connections.labels('chat')
+notification_connections = connections.labels('notifications')
+messages_received = metrics.Counter(
+    'chat_messages_received_total', 'Chat messages received from clients', labelnames=('room',))
+messages_delivered = metrics.Counter(
+    'chat_messages_delivered_total', 'Chat messages fanned out to sockets', labelnames=('room',))
+save_message_seconds = metrics.Histogram(
+    'chat_save_message_seconds', 'Time spent in ChatConsumer.save_message')
+update_user_status_seconds = metrics.Histogram(
+    'chat_update_user_status_seconds', 'Time spent in ChatConsumer.update_user_status')
+group_send_seconds = metrics.Histogram(
+    'chat_group_send_seconds', 'Time spent in channel layer group_send')
 
-class ChatConsumer(AsyncWebsocketConsumer):
+
+class AdmittedConsumer(AsyncWebsocketConsumer):
+    """Base for consumers whose sockets count against the worker's admission limits."""
+    codec = DEFAULT_CODEC
+    admitted = False
+    
+    async def admit(self):
+        """Take a connection slot, or turn the socket away with a retry hint."""
+        retry_after = get_admission().admit()
+        if not retry_after:
+            self.admitted = True
+            return True
+        
+        # Accepted only so the client can be told when to come back
+        self.codec = select_codec(self.scope)
+        await self.accept(self.codec.subprotocol)
+        await self.send(**self.codec.send_kwargs(self.codec.encode({
+            'type': 'error',
+            'code': 'overloaded',
+            'message': 'Server is busy, try again later',
+            'retry_after': retry_after,
+        })))
+        await self.close(CLOSE_OVERLOADED)
+        return False
+    
+    def release(self):
+        if self.admitted:
+            self.admitted = False
+            get_admission().release()
+
+
+class ChatConsumer(AdmittedConsumer):
+    # Set in connect() from the negotiated subprotocol
+    codec = DEFAULT_CODEC
+    # Set in connect(); queues frames between the channel layer and the socket
+    outbound = None
+    # Ids sent in the history or replay frame, so live copies of them are not
+    # sent again
+    history_ids = None
+    # Whether this socket holds a presence reference to give back
+    present = False
+    
     async def connect(self):
+        # Shed load before the room lookup, presence or anything else
+        if not await self.admit():
+            return
+        
         self.room_name = self.scope['url_route']['kwargs']['room_name']
-        self.room_group_name = f'chat_{self.room_name}'
+        
+        # Resolve the room once for the life of the socket; it may be
+        # addressed by name or by id
+        self.room = await aresolve_room(self.room_name)
+        if self.room is None:
+            self.release()
+            await self.close()
+            return
+        # Keyed by id so sockets addressing the room either way share a group
+        self.room_group_name = f'chat_{self.room.id}'
+        
+        # Binary clients ask for their encoding through Sec-WebSocket-Protocol
+        self.codec = select_codec(self.scope)
+        
+        # Per-room counters, looked up once rather than on every message
+        self.received_counter = messages_received.labels(self.room.name)
+        self.delivered_counter = messages_delivered.labels(self.room.name)
+        
+        # Clients advertise batch support with ?batch=1, ask for the room's
+        # recent messages with ?history=1 and resume with ?last_seen=<id>
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        self.outbound = OutboundQueue(
+            send_frame=self.send_frame,
+            send_batch=self.send_batch,
+            send_resync=self.send_resync,
+            disconnect=self.close_slow_consumer,
+            capacity=settings.CHAT_OUTBOUND_QUEUE_SIZE,
+            policy=settings.CHAT_SLOW_CONSUMER_POLICY,
+            batch=query.get('batch', ['0'])[0] == '1',
+            window=settings.CHAT_COALESCE_WINDOW_MS / 1000,
+            max_messages=settings.CHAT_COALESCE_MAX_MESSAGES,
+        )
         
         # Join room group
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
+        self.recent = get_recent_messages()
+        self.recent.join(self.room.id)
         
         # Accept the connection
-        await self.accept()
+        await self.accept(self.codec.subprotocol)
+        chat_connections.inc()
+        
+        last_seen = query.get('last_seen', [''])[0]
+        if last_seen.isdigit():
+            await self.send_replay(int(last_seen))
+        elif query.get('history', ['0'])[0] == '1':
+            await self.send_history()
         
         # Update user online status
         if self.scope['user'].is_authenticated:
             await self.update_user_status(True)
     
     async def disconnect(self, close_code):
+        self.release()
+        if getattr(self, 'room', None) is None:
+            return
+        chat_connections.dec()
+        
+        if self.outbound is not None:
+            self.outbound.close()
+        
         # Leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
+        self.recent.leave(self.room.id)
         
         # Update user offline status
         if self.scope['user'].is_authenticated:
             await self.update_user_status(False)
     
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        message = text_data_json['message']
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = self.codec.decode(text_data, bytes_data)
+        except ValueError:
+            data = None
+        message = data.get('message') if isinstance(data, dict) else None
+        if not isinstance(message, str) or not message:
+            await self.send_error('invalid_frame', 'Expected an object with a non-empty message')
+            return
         user = self.scope['user']
+        self.received_counter.inc()
         
-        # Save message to database
-        await self.save_message(user, message)
+        # A retry of a message we already accepted is only acknowledged again
+        user_key = user.id if user.is_authenticated else self.channel_name
+        client_msg_id = data.get('client_msg_id')
+        if client_msg_id is not None:
+            client_msg_id = str(client_msg_id)[:MAX_CLIENT_MSG_ID]
+            accepted = get_accepted_messages().get(user_key, client_msg_id)
+            if accepted is not None:
+                await self.send_ack(client_msg_id, *accepted)
+                return
+        
+        # Enforce the per-user and per-room message rates before any work
+        scope, retry_after = await get_rate_limits().check(user_key, self.room.id)
+        if scope is not None:
+            await self.send_error(
+                'rate_limited',
+                f'Too many messages for this {scope}, slow down',
+                retry_after=round(retry_after, 3),
+                client_msg_id=client_msg_id,
+            )
+            return
+        
+        # Save message to database; its id and timestamp are assigned
+        # up front, so they are known even when the write is queued
+        if isinstance(user, TokenUser):
+            # The buffered copy carries the sender's email and names
+            await user.load_details()
+        try:
+            saved = await self.save_message(user, message)
+        except MessageNotSaved:
+            # Not fanned out or acknowledged, so the client can retry it
+            await self.send_error('not_saved', 'Message could not be saved', client_msg_id=client_msg_id)
+            return
+        entry = encode_message(saved, user)
+        self.recent.add(self.room.id, entry)
+        if client_msg_id is not None:
+            get_accepted_messages().put(user_key, client_msg_id, saved.id, entry['timestamp'])
         
         # Send message to room group
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'chat_message',
-                'message': message,
-                'username': user.username,
-                'user_id': user.id
-            }
-        )
+        with group_send_seconds.time():
+            await self.channel_layer.group_send(self.room_group_name, chat_message_event(entry))
+        
+        if client_msg_id is not None:
+            await self.send_ack(client_msg_id, saved.id, entry['timestamp'])
     
     async def chat_message(self, event):
-        message = event['message']
-        username = event['username']
-        user_id = event['user_id']
+        entry = event.get('entry')
+        if entry is not None:
+            # Keeps this worker's buffer current with messages sent elsewhere
+            self.recent.add(self.room.id, entry)
+            if self.history_ids is not None:
+                if entry['id'] in self.history_ids:
+                    return
+                # Live messages have caught up with the history frame
+                self.history_ids = None
+        
+        frame = event.get('frames', {}).get(self.codec.name)
+        if frame is None:
+            # Event from a sender that predates pre-encoded frames
+            frame = self.codec.encode_chat_message(chat_message_frame(
+                event['message'], event['username'], event['user_id']
+            ))
         
         # Send message to WebSocket
-        await self.send(text_data=json.dumps({
+        self.delivered_counter.inc()
+        if self.outbound is not None:
+            self.outbound.push(frame)
+        else:
+            await self.send_frame(frame)
+    
+    async def send_history(self):
+        messages = await self.recent.history(self.room.id)
+        self.history_ids = {entry['id'] for entry in messages}
+        await self.send(**self.codec.send_kwargs(self.codec.encode({
+            'type': 'history',
+            'messages': messages,
+        })))
+    
+    async def send_replay(self, last_seen):
+        messages = await self.recent.since(
+            self.room.id, last_seen, settings.CHAT_RESUME_MAX_MESSAGES
+        )
+        if messages is None:
+            # Too far behind to replay; the client refetches the history
+            await self.send_resync(None)
+            return
+        self.history_ids = {entry['id'] for entry in messages}
+        await self.send(**self.codec.send_kwargs(self.codec.encode({
+            'type': 'replay',
+            'messages': messages,
+        })))
+    
+    async def send_frame(self, frame):
+        await self.send(**self.codec.send_kwargs(frame))
+    
+    async def send_batch(self, frames):
+        await self.send(**self.codec.send_kwargs(self.codec.encode_batch(frames)))
+    
+    async def send_resync(self, missed):
+        # The client fell behind and lost frames; it should refetch history
+        await self.send(**self.codec.send_kwargs(self.codec.encode({
+            'type': 'resync',
+            'missed': missed,
+        })))
+    
+    async def send_ack(self, client_msg_id, message_id, timestamp):
+        await self.send(**self.codec.send_kwargs(self.codec.encode({
+            'type': 'ack',
+            'client_msg_id': client_msg_id,
+            'id': message_id,
+            'timestamp': timestamp,
+        })))
+    
+    async def send_error(self, code, message, **extra):
+        await self.send(**self.codec.send_kwargs(self.codec.encode({
+            'type': 'error',
+            'code': code,
             'message': message,
-            'username': username,
-            'user_id': user_id
-        }))
-    
-    @database_sync_to_async
-    def save_message(self, user, message):
-        room = ChatRoom.objects.get(name=self.room_name)
-        Message.objects.create(room=room, user=user, content=message)
-    
-    @database_sync_to_async
-    def update_user_status(self, is_online):
-        profile, created = UserProfile.objects.get_or_create(user=self.scope['user'])
-        profile.is_online = is_online
-        profile.save()
+            **extra,
+        })))
+    
+    async def close_slow_consumer(self):
+        await self.close(CLOSE_SLOW_CONSUMER)
+    
+    async def save_message(self, user, message):
+        with save_message_seconds.time():
+            return await get_message_writer().save(self.room.id, user.id, message)
+    
+    async def update_user_status(self, is_online):
+        presence = get_presence()
+        with update_user_status_seconds.time():
+            if is_online:
+                await presence.connect(self.scope['user'].id, self.room.id)
+                self.present = True
+            elif self.present:
+                self.present = False
+                await presence.disconnect(self.scope['user'].id, self.room.id)
 
 
-class NotificationConsumer(AsyncWebsocketConsumer):
+class NotificationConsumer(AdmittedConsumer):
     async def connect(self):
         if self.scope['user'].is_authenticated:
+            if not await self.admit():
+                return
+            
+            self.codec = select_codec(self.scope)
             self.user_id = self.scope['user'].id
             self.user_group_name = f'user_{self.user_id}'
             
@@ -89,10 +318,13 @@ class NotificationConsumer(AsyncWebsocketConsumer):
                 self.channel_name
             )
             
-            await self.accept()
+            await self.accept(self.codec.subprotocol)
+            notification_connections.inc()
     
     async def disconnect(self, close_code):
+        self.release()
         if hasattr(self, 'user_group_name'):
+            notification_connections.dec()
             await self.channel_layer.group_discard(
                 self.user_group_name,
                 self.channel_name
@@ -100,8 +332,8 @@ class NotificationConsumer(AsyncWebsocketConsumer):
     
     async def notification_message(self, event):
         # Send notification to WebSocket
-        await self.send(text_data=json.dumps({
+        await self.send(**self.codec.send_kwargs(self.codec.encode({
             'type': 'notification',
             'message': event['message'],
             'notification_type': event.get('notification_type', 'info')
-        })) 
\ No newline at end of file
+        }))) 
\ No newline at end of file
@@ -0,0 +1,157 @@
+"""
+Database access from async code.
+
+``database_sync_to_async`` here replaces the Channels one for the chat app's
+own ORM work. Channels runs every call on asgiref's single thread-sensitive
+thread and Django opens a new connection for it whenever the last one was
+closed; here calls run on a dedicated pool of ``CHAT_DB_POOL_SIZE`` threads,
+each keeping its connection open between calls for ``CHAT_DB_CONN_MAX_AGE``
+seconds and checking it is still alive before reuse. Only pool threads keep
+their connections: the database settings leave ``CONN_MAX_AGE`` at 0, so the
+threads Django runs HTTP views on close theirs at the end of every request.
+The thread pool is the connection pool: a worker never holds more than
+``CHAT_DB_POOL_SIZE`` connections for async work, and calls beyond that wait
+in the executor queue rather than opening more. ``CHAT_DB_POOL_MIN``
+connections are opened at startup so the first requests do not pay for them.
+
+Time spent waiting for a pool thread is recorded in
+``chat_db_pool_wait_seconds``. The pool metrics are updated from several
+threads at once, so updates to them take ``_metrics_lock``.
+
+SQLite connections are switched to WAL mode with ``synchronous=NORMAL`` when
+opened, so readers do not block the writer, and wait up to
+``CHAT_SQLITE_BUSY_TIMEOUT`` seconds for a lock instead of failing. SQLite has
+one writer at a time, so on SQLite calls wrapped with ``write=True`` run on a
+single writer thread of their own instead of racing each other for the lock
+from the pool; the ``chat.backends.sqlite3`` engine also opens transactions
+with ``BEGIN IMMEDIATE`` so the writers of other processes wait on the busy
+timeout rather than failing on a lock upgrade.
+"""
+
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.db.backends.signals import connection_created
+
+from . import metrics
+from .lifespan import on_startup
+
+pool_wait_seconds = metrics.Histogram(
+    'chat_db_pool_wait_seconds', 'Time database calls waited for a pool thread')
+pool_call_seconds = metrics.Histogram(
+    'chat_db_pool_call_seconds', 'Time database calls held a pool thread')
+pool_in_use = metrics.Gauge(
+    'chat_db_pool_in_use', 'Pool threads running a database call')
+pool_waiting = metrics.Gauge(
+    'chat_db_pool_waiting', 'Database calls waiting for a pool thread')
+connections_opened = metrics.Counter(
+    'chat_db_connections_opened_total', 'Database connections opened by this process')
+
+_executor = None
+_writer = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+_metrics_lock = threading.Lock()
+# Marks the pool's threads, whose connections outlive a single call
+_pool_thread = threading.local()
+
+
+def _start_pool_thread():
+    _pool_thread.active = True
+
+
+def get_executor(write=False):
+    global _executor, _writer, _executor_pid
+    # Forked workers must not share the parent's threads
+    if _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.CHAT_DB_POOL_SIZE, thread_name_prefix='chat-db',
+                    initializer=_start_pool_thread)
+                _writer = None
+                if connection.vendor == 'sqlite':
+                    _writer = ThreadPoolExecutor(
+                        max_workers=1, thread_name_prefix='chat-db-writer',
+                        initializer=_start_pool_thread)
+                _executor_pid = os.getpid()
+    return _writer if write and _writer is not None else _executor
+
+
+def _run(func, args, kwargs, submitted):
+    started = time.perf_counter()
+    with _metrics_lock:
+        pool_waiting.dec()
+        pool_wait_seconds.observe(started - submitted)
+        pool_in_use.inc()
+    # Drops the thread's connection only if it is past its age or broken
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+        with _metrics_lock:
+            pool_in_use.dec()
+            pool_call_seconds.observe(time.perf_counter() - started)
+
+
+def database_sync_to_async(func=None, *, write=False):
+    """
+    Wrap a sync function that uses the ORM to run on the database pool, or on
+    the writer thread on SQLite if ``write`` is set.
+    """
+    if func is None:
+        return functools.partial(database_sync_to_async, write=write)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        context = contextvars.copy_context()
+        with _metrics_lock:
+            pool_waiting.inc()
+        return await asyncio.get_running_loop().run_in_executor(
+            get_executor(write),
+            functools.partial(context.run, _run, func, args, kwargs, time.perf_counter()),
+        )
+    return wrapper
+
+
+def configure_connection(sender, connection, **kwargs):
+    with _metrics_lock:
+        connections_opened.inc()
+    if getattr(_pool_thread, 'active', False):
+        # Outlive the call, unlike the CONN_MAX_AGE=0 connections of other threads
+        connection.close_at = time.monotonic() + settings.CHAT_DB_CONN_MAX_AGE
+        connection.health_check_enabled = True
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+            cursor.execute(f'PRAGMA busy_timeout={int(settings.CHAT_SQLITE_BUSY_TIMEOUT * 1000)}')
+
+
+connection_created.connect(configure_connection)
+
+
+@on_startup
+async def warm_pool():
+    count = min(settings.CHAT_DB_POOL_MIN, settings.CHAT_DB_POOL_SIZE)
+    if count < 1:
+        return
+    # Every call holds its thread until all have connected, so each lands on its own
+    barrier = threading.Barrier(count)
+
+    def connect():
+        connection.ensure_connection()
+        try:
+            barrier.wait(timeout=10)
+        except threading.BrokenBarrierError:
+            pass
+
+    await asyncio.gather(*(database_sync_to_async(connect)() for _ in range(count)))
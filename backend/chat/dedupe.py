@@ -0,0 +1,63 @@
+"""
+Idempotent chat message retries.
+
+Clients may tag a chat message with a ``client_msg_id`` of their choosing and
+resend it, with the same tag, if they never saw it acknowledged. The first
+copy is accepted and answered with an ``ack`` frame carrying the message id;
+copies arriving within ``CHAT_CLIENT_MSG_ID_TTL`` seconds are only answered
+with the same ``ack``, and are not saved or fanned out again.
+
+Accepted tags are remembered by the worker that received them, so a retry is
+only recognised if it reaches the same worker.
+"""
+
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from . import metrics
+
+duplicates = metrics.Counter(
+    'chat_duplicate_messages_total', 'Retried chat messages answered without resending')
+
+# Longest client_msg_id kept; longer tags are cut to this
+MAX_CLIENT_MSG_ID = 64
+
+
+class AcceptedMessages:
+    def __init__(self, maxsize=100_000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, user_key, client_msg_id):
+        """The ``(id, timestamp)`` a tag was accepted as, or None."""
+        key = (user_key, client_msg_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        accepted, expires = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+        duplicates.inc()
+        return accepted
+
+    def put(self, user_key, client_msg_id, message_id, timestamp):
+        key = (user_key, client_msg_id)
+        self._entries[key] = ((message_id, timestamp), time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        # Every entry has the same ttl, so the front is also the first to expire
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+_accepted = None
+
+
+def get_accepted_messages():
+    global _accepted
+    if _accepted is None:
+        _accepted = AcceptedMessages(ttl=settings.CHAT_CLIENT_MSG_ID_TTL)
+    return _accepted
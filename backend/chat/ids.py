@@ -0,0 +1,122 @@
+"""
+Time-ordered ids for chat messages, generated without the database.
+
+An id packs, from the most significant bit down:
+
+* 41 bits - milliseconds since ``EPOCH`` (about 69 years of range)
+* 7 bits  - worker id, 0-127
+* 5 bits  - sequence within the millisecond, 0-31
+
+so ids sort by creation time, are unique across workers with distinct worker
+ids, and new messages land at the end of ``(room, id)`` index ranges. They
+are stored in a ``bigint`` column but kept to 53 bits so browsers can hold
+them as JavaScript numbers without losing precision. A worker issuing more
+than 32 ids in a millisecond borrows the following milliseconds.
+
+Every process writing messages needs its own worker id. ``runchat`` gives its
+workers ``CHAT_ID_WORKER + index`` (from 0 when unset), so on several hosts
+each needs a ``CHAT_ID_WORKER`` base whose range does not overlap another's.
+Any other process uses ``CHAT_ID_WORKER`` as is. With neither, the id is
+derived from the host name and process id, and a warning is logged: two such
+processes share an id with a chance of 1 in 128, and then issue duplicate ids.
+
+If the clock steps backwards the generator keeps counting from the last
+millisecond it issued rather than reusing ids.
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+EPOCH_MS = int(EPOCH.timestamp() * 1000)
+
+WORKER_BITS = 7
+SEQUENCE_BITS = 5
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+TIMESTAMP_SHIFT = WORKER_BITS + SEQUENCE_BITS
+
+
+def configured_worker_base():
+    """``CHAT_ID_WORKER`` as an int, or None when unset."""
+    configured = settings.CHAT_ID_WORKER
+    if configured == '':
+        return None
+    worker = int(configured)
+    if not 0 <= worker <= MAX_WORKER:
+        raise ValueError(f'CHAT_ID_WORKER must be between 0 and {MAX_WORKER}, got {worker}')
+    return worker
+
+
+def default_worker_id():
+    base = configured_worker_base()
+    # Set by runchat in each worker it starts
+    index = os.environ.get('CHAT_WORKER_ID')
+    if index is not None:
+        worker = (base or 0) + int(index)
+        if worker > MAX_WORKER:
+            raise ValueError(f'Worker id {worker} is past {MAX_WORKER}; lower CHAT_ID_WORKER or --workers')
+        return worker
+    if base is not None:
+        return base
+    logger.warning(
+        'CHAT_ID_WORKER is not set; deriving the message id worker from the process id, '
+        'which can collide with another process writing messages'
+    )
+    return (zlib.crc32(socket.gethostname().encode()) + os.getpid()) & MAX_WORKER
+
+
+class IdGenerator:
+    def __init__(self, worker_id):
+        if not 0 <= worker_id <= MAX_WORKER:
+            raise ValueError(f'Worker id must be between 0 and {MAX_WORKER}, got {worker_id}')
+        self.worker_id = worker_id
+        self._last_ms = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            now = time.time_ns() // 1_000_000 - EPOCH_MS
+            if now > self._last_ms:
+                self._last_ms = now
+                self._sequence = 0
+            else:
+                # Same millisecond, or the clock went backwards: keep counting
+                # on the last one, borrowing the next once it is used up
+                self._sequence += 1
+                if self._sequence > MAX_SEQUENCE:
+                    self._last_ms += 1
+                    self._sequence = 0
+            return (self._last_ms << TIMESTAMP_SHIFT) | (self.worker_id << SEQUENCE_BITS) | self._sequence
+
+
+_generator = None
+_generator_pid = None
+_generator_lock = threading.Lock()
+
+
+def next_id():
+    """A new message id. Used as the ``Message.id`` default."""
+    global _generator, _generator_pid
+    # Forked workers must not share the parent's generator state
+    if _generator_pid != os.getpid():
+        with _generator_lock:
+            if _generator_pid != os.getpid():
+                _generator = IdGenerator(default_worker_id())
+                _generator_pid = os.getpid()
+    return _generator()
+
+
+def id_datetime(message_id):
+    """The UTC time at which ``message_id`` was generated, to the millisecond."""
+    return EPOCH + timedelta(milliseconds=message_id >> TIMESTAMP_SHIFT)
@@ -0,0 +1,313 @@
+"""
+Channel layer for several ASGI workers on one host.
+
+``InMemoryChannelLayer`` only reaches consumers in its own process, so group
+sends silently miss every other worker. ``UnixSocketChannelLayer`` keeps the
+in-memory layer's local delivery and joins the workers of one host together
+over Unix domain sockets, with no broker in between:
+
+* Each worker listens on ``<path>/<worker>.sock``. Channel names embed the
+  worker id (``specific.<worker>!<random>``), so a send to a channel is one
+  write to the worker that owns it.
+* Group membership is stored by the worker that owns the channel, so each
+  worker only tracks its own sockets. ``group_send`` delivers to local members
+  and forwards the message once to every other worker, which delivers it to
+  its own members.
+* Local group tables are split into shards by group name. Expiry cleanup
+  walks one shard per call instead of every group on every send, and a
+  reverse index of each channel's groups means dropping an expired channel
+  only touches the groups it was in.
+
+Messages between workers are length-prefixed MessagePack. The socket
+directory is set to mode 0700 on startup, even if it already existed; anything
+that can write to it can send messages to every consumer.
+
+Named channels without a ``!`` are treated as local to the process.
+"""
+
+import asyncio
+import logging
+import os
+import secrets
+import struct
+import time
+import zlib
+from pathlib import Path
+
+import msgpack
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+logger = logging.getLogger(__name__)
+
+SEND = 0
+GROUP_SEND = 1
+
+_length = struct.Struct('>I')
+
+
+class UnixSocketChannelLayer(BaseChannelLayer):
+    extensions = ['groups', 'flush']
+    write_buffer_limit = 256 * 1024
+
+    def __init__(self, path='/tmp/chat-channel-layer', expiry=60, group_expiry=86400,
+                 capacity=100, channel_capacity=None, shards=16, peer_refresh=1.0, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.path = Path(path)
+        self.group_expiry = group_expiry
+        self.peer_refresh = peer_refresh
+        self.worker = f'{os.getpid()}-{secrets.token_hex(3)}'
+        self.channels = {}
+        self.shards = [{} for _ in range(shards)]
+        # Channel -> groups it is in, so expiry does not walk every shard
+        self.channel_groups = {}
+        self._clean_shard = 0
+        self._loop = None
+        self._server = None
+        self._peers = {}
+        self._peer_locks = {}
+        self._peer_names = []
+        self._peers_checked = 0
+
+    @property
+    def socket_path(self):
+        return self.path / f'{self.worker}.sock'
+
+    # Connection management
+
+    async def _ensure_server(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._server is not None:
+            return
+        # First use, or the layer outlived the event loop it started on
+        self._loop = loop
+        self._peers = {}
+        self._peer_locks = {}
+        self.path.mkdir(mode=0o700, parents=True, exist_ok=True)
+        # mkdir leaves an existing directory's mode alone
+        os.chmod(self.path, 0o700)
+        try:
+            self.socket_path.unlink()
+        except FileNotFoundError:
+            pass
+        self._server = await asyncio.start_unix_server(self._serve_peer, path=str(self.socket_path))
+        os.chmod(self.socket_path, 0o600)
+
+    async def _serve_peer(self, reader, writer):
+        try:
+            while True:
+                header = await reader.readexactly(_length.size)
+                payload = await reader.readexactly(_length.unpack(header)[0])
+                kind, target, message = msgpack.unpackb(payload, raw=False)
+                if kind == SEND:
+                    try:
+                        self._deliver(target, message)
+                    except ChannelFull:
+                        pass
+                elif kind == GROUP_SEND:
+                    self._deliver_group(target, message)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            # Server shutting down; end the handler quietly
+            pass
+        finally:
+            writer.close()
+
+    def _list_peers(self):
+        now = time.monotonic()
+        if now - self._peers_checked >= self.peer_refresh:
+            self._peers_checked = now
+            self._peer_names = [
+                entry.stem for entry in self.path.glob('*.sock') if entry.stem != self.worker
+            ]
+        return self._peer_names
+
+    async def _peer_writer(self, worker):
+        writer = self._peers.get(worker)
+        if writer is not None and not writer.is_closing():
+            return writer
+        # One connection per peer keeps messages to it in order
+        lock = self._peer_locks.setdefault(worker, asyncio.Lock())
+        async with lock:
+            writer = self._peers.get(worker)
+            if writer is not None and not writer.is_closing():
+                return writer
+            return await self._connect_peer(worker)
+
+    async def _connect_peer(self, worker):
+        socket_path = self.path / f'{worker}.sock'
+        try:
+            _, writer = await asyncio.open_unix_connection(str(socket_path))
+        except (FileNotFoundError, ConnectionRefusedError):
+            # The worker exited; clear its socket so it is not retried
+            try:
+                socket_path.unlink()
+            except FileNotFoundError:
+                pass
+            self._peers.pop(worker, None)
+            if worker in self._peer_names:
+                self._peer_names.remove(worker)
+            return None
+        self._peers[worker] = writer
+        return writer
+
+    async def _send_to_peer(self, worker, frame):
+        writer = await self._peer_writer(worker)
+        if writer is None:
+            return
+        try:
+            writer.write(frame)
+            # Only wait on the peer once its socket buffer starts backing up
+            if writer.transport.get_write_buffer_size() > self.write_buffer_limit:
+                await writer.drain()
+        except ConnectionError:
+            self._peers.pop(worker, None)
+
+    @staticmethod
+    def _frame(kind, target, message):
+        payload = msgpack.packb([kind, target, message], use_bin_type=True)
+        return _length.pack(len(payload)) + payload
+
+    @staticmethod
+    def _channel_worker(channel):
+        if '!' not in channel:
+            return None
+        return channel.rsplit('!', 1)[0].rsplit('.', 1)[-1]
+
+    # Local delivery
+
+    def _deliver(self, channel, message):
+        queue = self.channels.setdefault(channel, asyncio.Queue())
+        if queue.qsize() >= self.get_capacity(channel):
+            raise ChannelFull(channel)
+        queue.put_nowait((time.time() + self.expiry, message))
+
+    def _deliver_group(self, group, message):
+        for channel in list(self._shard(group).get(group, ())):
+            try:
+                # Consumers treat events as read-only, so a shallow copy each
+                # is enough to keep recipients independent
+                self._deliver(channel, dict(message))
+            except ChannelFull:
+                pass
+
+    def _shard(self, group):
+        return self.shards[zlib.crc32(group.encode()) % len(self.shards)]
+
+    def _clean_expired(self):
+        now = time.time()
+        for channel, queue in list(self.channels.items()):
+            while not queue.empty() and queue._queue[0][0] < now:
+                queue.get_nowait()
+                # Any removal prompts group discard
+                self._remove_from_groups(channel)
+                if queue.empty():
+                    del self.channels[channel]
+
+        # Group expiry, one shard per call
+        shard = self.shards[self._clean_shard]
+        self._clean_shard = (self._clean_shard + 1) % len(self.shards)
+        timeout = now - self.group_expiry
+        for group, members in list(shard.items()):
+            for channel, joined in list(members.items()):
+                if joined < timeout:
+                    del members[channel]
+                    self._forget_membership(channel, group)
+            if not members:
+                del shard[group]
+
+    def _remove_from_groups(self, channel):
+        for group in self.channel_groups.pop(channel, ()):
+            shard = self._shard(group)
+            members = shard.get(group)
+            if members is not None:
+                members.pop(channel, None)
+                if not members:
+                    del shard[group]
+
+    def _forget_membership(self, channel, group):
+        groups = self.channel_groups.get(channel)
+        if groups is not None:
+            groups.discard(group)
+            if not groups:
+                del self.channel_groups[channel]
+
+    # Channel layer API
+
+    async def new_channel(self, prefix='specific.'):
+        await self._ensure_server()
+        return f'{prefix}.{self.worker}!{secrets.token_hex(6)}'
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        await self._ensure_server()
+        worker = self._channel_worker(channel)
+        if worker is None or worker == self.worker:
+            self._deliver(channel, dict(message))
+        else:
+            await self._send_to_peer(worker, self._frame(SEND, channel, message))
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        await self._ensure_server()
+        self._clean_expired()
+        queue = self.channels.setdefault(channel, asyncio.Queue())
+        try:
+            _, message = await queue.get()
+        finally:
+            if queue.empty():
+                self.channels.pop(channel, None)
+        return message
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        self._shard(group).setdefault(group, {})[channel] = time.time()
+        self.channel_groups.setdefault(channel, set()).add(group)
+
+    async def group_discard(self, group, channel):
+        assert self.valid_channel_name(channel), 'Invalid channel name'
+        assert self.valid_group_name(group), 'Invalid group name'
+        shard = self._shard(group)
+        members = shard.get(group)
+        if members is not None:
+            members.pop(channel, None)
+            if not members:
+                del shard[group]
+        self._forget_membership(channel, group)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'Message is not a dict'
+        assert self.valid_group_name(group), 'Invalid group name'
+        await self._ensure_server()
+        self._clean_expired()
+        self._deliver_group(group, message)
+        # Encoded once, written to every other worker
+        frame = None
+        for worker in self._list_peers():
+            if frame is None:
+                frame = self._frame(GROUP_SEND, group, message)
+            await self._send_to_peer(worker, frame)
+
+    async def flush(self):
+        self.channels = {}
+        self.shards = [{} for _ in self.shards]
+        self.channel_groups = {}
+
+    async def close(self):
+        peers, self._peers = self._peers, {}
+        for writer in peers.values():
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+            writer.close()
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        try:
+            self.socket_path.unlink()
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,45 @@
+"""
+ASGI lifespan handling for the chat app.
+
+Servers that speak the lifespan protocol (uvicorn, hypercorn) send a shutdown
+event before the process exits; anything registered with ``on_shutdown`` gets
+a chance to drain in-memory state such as queued message writes.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+_startup_hooks = []
+_shutdown_hooks = []
+
+
+def on_startup(hook):
+    _startup_hooks.append(hook)
+    return hook
+
+
+def on_shutdown(hook):
+    _shutdown_hooks.append(hook)
+    return hook
+
+
+async def _run(hooks):
+    for hook in hooks:
+        try:
+            await hook()
+        except Exception:
+            logger.exception('Lifespan hook %r failed', hook)
+
+
+class LifespanApp:
+    async def __call__(self, scope, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await _run(_startup_hooks)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await _run(_shutdown_hooks)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
@@ -0,0 +1,48 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.archive import archive_cutoff, archive_room
+from chat.models import Message
+
+
+class Command(BaseCommand):
+    help = (
+        'Move messages older than CHAT_ARCHIVE_AFTER_DAYS into compressed per-room '
+        'daily archive segments'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=None,
+            help='Archive messages older than this many days (default CHAT_ARCHIVE_AFTER_DAYS)',
+        )
+        parser.add_argument('--room', type=int, action='append', help='Only archive these rooms')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be archived')
+
+    def handle(self, *args, **options):
+        days = settings.CHAT_ARCHIVE_AFTER_DAYS if options['days'] is None else options['days']
+        # Today's messages may still be in a write queue
+        if days < 1:
+            raise CommandError('--days must be at least 1')
+        cutoff = archive_cutoff(days)
+
+        old = Message.objects.filter(timestamp__lt=cutoff)
+        if options['room']:
+            old = old.filter(room_id__in=options['room'])
+        room_ids = sorted(set(old.values_list('room_id', flat=True).distinct()))
+        self.stdout.write(f'{len(room_ids)} rooms have messages from before {cutoff:%Y-%m-%d}')
+        if options['dry_run']:
+            self.stdout.write(f'{old.count()} messages would be archived')
+            return
+
+        started = time.perf_counter()
+        total = 0
+        for room_id in room_ids:
+            moved = archive_room(room_id, cutoff)
+            total += moved
+            self.stdout.write(f'  room {room_id}: {moved} messages')
+        self.stdout.write(self.style.SUCCESS(
+            f'Archived {total} messages in {time.perf_counter() - started:.2f}s'
+        ))
@@ -0,0 +1,61 @@
+import asyncio
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.consumers import ChatConsumer, messages_delivered
+from chat.protocol import chat_message_frame, encode_chat_message
+
+
+async def discard(message):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure the CPU cost of delivering one chat message to every member '
+        'of a room, with per-recipient encoding versus pre-encoded frames'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--room-sizes', type=int, nargs='+', default=[10, 100, 1000, 5000])
+        parser.add_argument('--messages', type=int, default=20, help='Messages per room size')
+        parser.add_argument('--message-length', type=int, default=200)
+
+    def handle(self, *args, **options):
+        asyncio.run(self.run(options))
+
+    async def run(self, options):
+        text = 'x' * options['message_length']
+        self.stdout.write(f"{'room size':>10} {'before us/msg':>15} {'after us/msg':>15} {'speedup':>8}")
+
+        for size in options['room_sizes']:
+            consumers = []
+            for _ in range(size):
+                consumer = ChatConsumer()
+                consumer.base_send = discard
+                consumer.delivered_counter = messages_delivered.labels('benchmark')
+                consumers.append(consumer)
+
+            before = await self.measure(consumers, options['messages'], lambda: {
+                'type': 'chat_message',
+                'message': text,
+                'username': 'benchmark',
+                'user_id': 1,
+            })
+            after = await self.measure(consumers, options['messages'], lambda: {
+                'type': 'chat_message',
+                'frames': encode_chat_message(chat_message_frame(text, 'benchmark', 1)),
+            })
+            self.stdout.write(
+                f'{size:>10} {before:>15.1f} {after:>15.1f} {before / after:>7.1f}x'
+            )
+
+    async def measure(self, consumers, messages, make_event):
+        # CPU time per message: building the event plus every recipient's handler
+        started = time.process_time()
+        for _ in range(messages):
+            event = make_event()
+            for consumer in consumers:
+                await consumer.chat_message(event)
+        return (time.process_time() - started) / messages * 1_000_000
@@ -0,0 +1,102 @@
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from chat.models import ChatRoom, Message
+from chat.pagination import keyset_before
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed messages into throwaway rooms, then print timings and query plans '
+        'for the message history access patterns'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=100_000, help='Messages to seed')
+        parser.add_argument('--rooms', type=int, default=10, help='Rooms to spread them over')
+        parser.add_argument('--users', type=int, default=20, help='Users to spread them over')
+        parser.add_argument('--page-size', type=int, default=50)
+        parser.add_argument('--repeat', type=int, default=20, help='Runs per query')
+        parser.add_argument('--keep', action='store_true', help='Keep the seeded data afterwards')
+
+    def handle(self, *args, **options):
+        rooms, users = self.seed(options)
+        try:
+            self.run_queries(rooms[0], users[0], options)
+        finally:
+            if not options['keep']:
+                ChatRoom.objects.filter(id__in=[room.id for room in rooms]).delete()
+                User.objects.filter(id__in=[user.id for user in users]).delete()
+
+    def seed(self, options):
+        rooms = [
+            ChatRoom.objects.create(name=f'bench_room_{i}', description='benchmark')
+            for i in range(options['rooms'])
+        ]
+        users = [
+            User.objects.create(username=f'bench_user_{int(time.time())}_{i}')
+            for i in range(options['users'])
+        ]
+
+        self.stdout.write(f"Seeding {options['messages']} messages ({connection.vendor})...")
+        started = time.perf_counter()
+        batch = []
+        for i in range(options['messages']):
+            batch.append(Message(
+                room_id=rooms[i % len(rooms)].id,
+                user_id=users[i % len(users)].id,
+                content=f'benchmark message {i}',
+            ))
+            if len(batch) == 5000:
+                Message.objects.bulk_create(batch)
+                batch = []
+        Message.objects.bulk_create(batch)
+        self.stdout.write(f'Seeded in {time.perf_counter() - started:.2f}s')
+
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE chat_message')
+        return rooms, users
+
+    def run_queries(self, room, user, options):
+        page_size = options['page_size']
+        history = Message.objects.filter(room=room)
+        middle = history.order_by('timestamp', 'id')[history.count() // 2]
+
+        queries = {
+            'latest page of room history': (
+                history.order_by('-timestamp', '-id')[:page_size]
+            ),
+            'page from the middle of room history': (
+                history.filter(keyset_before(middle.timestamp, middle.id))
+                .order_by('-timestamp', '-id')[:page_size]
+            ),
+            'latest messages by one user': (
+                Message.objects.filter(user=user).order_by('-timestamp')[:page_size]
+            ),
+        }
+
+        for label, queryset in queries.items():
+            timings = []
+            for _ in range(options['repeat']):
+                started = time.perf_counter()
+                list(queryset.all())
+                timings.append((time.perf_counter() - started) * 1000)
+
+            self.stdout.write(self.style.MIGRATE_HEADING(label))
+            self.stdout.write(
+                f'  median {statistics.median(timings):.2f} ms, '
+                f'max {max(timings):.2f} ms over {len(timings)} runs'
+            )
+            self.stdout.write(self.explain(queryset))
+
+    def explain(self, queryset):
+        if connection.vendor == 'postgresql':
+            plan = queryset.explain(analyze=True, buffers=True)
+        else:
+            plan = queryset.explain()
+        return '\n'.join(f'    {line}' for line in plan.splitlines())
@@ -0,0 +1,52 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.protocol import CODECS, chat_message_frame
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare the JSON and binary WebSocket codecs: encode/decode throughput '
+        'and bytes on the wire for chat message frames'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--frames', type=int, default=100_000, help='Frames per measurement')
+        parser.add_argument('--message-lengths', type=int, nargs='+', default=[20, 200, 1000])
+        parser.add_argument('--batch-size', type=int, default=20, help='Frames per batch frame')
+
+    def handle(self, *args, **options):
+        if len(CODECS) < 2:
+            raise CommandError('Only the JSON codec is available; install msgpack to compare')
+
+        self.stdout.write(
+            f"{'codec':<8} {'msg len':>8} {'bytes':>7} {'batch bytes':>12} "
+            f"{'encode/s':>12} {'decode/s':>12}"
+        )
+        for length in options['message_lengths']:
+            frame = chat_message_frame('x' * length, 'benchmark_user', 123456)
+            for name, codec in CODECS.items():
+                self.report(name, codec, frame, length, options)
+
+    def report(self, name, codec, frame, length, options):
+        count = options['frames']
+
+        started = time.perf_counter()
+        for _ in range(count):
+            payload = codec.encode_chat_message(frame)
+        encode_rate = count / (time.perf_counter() - started)
+
+        # Inbound frames only carry the message text
+        inbound = codec.encode({'message': frame['message']})
+        kwargs = {'bytes_data': inbound} if codec.binary else {'text_data': inbound}
+        started = time.perf_counter()
+        for _ in range(count):
+            codec.decode(**kwargs)
+        decode_rate = count / (time.perf_counter() - started)
+
+        batch = codec.encode_batch([payload] * options['batch_size'])
+        self.stdout.write(
+            f'{name:<8} {length:>8} {len(payload):>7} {len(batch):>12} '
+            f'{encode_rate:>12,.0f} {decode_rate:>12,.0f}'
+        )
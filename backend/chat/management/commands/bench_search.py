@@ -0,0 +1,127 @@
+import random
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from chat.benchmarks.stats import percentile
+from chat.models import ChatRoom, Message
+from chat.search import search_ids
+
+SYLLABLES = ('ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'to', 'vi', 'ze', 'po', 'qu', 'di', 'fe', 'ga', 'hu')
+
+
+def vocabulary(size, rng):
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    words = sorted(words)
+    rng.shuffle(words)
+    return words
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed messages with a Zipf-distributed vocabulary into throwaway rooms, '
+        'then time message search queries'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1_000_000, help='Messages to seed')
+        parser.add_argument('--rooms', type=int, default=50, help='Rooms to spread them over')
+        parser.add_argument('--users', type=int, default=50, help='Users to spread them over')
+        parser.add_argument('--words', type=int, default=20_000, help='Vocabulary size')
+        parser.add_argument('--page-size', type=int, default=20)
+        parser.add_argument('--repeat', type=int, default=20, help='Runs per query')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed for the generated text')
+        parser.add_argument(
+            '--baseline', action='store_true',
+            help='Also time an unindexed icontains scan for each query, once',
+        )
+        parser.add_argument('--keep', action='store_true', help='Keep the seeded data afterwards')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        words = vocabulary(options['words'], rng)
+        rooms, users = self.seed(words, rng, options)
+        try:
+            self.run_queries(words, rooms[0], options)
+        finally:
+            if not options['keep']:
+                self.stdout.write('Cleaning up...')
+                ChatRoom.objects.filter(id__in=[room.id for room in rooms]).delete()
+                User.objects.filter(id__in=[user.id for user in users]).delete()
+
+    def seed(self, words, rng, options):
+        rooms = [
+            ChatRoom.objects.create(name=f'bench_search_room_{int(time.time())}_{i}', description='benchmark')
+            for i in range(options['rooms'])
+        ]
+        users = [
+            User.objects.create(username=f'bench_search_user_{int(time.time())}_{i}')
+            for i in range(options['users'])
+        ]
+        weights = [1 / rank for rank in range(1, len(words) + 1)]
+
+        self.stdout.write(f"Seeding {options['messages']} messages ({connection.vendor})...")
+        started = time.perf_counter()
+        remaining = options['messages']
+        while remaining:
+            count = min(remaining, 10_000)
+            text = rng.choices(words, weights, k=count * 12)
+            batch = []
+            for i in range(count):
+                length = rng.randint(3, 12)
+                batch.append(Message(
+                    room_id=rooms[rng.randrange(len(rooms))].id,
+                    user_id=users[rng.randrange(len(users))].id,
+                    content=' '.join(text[i * 12:i * 12 + length]),
+                ))
+            with transaction.atomic():
+                Message.objects.bulk_create(batch)
+            remaining -= count
+        self.stdout.write(f'Seeded in {time.perf_counter() - started:.2f}s (index kept in step by the database)')
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE chat_message' if connection.vendor == 'postgresql' else 'ANALYZE')
+        return rooms, users
+
+    def run_queries(self, words, room, options):
+        page_size = options['page_size']
+        # Word frequency falls with its rank in the vocabulary
+        common, middling, rare = words[0], words[200], words[-1]
+        queries = {
+            f'most common word ({common})': (common, None, 0),
+            f'mid-frequency word ({middling})': (middling, None, 0),
+            f'rare word ({rare})': (rare, None, 0),
+            f'two words ({common} {middling})': (f'{common} {middling}', None, 0),
+            f'common word in one room ({common})': (common, room.id, 0),
+            f'fifth page of a common word ({common})': (common, None, page_size * 4),
+        }
+
+        for label, (query, room_id, offset) in queries.items():
+            timings = []
+            for _ in range(options['repeat']):
+                started = time.perf_counter()
+                search_ids(query, room_id=room_id, limit=page_size, offset=offset)
+                timings.append((time.perf_counter() - started) * 1000)
+
+            self.stdout.write(self.style.MIGRATE_HEADING(label))
+            self.stdout.write(
+                f'  median {statistics.median(timings):.2f} ms, '
+                f'p95 {percentile(sorted(timings), 0.95):.2f} ms over {len(timings)} runs'
+            )
+            if options['baseline']:
+                self.stdout.write(f'  icontains scan {self.baseline(query, room_id, offset, page_size):.2f} ms')
+
+    def baseline(self, query, room_id, offset, page_size):
+        matches = Message.objects.all()
+        for term in query.split():
+            matches = matches.filter(content__icontains=term)
+        if room_id is not None:
+            matches = matches.filter(room_id=room_id)
+        started = time.perf_counter()
+        list(matches.order_by('-timestamp', '-id').values_list('id', flat=True)[offset:offset + page_size])
+        return (time.perf_counter() - started) * 1000
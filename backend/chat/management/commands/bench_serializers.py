@@ -0,0 +1,83 @@
+import json
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from chat.models import ChatRoom, Message
+from chat.serializers import (
+    ChatRoomSerializer, MessageSerializer,
+    MESSAGE_HISTORY_FIELDS, encode_message_rows,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare MessageSerializer with the values()-based history encoder '
+        'on pages of room history'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000],
+                            help='Page sizes to encode')
+        parser.add_argument('--users', type=int, default=50, help='Distinct message authors')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per measurement')
+
+    def handle(self, *args, **options):
+        sizes = sorted(options['sizes'])
+        room = ChatRoom.objects.create(name=f'bench_serializers_{int(time.time())}')
+        users = [
+            User.objects.create(username=f'bench_serializer_user_{room.id}_{i}')
+            for i in range(options['users'])
+        ]
+        try:
+            Message.objects.bulk_create(
+                [
+                    Message(room=room, user=users[i % len(users)], content=f'benchmark message {i}')
+                    for i in range(sizes[-1])
+                ],
+                batch_size=5000,
+            )
+            for size in sizes:
+                self.stdout.write(self.style.MIGRATE_HEADING(f'{size} messages'))
+                self.report('MessageSerializer', lambda: self.serializer_page(room, size), options)
+                self.report('encode_message_rows', lambda: self.encoder_page(room, size), options)
+        finally:
+            room.delete()
+            User.objects.filter(id__in=[user.id for user in users]).delete()
+
+    def serializer_page(self, room, size):
+        # What ChatRoomViewSet.messages did before the fast read path
+        messages = room.messages.all()[:size]
+        return MessageSerializer(messages, many=True).data
+
+    def encoder_page(self, room, size):
+        rows = room.messages.values(*MESSAGE_HISTORY_FIELDS)[:size]
+        return {
+            'room': ChatRoomSerializer(room).data,
+            'results': encode_message_rows(rows),
+        }
+
+    def report(self, label, build, options):
+        timings = []
+        for _ in range(options['repeat']):
+            queries = []
+            with connection.execute_wrapper(self.count_queries(queries)):
+                started = time.perf_counter()
+                data = build()
+                payload = json.dumps(data)
+                timings.append((time.perf_counter() - started) * 1000)
+
+        self.stdout.write(
+            f'  {label:<20} median {statistics.median(timings):8.1f} ms  '
+            f'queries {len(queries):6d}  bytes {len(payload):9d}'
+        )
+
+    @staticmethod
+    def count_queries(queries):
+        def wrapper(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+        return wrapper
@@ -0,0 +1,228 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+
+from channels.layers import InMemoryChannelLayer, channel_layers
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from chat.ids import MAX_WORKER, configured_worker_base
+from chat.presence import clear_member_counts
+
+logger = logging.getLogger(__name__)
+
+PROBE_TIMEOUT = 5.0
+
+
+def probe_receiver(channel_queue, result_queue):
+    async def run():
+        layer = channel_layers.make_backend('default')
+        channel = await layer.new_channel()
+        channel_queue.put(channel)
+        try:
+            message = await asyncio.wait_for(layer.receive(channel), PROBE_TIMEOUT)
+        except asyncio.TimeoutError:
+            message = None
+        result_queue.put(message is not None and message.get('type') == 'runchat.probe')
+        await layer.close()
+    asyncio.run(run())
+
+
+class Command(BaseCommand):
+    help = (
+        'Run the ASGI application in several worker processes that share one '
+        'listening port through SO_REUSEPORT, restarting workers that crash'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='0.0.0.0')
+        parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 8000)))
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--log-level', default='info')
+        parser.add_argument('--skip-layer-check', action='store_true',
+                            help='Do not check that the channel layer works across processes')
+
+    def handle(self, *args, **options):
+        try:
+            import uvicorn
+        except ImportError:
+            raise CommandError('runchat needs uvicorn; pip install "uvicorn[standard]"')
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise CommandError('SO_REUSEPORT is not available on this platform')
+
+        workers = options['workers']
+        if workers < 1:
+            raise CommandError('--workers must be at least 1')
+
+        # Import the application once so every forked worker starts warm
+        from chat_backend.asgi import application
+
+        self.check_shared_state(workers)
+        self.check_worker_ids(workers)
+        # A single worker has no other process to reach
+        if workers > 1 and not options['skip_layer_check']:
+            self.check_channel_layer(workers)
+
+        if settings.CHAT_PRESENCE_BACKEND == 'local':
+            # No worker holds a socket yet; drop counts left by an unclean exit
+            clear_member_counts()
+
+        # Workers must not share the parent's database connections
+        connections.close_all()
+
+        self.uvicorn = uvicorn
+        self.application = application
+        self.options = options
+        self.children = {}
+        self.stopping = False
+        self.restarts = []
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        self.stdout.write(
+            f"Starting {workers} workers on {options['host']}:{options['port']} (pid {os.getpid()})"
+        )
+        for index in range(workers):
+            self.spawn(index)
+        self.supervise()
+
+    def check_shared_state(self, workers):
+        local = [
+            name for name in ('CHAT_PRESENCE_BACKEND', 'CHAT_RATE_LIMIT_BACKEND')
+            if getattr(settings, name) == 'local'
+        ]
+        if local and workers > 1:
+            raise CommandError(
+                f"{' and '.join(local)} keep state in each process, so online status, "
+                'room member counts and per-user limits would be wrong across workers; '
+                'set them to redis or run with --workers 1'
+            )
+
+    def check_worker_ids(self, workers):
+        # Each worker gets CHAT_ID_WORKER + its index as its message id worker
+        base = configured_worker_base() or 0
+        if base + workers - 1 > MAX_WORKER:
+            raise CommandError(
+                f'Workers would need message id workers {base}-{base + workers - 1}, '
+                f'past {MAX_WORKER}; lower CHAT_ID_WORKER or --workers'
+            )
+
+    def check_channel_layer(self, workers):
+        layer = channel_layers.make_backend('default')
+        if isinstance(layer, InMemoryChannelLayer) and workers > 1:
+            raise CommandError(
+                'The in-memory channel layer does not deliver across processes; '
+                'set CHANNEL_LAYER=unix or configure a broker before running '
+                'more than one worker'
+            )
+
+        context = multiprocessing.get_context('fork')
+        channel_queue = context.Queue()
+        result_queue = context.Queue()
+        process = context.Process(target=probe_receiver, args=(channel_queue, result_queue))
+        process.start()
+        try:
+            channel = channel_queue.get(timeout=PROBE_TIMEOUT)
+
+            async def send():
+                await layer.send(channel, {'type': 'runchat.probe'})
+                await layer.close()
+
+            asyncio.run(send())
+            delivered = result_queue.get(timeout=PROBE_TIMEOUT * 2)
+        except Exception as exc:
+            raise CommandError(f'Channel layer check failed: {exc!r}')
+        finally:
+            process.join(PROBE_TIMEOUT)
+            if process.is_alive():
+                process.kill()
+
+        if not delivered:
+            raise CommandError(
+                'The channel layer did not deliver a message between processes; '
+                'workers would not see each other\'s group messages'
+            )
+        self.stdout.write('Channel layer delivers across processes')
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = index
+            return
+
+        # Worker process
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            os.environ['CHAT_WORKER_ID'] = str(index)
+            self.run_worker()
+        except SystemExit as exc:
+            code = exc.code if isinstance(exc.code, int) else int(exc.code is not None)
+        except KeyboardInterrupt:
+            pass
+        except Exception:
+            logger.exception('Worker %d (pid %d) failed', index, os.getpid())
+            code = 1
+        finally:
+            # os._exit skips the usual flush of buffered output
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def run_worker(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.options['host'], self.options['port']))
+        sock.set_inheritable(True)
+
+        config = self.uvicorn.Config(
+            self.application,
+            lifespan='on',
+            log_level=self.options['log_level'],
+        )
+        self.uvicorn.Server(config).run(sockets=[sock])
+
+    def supervise(self):
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+
+            index = self.children.pop(pid, None)
+            if index is None or self.stopping:
+                continue
+
+            code = os.waitstatus_to_exitcode(status)
+            self.stderr.write(f'Worker {index} (pid {pid}) exited with {code}, restarting')
+            self.backoff()
+            if not self.stopping:
+                self.spawn(index)
+
+    def backoff(self):
+        # Back off when workers keep dying straight after starting
+        now = time.monotonic()
+        self.restarts = [started for started in self.restarts if now - started < 30] + [now]
+        time.sleep(min(0.1 * 2 ** (len(self.restarts) - 1), 5.0))
+
+    def stop(self, signum, frame):
+        if self.stopping:
+            return
+        self.stopping = True
+        self.stdout.write('Stopping workers')
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
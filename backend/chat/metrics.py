@@ -0,0 +1,179 @@
+"""
+In-process counters, gauges and histograms for the chat backend.
+
+Metrics are plain Python objects registered by name at import time, so reading
+or bumping one never touches the database or the channel layer. Updates are
+plain attribute arithmetic with no locking; a labelled metric creates its child
+for a new label combination once and hands back the same object afterwards, so
+hot paths can keep a reference to the child.
+
+``render()`` writes every metric in the Prometheus text exposition format.
+Values are per process: with several workers each one reports its own.
+"""
+
+import bisect
+import threading
+import time
+
+_registry = {}
+_lock = threading.Lock()
+
+# Seconds, from well under a millisecond up to slow database writes
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation='', labelnames=(), register=True):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._value = 0
+        self._children = {}
+        if register:
+            with _lock:
+                _registry[name] = self
+
+    @property
+    def value(self):
+        return self._value
+
+    def labels(self, *values):
+        """The child metric for one combination of label values."""
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f'{self.name} takes labels {self.labelnames}, got {values}')
+            with _lock:
+                child = self._children.setdefault(values, self._child())
+        return child
+
+    def _child(self):
+        return type(self)(self.name, self.documentation, register=False)
+
+    def _samples(self):
+        """Yield ``(suffix, labels, value)`` for every series of this metric."""
+        if not self.labelnames:
+            yield from self._own_samples(())
+            return
+        for values, child in list(self._children.items()):
+            yield from child._own_samples(tuple(zip(self.labelnames, values)))
+
+    def _own_samples(self, labels):
+        yield '', labels, self._value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1):
+        self._value += amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value):
+        self._value = value
+
+    def inc(self, amount=1):
+        self._value += amount
+
+    def dec(self, amount=1):
+        self._value -= amount
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation='', labelnames=(), buckets=DEFAULT_BUCKETS, register=True):
+        super().__init__(name, documentation, labelnames, register)
+        self.buckets = tuple(sorted(buckets))
+        # One slot per bucket plus +Inf; counts are per bucket, not cumulative
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0
+
+    @property
+    def value(self):
+        return {'count': self._value, 'sum': self._sum}
+
+    def observe(self, amount):
+        self._counts[bisect.bisect_left(self.buckets, amount)] += 1
+        self._sum += amount
+        self._value += 1
+
+    def time(self):
+        """Context manager observing the seconds spent inside it."""
+        return _Timer(self)
+
+    def _child(self):
+        return Histogram(self.name, self.documentation, buckets=self.buckets, register=False)
+
+    def _own_samples(self, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self._counts):
+            cumulative += count
+            yield '_bucket', labels + (('le', _format(bound)),), cumulative
+        yield '_bucket', labels + (('le', '+Inf'),), cumulative + self._counts[-1]
+        yield '_sum', labels, self._sum
+        yield '_count', labels, self._value
+
+
+class _Timer:
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+def snapshot():
+    """Return the current value of every registered metric keyed by name."""
+    with _lock:
+        metrics = list(_registry.values())
+    result = {}
+    for metric in metrics:
+        if metric.labelnames:
+            result[metric.name] = {
+                labels: child.value for labels, child in list(metric._children.items())
+            }
+        else:
+            result[metric.name] = metric.value
+    return result
+
+
+def _format(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _escape(value, quotes=True):
+    value = value.replace('\\', r'\\').replace('\n', r'\n')
+    return value.replace('"', r'\"') if quotes else value
+
+
+def render():
+    """Every registered metric in the Prometheus text exposition format."""
+    with _lock:
+        metrics = sorted(_registry.values(), key=lambda metric: metric.name)
+    lines = []
+    for metric in metrics:
+        if metric.documentation:
+            lines.append(f'# HELP {metric.name} {_escape(metric.documentation, quotes=False)}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for suffix, labels, value in metric._samples():
+            if labels:
+                pairs = ','.join(f'{name}="{_escape(label)}"' for name, label in labels)
+                lines.append(f'{metric.name}{suffix}{{{pairs}}} {_format(value)}')
+            else:
+                lines.append(f'{metric.name}{suffix} {_format(value)}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,61 @@
+"""
+Request metrics for the REST API.
+
+``MetricsMiddleware`` times every request that resolves to a view and counts
+the queries it runs on the default database. DRF viewsets are labelled with
+the viewset class and action (``ChatRoomViewSet``/``messages``), plain Django
+views with the function name.
+"""
+
+import time
+
+from django.db import connection
+
+from . import metrics
+
+request_seconds = metrics.Histogram(
+    'chat_api_request_seconds', 'Time spent handling API requests',
+    labelnames=('view', 'action', 'method'))
+request_queries = metrics.Histogram(
+    'chat_api_request_db_queries', 'Database queries run per API request',
+    labelnames=('view', 'action'), buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+
+
+class QueryCounter:
+    __slots__ = ('count',)
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def view_labels(view_func, method):
+    view_class = getattr(view_func, 'cls', None)
+    if view_class is None:
+        return getattr(view_func, '__name__', 'unknown'), ''
+    actions = getattr(view_func, 'actions', None) or {}
+    return view_class.__name__, actions.get(method.lower(), '')
+
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = QueryCounter()
+        started = time.perf_counter()
+        with connection.execute_wrapper(queries):
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        labels = getattr(request, 'metrics_labels', None)
+        if labels is not None:
+            request_seconds.labels(*labels, request.method).observe(elapsed)
+            request_queries.labels(*labels).observe(queries.count)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.metrics_labels = view_labels(view_func, request.method)
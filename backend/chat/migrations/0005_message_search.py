@@ -0,0 +1,88 @@
+from django.db import migrations
+
+# SQLite: an external-content FTS5 table over chat_message, kept in step with
+# it by triggers inside the writing transaction. room_id is indexed too, so a
+# room filter is part of the match, but carries no weight in the ranking.
+# Chat messages rarely repeat a word, so term positions are not stored
+# (detail=column), which keeps doclists small and quick to scan.
+#
+# Django rebuilds chat_message on SQLite for most later AlterField/AddField
+# operations on Message, and the rebuild drops these triggers.
+# chat.search.repair_sqlite_index recreates them after every migrate.
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE chat_message_fts USING fts5(
+        content,
+        room_id,
+        content='chat_message',
+        content_rowid='id',
+        tokenize='porter unicode61 remove_diacritics 2',
+        detail=column
+    )
+    """,
+    """
+    CREATE TRIGGER chat_message_fts_insert AFTER INSERT ON chat_message BEGIN
+        INSERT INTO chat_message_fts(rowid, content, room_id)
+        VALUES (new.id, new.content, new.room_id);
+    END
+    """,
+    """
+    CREATE TRIGGER chat_message_fts_delete AFTER DELETE ON chat_message BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, content, room_id)
+        VALUES ('delete', old.id, old.content, old.room_id);
+    END
+    """,
+    """
+    CREATE TRIGGER chat_message_fts_update AFTER UPDATE OF content, room_id ON chat_message BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, content, room_id)
+        VALUES ('delete', old.id, old.content, old.room_id);
+        INSERT INTO chat_message_fts(rowid, content, room_id)
+        VALUES (new.id, new.content, new.room_id);
+    END
+    """,
+    "INSERT INTO chat_message_fts(chat_message_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0)')",
+    "INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')",
+]
+
+SQLITE_BACKWARD = [
+    'DROP TRIGGER IF EXISTS chat_message_fts_update',
+    'DROP TRIGGER IF EXISTS chat_message_fts_delete',
+    'DROP TRIGGER IF EXISTS chat_message_fts_insert',
+    'DROP TABLE IF EXISTS chat_message_fts',
+]
+
+# PostgreSQL: a stored generated tsvector column, so every insert or edit
+# updates it, with a GIN index. The column is not on the model.
+POSTGRES_FORWARD = [
+    """
+    ALTER TABLE chat_message ADD COLUMN search_vector tsvector
+        GENERATED ALWAYS AS (to_tsvector('english'::regconfig, content)) STORED
+    """,
+    'CREATE INDEX chat_msg_search_idx ON chat_message USING gin (search_vector)',
+]
+
+POSTGRES_BACKWARD = [
+    'DROP INDEX IF EXISTS chat_msg_search_idx',
+    'ALTER TABLE chat_message DROP COLUMN IF EXISTS search_vector',
+]
+
+
+def run(statements):
+    def apply(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, ()):
+            schema_editor.execute(statement)
+    return apply
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_message_snowflake_ids'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRES_FORWARD}),
+            run({'sqlite': SQLITE_BACKWARD, 'postgresql': POSTGRES_BACKWARD}),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.7 on 2026-10-18 20:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_message_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('first_timestamp', models.DateTimeField()),
+                ('first_id', models.BigIntegerField()),
+                ('last_timestamp', models.DateTimeField()),
+                ('last_id', models.BigIntegerField()),
+                ('message_count', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('room', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='archives', to='chat.chatroom')),
+            ],
+            options={
+                'ordering': ['room', 'day'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='messagearchive',
+            constraint=models.UniqueConstraint(fields=('room', 'day'), name='chat_archive_room_day_uniq'),
+        ),
+    ]
@@ -0,0 +1,75 @@
+# Generated by Django 4.2.7 on 2026-10-18 20:20
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def backfill_summaries(apps, schema_editor):
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    Message = apps.get_model('chat', 'Message')
+    MessageArchive = apps.get_model('chat', 'MessageArchive')
+
+    counts = dict(Message.objects.values_list('room_id').annotate(Count('id')).order_by())
+    archived = dict(MessageArchive.objects.values_list('room_id').annotate(Sum('message_count')).order_by())
+    rooms = []
+    for room in ChatRoom.objects.only('id').iterator():
+        room.message_count = counts.get(room.id, 0) + (archived.get(room.id) or 0)
+        last = Message.objects.filter(room_id=room.id).order_by('-id').values('id', 'content', 'timestamp').first()
+        if last is not None:
+            room.last_message_id = last['id']
+            room.last_message_preview = last['content'][:140]
+            room.last_message_at = last['timestamp']
+        elif room.id in archived:
+            # Everything has been archived; the preview would mean reading the segment
+            segment = (
+                MessageArchive.objects.filter(room_id=room.id).order_by('-day')
+                .values('last_id', 'last_timestamp').first()
+            )
+            room.last_message_id = segment['last_id']
+            room.last_message_at = segment['last_timestamp']
+        rooms.append(room)
+    ChatRoom.objects.bulk_update(
+        rooms,
+        ['message_count', 'last_message_id', 'last_message_preview', 'last_message_at'],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_room_read_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_preview',
+            field=models.CharField(blank=True, max_length=140),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='member_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='message_count',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_summaries, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='chatroom',
+            index=models.Index(fields=['last_message_id', 'id'], name='chat_room_last_msg_idx'),
+        ),
+    ]
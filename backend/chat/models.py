@@ -2,30 +2,119 @@ from django.db import models
 from django.contrib.auth.models import User
 from django.utils import timezone
 
+from .ids import next_id
+
 
 class ChatRoom(models.Model):
     name = models.CharField(max_length=255)
     description = models.TextField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Summary for the room list, kept up to date by the write path and
+    # presence (see chat.summaries). Message ids are time-ordered, so the
+    # last message id orders rooms by activity; 0 means no messages yet
+    last_message_id = models.BigIntegerField(default=0)
+    last_message_preview = models.CharField(max_length=140, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    message_count = models.PositiveBigIntegerField(default=0)
+    member_count = models.PositiveIntegerField(default=0)
+    
+    SUMMARY_FIELDS = (
+        'last_message_id', 'last_message_preview', 'last_message_at',
+        'message_count', 'member_count',
+    )
+    
+    class Meta:
+        indexes = [
+            # The room list, most recently active first
+            models.Index(fields=['last_message_id', 'id'], name='chat_room_last_msg_idx'),
+        ]
     
     def __str__(self):
         return self.name
+    
+    def save(self, *args, **kwargs):
+        # Edits (API, admin) leave the summary alone: the copy loaded on this
+        # instance is stale as soon as another message lands
+        if not self._state.adding and kwargs.get('update_fields') is None and not args:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.SUMMARY_FIELDS
+            ]
+        super().save(*args, **kwargs)
 
 
 class Message(models.Model):
-    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='messages')
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # Time-ordered ids assigned in-process (see chat.ids), so a message has its
+    # id and timestamp before it is written
+    id = models.BigIntegerField(primary_key=True, default=next_id, editable=False)
+    # The composite indexes below lead with room/user, so the single-column
+    # FK indexes would only add write cost
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='messages', db_index=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
     
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            # Room history, keyset-paginated on (timestamp, id)
+            models.Index(fields=['room', 'timestamp', 'id'], name='chat_msg_room_ts_id_idx'),
+            # Per-user message lookups
+            models.Index(fields=['user', 'timestamp'], name='chat_msg_user_ts_idx'),
+            # Reconnect replay: everything in a room after a given id
+            models.Index(fields=['room', 'id'], name='chat_msg_room_id_idx'),
+        ]
     
     def __str__(self):
         return f'{self.user.username}: {self.content[:50]}'
 
 
+class MessageArchive(models.Model):
+    """One room's messages for one UTC day, moved out of ``Message`` and compressed (see chat.archive)."""
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='archives', db_index=False)
+    day = models.DateField()
+    first_timestamp = models.DateTimeField()
+    first_id = models.BigIntegerField()
+    last_timestamp = models.DateTimeField()
+    last_id = models.BigIntegerField()
+    message_count = models.PositiveIntegerField()
+    data = models.BinaryField()
+    
+    class Meta:
+        ordering = ['room', 'day']
+        constraints = [
+            # Also the index history reads walk, newest or oldest day first
+            models.UniqueConstraint(fields=['room', 'day'], name='chat_archive_room_day_uniq'),
+        ]
+    
+    def __str__(self):
+        return f'{self.room_id} {self.day} ({self.message_count} messages)'
+
+
+class RoomReadState(models.Model):
+    """How far a user has read a room, and how many messages have arrived since (see chat.unread)."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='read_states', db_index=False)
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='read_states', db_index=False)
+    # Id of the last message read; message ids are time-ordered
+    last_read_id = models.BigIntegerField(default=0)
+    unread_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        constraints = [
+            # Also the index a user's unread counts are read from
+            models.UniqueConstraint(fields=['user', 'room'], name='chat_readstate_user_room_uniq'),
+        ]
+        indexes = [
+            # The write path bumps every reader of a room
+            models.Index(fields=['room'], name='chat_readstate_room_idx'),
+        ]
+    
+    def __str__(self):
+        return f'{self.user_id} in {self.room_id}: {self.unread_count} unread'
+
+
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     avatar = models.URLField(blank=True)
@@ -0,0 +1,168 @@
+"""
+Per-connection outbound frame queues.
+
+Chat frames for a socket go through an ``OutboundQueue`` drained by a
+per-connection sender task, so a client that stops reading never blocks the
+consumer's event handling. The queue holds at most ``CHAT_OUTBOUND_QUEUE_SIZE``
+frames; once it is full ``CHAT_SLOW_CONSUMER_POLICY`` decides what happens:
+
+* ``drop_oldest`` - discard the oldest queued frame to make room.
+* ``resync``      - discard everything queued and send a single
+  ``{"type": "resync", "missed": N}`` frame so the client refetches history.
+* ``disconnect``  - close the socket with ``CLOSE_SLOW_CONSUMER``.
+
+The queue only fills when the server applies backpressure to ``send`` (for
+example uvicorn's websockets implementation awaiting the transport drain).
+
+Clients that opt in (``?batch=1`` on the socket URL) also get frames arriving
+within ``CHAT_COALESCE_WINDOW_MS`` of each other, or up to
+``CHAT_COALESCE_MAX_MESSAGES`` of them, written as a single batch frame. That
+costs one WebSocket frame and one write per window instead of one per
+message. A window holding a single frame sends it unwrapped.
+"""
+
+import asyncio
+import logging
+from collections import deque
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+POLICY_DROP_OLDEST = 'drop_oldest'
+POLICY_RESYNC = 'resync'
+POLICY_DISCONNECT = 'disconnect'
+POLICIES = (POLICY_DROP_OLDEST, POLICY_RESYNC, POLICY_DISCONNECT)
+
+# Private-use WebSocket close code sent to clients that fell too far behind
+CLOSE_SLOW_CONSUMER = 4008
+
+batches_sent = metrics.Counter(
+    'chat_outbound_batches_total', 'Coalesced frames written to sockets')
+frames_coalesced = metrics.Counter(
+    'chat_outbound_coalesced_frames_total', 'Chat frames delivered inside a batch')
+frames_queued = metrics.Gauge(
+    'chat_outbound_queued_frames', 'Frames waiting in outbound queues on this worker')
+queue_high_water = metrics.Gauge(
+    'chat_outbound_queue_high_water', 'Deepest any outbound queue has been on this worker')
+frames_dropped = metrics.Counter(
+    'chat_outbound_dropped_frames_total', 'Frames discarded because a client fell behind')
+resyncs_sent = metrics.Counter(
+    'chat_outbound_resyncs_total', 'Resync markers sent to slow clients')
+slow_disconnects = metrics.Counter(
+    'chat_outbound_slow_disconnects_total', 'Sockets closed for falling behind')
+
+
+class OutboundQueue:
+    def __init__(self, send_frame, send_batch=None, send_resync=None, disconnect=None,
+                 capacity=256, policy=POLICY_RESYNC, batch=False, window=0.01, max_messages=50):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown slow consumer policy {policy!r}, expected one of {POLICIES}')
+        self.send_frame = send_frame
+        self.send_batch = send_batch
+        self.send_resync = send_resync
+        self.disconnect = disconnect
+        self.capacity = capacity
+        self.policy = policy
+        self.batch = batch
+        self.window = window
+        self.max_messages = max_messages
+        self.high_water = 0
+        self._frames = deque()
+        self._missed = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._closed = False
+
+    def __len__(self):
+        return len(self._frames)
+
+    def push(self, frame):
+        """Queue a frame for the socket. Never waits on the client."""
+        if self._closed:
+            return
+
+        if len(self._frames) >= self.capacity:
+            if not self._overflow():
+                return
+
+        self._frames.append(frame)
+        frames_queued.inc()
+        depth = len(self._frames)
+        if depth > self.high_water:
+            self.high_water = depth
+            if depth > queue_high_water.value:
+                queue_high_water.set(depth)
+
+        self._wakeup.set()
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def _overflow(self):
+        """Apply the slow consumer policy; return True if the new frame should be queued."""
+        if self.policy == POLICY_DROP_OLDEST:
+            self._frames.popleft()
+            frames_queued.dec()
+            frames_dropped.inc()
+            return True
+
+        if self.policy == POLICY_RESYNC:
+            missed = len(self._frames) + 1
+            self._missed += missed
+            frames_queued.dec(len(self._frames))
+            frames_dropped.inc(missed)
+            self._frames.clear()
+            self._wakeup.set()
+            return False
+
+        frames_dropped.inc(len(self._frames) + 1)
+        slow_disconnects.inc()
+        self.close()
+        if self.disconnect is not None:
+            asyncio.ensure_future(self.disconnect())
+        return False
+
+    async def _run(self):
+        try:
+            while not self._closed:
+                if not self._frames and not self._missed:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+
+                if self._missed:
+                    missed, self._missed = self._missed, 0
+                    resyncs_sent.inc()
+                    await self.send_resync(missed)
+                    continue
+
+                if self.batch and len(self._frames) < self.max_messages:
+                    # Give a burst the rest of the window to arrive
+                    await asyncio.sleep(self.window)
+                    if self._closed or not self._frames:
+                        continue
+
+                count = min(len(self._frames), self.max_messages) if self.batch else 1
+                frames = [self._frames.popleft() for _ in range(count)]
+                frames_queued.dec(count)
+                if count == 1:
+                    await self.send_frame(frames[0])
+                else:
+                    await self.send_batch(frames)
+                    batches_sent.inc()
+                    frames_coalesced.inc(count)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('Outbound sender stopped')
+            self.close()
+
+    def close(self):
+        """Stop sending and drop anything not yet written."""
+        if self._closed:
+            return
+        self._closed = True
+        frames_queued.dec(len(self._frames))
+        self._frames.clear()
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
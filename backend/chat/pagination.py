@@ -0,0 +1,205 @@
+"""
+Keyset pagination for message history and the room list.
+
+Pages are addressed by opaque cursors encoding a ``(timestamp, id)`` position,
+so every page is an indexed range scan regardless of how deep into the history
+it is. Query parameters:
+
+* ``before`` - return the messages immediately older than this cursor
+* ``after``  - return the messages immediately newer than this cursor
+* ``limit``  - page size, capped at ``max_limit``
+
+The paginated queryset may yield model instances or ``.values()`` rows.
+With neither cursor the newest page is returned. Results are always in
+chronological order. The response carries a ``before`` cursor for the next
+older page (``null`` once the start of the history is reached) and an
+``after`` cursor pointing at the newest message in the page, which clients can
+use to poll for new messages.
+
+The room list (``RoomKeysetPagination``) pages the same way over
+``(last_message_id, id)``, most recently active first, with only a ``before``
+cursor for the next, less recently active page. A room that gets a message
+while a client pages moves to the front of the list, so the client sees it
+again there rather than further down.
+"""
+
+import base64
+import binascii
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+
+from .archive import archived_after, archived_before
+
+
+def _encode(key, pk):
+    raw = f'{key}|{pk}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def _decode(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    raw = base64.urlsafe_b64decode(padded.encode()).decode()
+    key, pk = raw.rsplit('|', 1)
+    return key, int(pk)
+
+
+def encode_cursor(timestamp, pk):
+    return _encode(timestamp.isoformat(), pk)
+
+
+def decode_cursor(cursor):
+    try:
+        timestamp, pk = _decode(cursor)
+        timestamp = parse_datetime(timestamp)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise NotFound('Invalid cursor')
+    if timestamp is None:
+        raise NotFound('Invalid cursor')
+    return timestamp, pk
+
+
+def encode_room_cursor(last_message_id, pk):
+    return _encode(last_message_id, pk)
+
+
+def decode_room_cursor(cursor):
+    try:
+        last_message_id, pk = _decode(cursor)
+        return int(last_message_id), pk
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise NotFound('Invalid cursor')
+
+
+def keyset_before(timestamp, pk):
+    """Rows strictly before ``(timestamp, pk)``."""
+    # The redundant timestamp bound gives the planner an index range to scan
+    return Q(timestamp__lte=timestamp) & (Q(timestamp__lt=timestamp) | Q(id__lt=pk))
+
+
+def keyset_after(timestamp, pk):
+    """Rows strictly after ``(timestamp, pk)``."""
+    return Q(timestamp__gte=timestamp) & (Q(timestamp__gt=timestamp) | Q(id__gt=pk))
+
+
+class KeysetPagination(BasePagination):
+    default_limit = 50
+    max_limit = 200
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params.get('limit', self.default_limit))
+        except (TypeError, ValueError):
+            return self.default_limit
+        return max(1, min(limit, self.max_limit))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.limit = self.get_limit(request)
+        before = request.query_params.get('before')
+        after = request.query_params.get('after')
+        self.before = decode_cursor(before) if before else None
+        self.after = decode_cursor(after) if after else None
+
+        if self.before is not None:
+            timestamp, pk = self.before
+            queryset = queryset.filter(keyset_before(timestamp, pk))
+        if self.after is not None:
+            timestamp, pk = self.after
+            queryset = queryset.filter(keyset_after(timestamp, pk))
+
+        if self.after is not None and self.before is None:
+            # Walking forwards from a cursor: oldest first
+            rows = list(queryset.order_by('timestamp', 'id')[:self.limit + 1])
+            self.page = rows[:self.limit]
+            self.has_older = True
+        else:
+            rows = list(queryset.order_by('-timestamp', '-id')[:self.limit + 1])
+            self.page = rows[:self.limit][::-1]
+            self.has_older = len(rows) > self.limit
+
+        return self.page
+
+    def get_cursor(self, item):
+        return encode_cursor(*position(item))
+
+    def get_paginated_response(self, data, **extra):
+        before = None
+        after = None
+        if self.page:
+            if self.has_older:
+                before = self.get_cursor(self.page[0])
+            after = self.get_cursor(self.page[-1])
+        elif self.after is not None:
+            after = encode_cursor(*self.after)
+
+        return Response({
+            **extra,
+            'results': data,
+            'before': before,
+            'after': after,
+        })
+
+
+def position(item):
+    if isinstance(item, dict):
+        return item['timestamp'], item['id']
+    return item.timestamp, item.id
+
+
+class ArchiveKeysetPagination(KeysetPagination):
+    """
+    ``KeysetPagination`` over one room's history that carries on into its
+    ``MessageArchive`` segments where the message table runs out. Archived
+    messages are all older than the room's hot ones, so the archive is only
+    read when a page reaches past the oldest hot message.
+    """
+
+    def __init__(self, room_id):
+        self.room_id = room_id
+
+    def paginate_queryset(self, queryset, request, view=None):
+        page = super().paginate_queryset(queryset, request, view)
+
+        if self.after is not None and self.before is None:
+            # A cursor inside the archive: its newer archived messages come first
+            archived = archived_after(self.room_id, self.after, self.limit)
+            if archived:
+                self.page = (archived + page)[:self.limit]
+        elif not self.has_older:
+            bound = position(page[0]) if page else self.before
+            archived, more = archived_before(self.room_id, bound, self.limit - len(page), after=self.after)
+            self.page = archived[::-1] + page
+            self.has_older = more
+
+        return self.page
+
+
+class RoomKeysetPagination(KeysetPagination):
+    """Pages of ``ROOM_LIST_FIELDS`` rows, most recently active first."""
+    default_limit = 100
+    max_limit = 500
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.limit = self.get_limit(request)
+        before = request.query_params.get('before')
+        if before:
+            last_message_id, pk = decode_room_cursor(before)
+            # Same shape as keyset_before, on chat_room_last_msg_idx
+            queryset = queryset.filter(
+                Q(last_message_id__lte=last_message_id)
+                & (Q(last_message_id__lt=last_message_id) | Q(id__lt=pk))
+            )
+        rows = list(queryset.order_by('-last_message_id', '-id')[:self.limit + 1])
+        self.page = rows[:self.limit]
+        self.has_older = len(rows) > self.limit
+        return self.page
+
+    def get_paginated_response(self, data):
+        before = None
+        if self.has_older:
+            last = self.page[-1]
+            before = encode_room_cursor(last['last_message_id'], last['id'])
+        return Response({'results': data, 'before': before})
@@ -0,0 +1,209 @@
+"""
+Message persistence for the chat consumers.
+
+``MessageWriter`` supports three durability modes, picked with the
+``CHAT_PERSISTENCE_MODE`` setting:
+
+* ``sync``    - every message is inserted before it is fanned out (default).
+* ``enqueue`` - messages are queued and fanned out straight away; the queue is
+  written with ``bulk_create`` once it reaches ``CHAT_WRITE_BATCH_SIZE`` rows
+  or ``CHAT_WRITE_FLUSH_INTERVAL`` seconds have passed.
+* ``flush``   - same queue, but the sender waits until the batch holding its
+  message has been committed before fanning out.
+
+Messages get their id and timestamp when they are created (see ``chat.ids``),
+so the fan-out carries both in every mode. Sockets do not flush the queue when
+they close: the interval timer is always running while messages are queued,
+so they are written within ``CHAT_WRITE_FLUSH_INTERVAL`` without a closing
+socket waiting on every room's batch, and the shutdown hook writes whatever
+is left when the worker stops.
+
+In ``sync`` and ``flush`` modes a message that could not be written makes
+``save`` raise ``MessageNotSaved``, so it is neither fanned out nor
+acknowledged. In ``enqueue`` mode it has already gone out and is only counted
+in ``chat_messages_dropped_total``.
+"""
+
+import asyncio
+import logging
+
+from django.conf import settings
+from django.db import transaction
+
+from . import metrics
+from .db import database_sync_to_async
+from .lifespan import on_shutdown
+from .models import Message
+from .summaries import record_messages
+from .unread import count_unread
+
+logger = logging.getLogger(__name__)
+
+MODE_SYNC = 'sync'
+MODE_ENQUEUE = 'enqueue'
+MODE_FLUSH = 'flush'
+MODES = (MODE_SYNC, MODE_ENQUEUE, MODE_FLUSH)
+
+queue_depth = metrics.Gauge(
+    'chat_write_queue_depth', 'Messages waiting to be written')
+messages_written = metrics.Counter(
+    'chat_messages_written_total', 'Messages inserted into the database')
+messages_dropped = metrics.Counter(
+    'chat_messages_dropped_total', 'Messages that could not be written')
+flush_seconds = metrics.Histogram(
+    'chat_write_flush_seconds', 'Time spent writing each batch of messages')
+
+
+class MessageNotSaved(Exception):
+    """A message could not be written to the database."""
+
+
+def persist_messages(messages):
+    """
+    Insert a batch of unsaved ``Message`` objects and add them to their rooms'
+    unread counts and summaries. Returns the messages written and the ones
+    that failed.
+
+    If the bulk insert fails the rows are retried one at a time so that a
+    single bad row does not take the rest of the batch down with it.
+    """
+    failed = []
+    try:
+        with transaction.atomic():
+            Message.objects.bulk_create(messages)
+            count_unread(messages)
+            record_messages(messages)
+    except Exception:
+        logger.exception('Bulk insert of %d messages failed, retrying row by row', len(messages))
+        written = []
+        for message in messages:
+            try:
+                message.save()
+            except Exception:
+                logger.exception('Dropping message from user %s', message.user_id)
+                messages_dropped.inc()
+                failed.append(message)
+            else:
+                written.append(message)
+        messages = written
+        try:
+            with transaction.atomic():
+                count_unread(messages)
+                record_messages(messages)
+        except Exception:
+            logger.exception('Failed to update unread counts and room summaries for %d messages', len(messages))
+
+    messages_written.inc(len(messages))
+    return messages, failed
+
+
+class MessageWriter:
+    def __init__(self, mode=MODE_SYNC, batch_size=100, flush_interval=0.05):
+        if mode not in MODES:
+            raise ValueError(f'Unknown persistence mode {mode!r}, expected one of {MODES}')
+        self.mode = mode
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._waiters = []
+        self._timer = None
+        self._flush_lock = None
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    async def save(self, room_id, user_id, content):
+        """Persist a chat message according to the configured mode."""
+        message = Message(room_id=room_id, user_id=user_id, content=content)
+
+        if self.mode == MODE_SYNC:
+            if await self._write([message]):
+                raise MessageNotSaved(message.id)
+            return message
+
+        loop = asyncio.get_running_loop()
+        self._pending.append(message)
+        queue_depth.set(len(self._pending))
+
+        waiter = None
+        if self.mode == MODE_FLUSH:
+            waiter = loop.create_future()
+            self._waiters.append((message.id, waiter))
+
+        if len(self._pending) >= self.batch_size:
+            self._cancel_timer()
+            asyncio.ensure_future(self.flush())
+        elif self._timer is None:
+            self._timer = loop.call_later(self.flush_interval, self._on_timer)
+
+        if waiter is not None:
+            await waiter
+        return message
+
+    async def flush(self):
+        """Write everything queued so far. Safe to call when the queue is empty."""
+        self._cancel_timer()
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+
+        # Flushes are serialised so batches land in the order they were queued
+        async with self._flush_lock:
+            pending, self._pending = self._pending, []
+            waiters, self._waiters = self._waiters, []
+            queue_depth.set(len(self._pending))
+            if not pending:
+                return
+
+            try:
+                failed = {message.id for message in await self._write(pending)}
+            except Exception:
+                logger.exception('Failed to write %d queued messages', len(pending))
+                messages_dropped.inc(len(pending))
+                failed = {message.id for message in pending}
+
+            for message_id, waiter in waiters:
+                if waiter.done():
+                    continue
+                if message_id in failed:
+                    waiter.set_exception(MessageNotSaved(message_id))
+                else:
+                    waiter.set_result(None)
+
+    async def close(self):
+        await self.flush()
+
+    async def _write(self, pending):
+        """Write ``pending``; return the messages that could not be written."""
+        with flush_seconds.time():
+            _, failed = await database_sync_to_async(persist_messages, write=True)(pending)
+        return failed
+
+    def _on_timer(self):
+        self._timer = None
+        asyncio.ensure_future(self.flush())
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+_writer = None
+
+
+def get_message_writer():
+    global _writer
+    if _writer is None:
+        _writer = MessageWriter(
+            mode=settings.CHAT_PERSISTENCE_MODE,
+            batch_size=settings.CHAT_WRITE_BATCH_SIZE,
+            flush_interval=settings.CHAT_WRITE_FLUSH_INTERVAL,
+        )
+    return _writer
+
+
+@on_shutdown
+async def _flush_on_shutdown():
+    if _writer is not None:
+        await _writer.close()
@@ -0,0 +1,299 @@
+"""
+Connection-refcounted user presence.
+
+Every open chat socket holds a reference on its user and room. A user goes
+offline only when their last socket closes, no matter how many tabs or rooms
+they had open. Online/offline transitions are collected in memory and written
+to ``UserProfile`` in bulk every ``CHAT_PRESENCE_FLUSH_INTERVAL`` seconds, so a
+reconnect storm costs a handful of UPDATEs rather than one write per socket.
+The same flush writes the live member count of every room whose sockets
+changed to ``ChatRoom.member_count``, read back from the backend so it is
+the count across workers where the backend is shared.
+
+``CHAT_PRESENCE_BACKEND`` selects where the reference counts live:
+
+* ``local`` - in this process only (default). Correct with a single worker;
+  ``runchat`` clears every room's member count before starting it, as counts
+  left by a run that did not shut down cleanly would otherwise linger until
+  the room's sockets next change.
+* ``redis`` - in Redis, shared by every worker. A worker releases its own
+  references on shutdown; references held by a worker that crashes stay
+  behind until the affected users reconnect and disconnect again.
+"""
+
+import asyncio
+import logging
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import metrics
+from .db import database_sync_to_async
+from .lifespan import on_shutdown
+from .models import ChatRoom, UserProfile
+from .shared import get_redis
+from .summaries import write_member_counts
+
+logger = logging.getLogger(__name__)
+
+online_users = metrics.Gauge(
+    'chat_presence_local_users', 'Users with at least one socket on this worker')
+presence_flushes = metrics.Counter(
+    'chat_presence_flushes_total', 'Batched presence writes to UserProfile')
+presence_updates = metrics.Counter(
+    'chat_presence_updates_total', 'User online/offline transitions written')
+member_count_updates = metrics.Counter(
+    'chat_presence_member_counts_total', 'Room member counts written')
+
+
+class LocalPresenceBackend:
+    def __init__(self):
+        self._users = Counter()
+        self._rooms = defaultdict(Counter)
+
+    async def connect(self, user_id, room_id):
+        """Add a reference; return True if the user just came online."""
+        self._rooms[room_id][user_id] += 1
+        self._users[user_id] += 1
+        return self._users[user_id] == 1
+
+    async def disconnect(self, user_id, room_id):
+        """Drop a reference; return True if the user just went offline."""
+        members = self._rooms.get(room_id)
+        if members is not None:
+            members[user_id] -= 1
+            if members[user_id] <= 0:
+                del members[user_id]
+            if not members:
+                del self._rooms[room_id]
+
+        self._users[user_id] -= 1
+        if self._users[user_id] <= 0:
+            del self._users[user_id]
+            return True
+        return False
+
+    async def is_online(self, user_id):
+        return user_id in self._users
+
+    async def room_members(self, room_id):
+        return set(self._rooms.get(room_id, ()))
+
+    async def close(self):
+        """Drop every reference; return the users that went offline."""
+        offline = set(self._users)
+        self._users.clear()
+        self._rooms.clear()
+        return offline
+
+
+class RedisPresenceBackend:
+    prefix = 'chat:presence'
+
+    def __init__(self):
+        # References held by this worker, released on shutdown
+        self._local = Counter()
+
+    def _user_key(self):
+        return f'{self.prefix}:users'
+
+    def _room_key(self, room_id):
+        return f'{self.prefix}:room:{room_id}'
+
+    async def connect(self, user_id, room_id):
+        self._local[(user_id, room_id)] += 1
+        pipe = get_redis().pipeline()
+        pipe.hincrby(self._room_key(room_id), user_id, 1)
+        pipe.hincrby(self._user_key(), user_id, 1)
+        _, user_refs = await pipe.execute()
+        return user_refs == 1
+
+    async def disconnect(self, user_id, room_id):
+        self._local[(user_id, room_id)] -= 1
+        if self._local[(user_id, room_id)] <= 0:
+            del self._local[(user_id, room_id)]
+        return await self._release(user_id, room_id, 1)
+
+    async def _release(self, user_id, room_id, count):
+        redis = get_redis()
+        pipe = redis.pipeline()
+        pipe.hincrby(self._room_key(room_id), user_id, -count)
+        pipe.hincrby(self._user_key(), user_id, -count)
+        room_refs, user_refs = await pipe.execute()
+
+        # Tidy up zero counts so membership queries stay cheap
+        if room_refs <= 0:
+            await redis.hdel(self._room_key(room_id), user_id)
+        if user_refs <= 0:
+            await redis.hdel(self._user_key(), user_id)
+            return True
+        return False
+
+    async def is_online(self, user_id):
+        refs = await get_redis().hget(self._user_key(), user_id)
+        return refs is not None and int(refs) > 0
+
+    async def room_members(self, room_id):
+        members = await get_redis().hgetall(self._room_key(room_id))
+        return {int(user_id) for user_id, refs in members.items() if int(refs) > 0}
+
+    async def close(self):
+        held, self._local = self._local, Counter()
+        offline = set()
+        for (user_id, room_id), count in held.items():
+            if await self._release(user_id, room_id, count):
+                offline.add(user_id)
+        return offline
+
+
+BACKENDS = {
+    'local': LocalPresenceBackend,
+    'redis': RedisPresenceBackend,
+}
+
+
+def write_presence(changes, now, member_counts=None):
+    """
+    Apply ``{user_id: is_online}`` to ``UserProfile`` and
+    ``{room_id: member_count}`` to ``ChatRoom``, in bulk.
+    """
+    if member_counts:
+        write_member_counts(member_counts)
+    user_ids = set(changes)
+    existing = set(
+        UserProfile.objects.filter(user_id__in=user_ids).values_list('user_id', flat=True)
+    )
+    UserProfile.objects.bulk_create(
+        [
+            UserProfile(user_id=user_id, is_online=changes[user_id], last_seen=now)
+            for user_id in user_ids - existing
+        ],
+        ignore_conflicts=True,
+    )
+
+    online = [user_id for user_id in existing if changes[user_id]]
+    offline = [user_id for user_id in existing if not changes[user_id]]
+    if online:
+        UserProfile.objects.filter(user_id__in=online).update(is_online=True, last_seen=now)
+    if offline:
+        UserProfile.objects.filter(user_id__in=offline).update(is_online=False, last_seen=now)
+
+
+class PresenceService:
+    def __init__(self, backend, flush_interval=2.0):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self._local_users = Counter()
+        self._local_rooms = Counter()
+        self._changes = {}
+        self._rooms = set()
+        self._timer = None
+        self._flush_lock = None
+
+    async def connect(self, user_id, room_id):
+        self._local_users[user_id] += 1
+        self._local_rooms[room_id] += 1
+        online_users.set(len(self._local_users))
+        if await self.backend.connect(user_id, room_id):
+            self._record(user_id, True)
+        self._touch(room_id)
+
+    async def disconnect(self, user_id, room_id):
+        self._local_users[user_id] -= 1
+        if self._local_users[user_id] <= 0:
+            del self._local_users[user_id]
+        self._local_rooms[room_id] -= 1
+        if self._local_rooms[room_id] <= 0:
+            del self._local_rooms[room_id]
+        online_users.set(len(self._local_users))
+        if await self.backend.disconnect(user_id, room_id):
+            self._record(user_id, False)
+        self._touch(room_id)
+
+    async def is_online(self, user_id):
+        return await self.backend.is_online(user_id)
+
+    async def room_members(self, room_id):
+        """Ids of the users with at least one socket open in ``room_id``."""
+        return await self.backend.room_members(room_id)
+
+    def _record(self, user_id, is_online):
+        # Only the latest state matters; a connect/disconnect pair inside one
+        # flush window collapses into a single write
+        self._changes[user_id] = is_online
+        self._schedule()
+
+    def _touch(self, room_id):
+        # The count is read back at flush time, so repeat changes cost nothing
+        self._rooms.add(room_id)
+        self._schedule()
+
+    def _schedule(self):
+        if self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(self.flush_interval, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+
+        async with self._flush_lock:
+            changes, self._changes = self._changes, {}
+            rooms, self._rooms = self._rooms, set()
+            if not changes and not rooms:
+                return
+            try:
+                member_counts = {
+                    room_id: len(await self.backend.room_members(room_id)) for room_id in rooms
+                }
+                await database_sync_to_async(write_presence, write=True)(changes, timezone.now(), member_counts)
+            except Exception:
+                logger.exception(
+                    'Failed to write presence for %d users and %d rooms', len(changes), len(rooms))
+                return
+            presence_flushes.inc()
+            presence_updates.inc(len(changes))
+            member_count_updates.inc(len(rooms))
+
+    async def close(self):
+        # Release this worker's references first so the resulting offline
+        # transitions and member counts are part of the final flush
+        for user_id in await self.backend.close():
+            self._record(user_id, False)
+        for room_id in self._local_rooms:
+            self._touch(room_id)
+        self._local_users.clear()
+        self._local_rooms.clear()
+        await self.flush()
+
+
+_presence = None
+
+
+def get_presence():
+    global _presence
+    if _presence is None:
+        _presence = PresenceService(
+            BACKENDS[settings.CHAT_PRESENCE_BACKEND](),
+            flush_interval=settings.CHAT_PRESENCE_FLUSH_INTERVAL,
+        )
+    return _presence
+
+
+def clear_member_counts():
+    """Zero every room's member count, for a server starting with no sockets."""
+    ChatRoom.objects.filter(member_count__gt=0).update(member_count=0)
+
+
+@on_shutdown
+async def _close_presence():
+    if _presence is not None:
+        await _presence.close()
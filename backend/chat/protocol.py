@@ -0,0 +1,133 @@
+"""
+Wire format of the frames sent to chat clients.
+
+JSON text frames are the default. Clients can ask for a more compact binary
+encoding by offering its subprotocol in ``Sec-WebSocket-Protocol``:
+
+* ``chat.msgpack.v1`` - MessagePack. Chat messages are sent as positional
+  arrays ``[1, message, username, user_id, id, timestamp]`` instead of maps,
+  so the keys are not repeated in every frame; other frames are MessagePack
+  maps. Requires the ``msgpack`` package.
+
+Frames for a chat message are encoded once per codec by the sender and carried
+through the channel layer already encoded, so each recipient only has to write
+them to its socket. Connections that opt into batching receive several of them
+wrapped in one batch frame, ``{"type": "batch", "messages": [...]}`` in JSON or
+``[3, [frame, ...]]`` in MessagePack.
+"""
+
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Type tags for positional binary frames
+CHAT_MESSAGE = 1
+BATCH = 3
+
+CHAT_MESSAGE_FIELDS = ('message', 'username', 'user_id', 'id', 'timestamp')
+
+
+def chat_message_frame(message, username, user_id, id=None, timestamp=None):
+    return {
+        'message': message,
+        'username': username,
+        'user_id': user_id,
+        'id': id,
+        'timestamp': timestamp,
+    }
+
+
+class JsonCodec:
+    name = 'json'
+    subprotocol = None
+    binary = False
+
+    def encode(self, frame):
+        return json.dumps(frame)
+
+    def encode_chat_message(self, frame):
+        return json.dumps(frame)
+
+    def encode_batch(self, frames):
+        """Wrap already-encoded frames in one batch frame without re-encoding them."""
+        return '{"type": "batch", "messages": [' + ', '.join(frames) + ']}'
+
+    def decode(self, text_data=None, bytes_data=None):
+        return json.loads(text_data if text_data is not None else bytes_data)
+
+    def send_kwargs(self, payload):
+        return {'text_data': payload}
+
+
+class MsgpackCodec:
+    name = 'msgpack'
+    subprotocol = 'chat.msgpack.v1'
+    binary = True
+
+    def encode(self, frame):
+        return msgpack.packb(frame)
+
+    def encode_chat_message(self, frame):
+        return msgpack.packb([CHAT_MESSAGE, *(frame[field] for field in CHAT_MESSAGE_FIELDS)])
+
+    def encode_batch(self, frames):
+        # A MessagePack array is its header followed by the encoded items, so
+        # the frames can be joined without being decoded
+        return b'\x92' + msgpack.packb(BATCH) + _array_header(len(frames)) + b''.join(frames)
+
+    def decode(self, text_data=None, bytes_data=None):
+        data = msgpack.unpackb(bytes_data if bytes_data is not None else text_data.encode())
+        if isinstance(data, list) and data and data[0] == CHAT_MESSAGE:
+            return dict(zip(CHAT_MESSAGE_FIELDS, data[1:]))
+        return data
+
+    def send_kwargs(self, payload):
+        return {'bytes_data': payload}
+
+
+def _array_header(length):
+    if length < 16:
+        return bytes([0x90 | length])
+    if length < 0x10000:
+        return b'\xdc' + struct.pack('>H', length)
+    return b'\xdd' + struct.pack('>I', length)
+
+
+DEFAULT_CODEC = JsonCodec()
+
+CODECS = {DEFAULT_CODEC.name: DEFAULT_CODEC}
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+
+
+def select_codec(scope):
+    """Pick the codec for the first subprotocol offered by the client that we speak."""
+    by_subprotocol = {codec.subprotocol: codec for codec in CODECS.values() if codec.subprotocol}
+    for subprotocol in scope.get('subprotocols', []):
+        codec = by_subprotocol.get(subprotocol)
+        if codec is not None:
+            return codec
+    return DEFAULT_CODEC
+
+
+def encode_chat_message(frame):
+    """Encode a chat message frame once for every available codec."""
+    return {name: codec.encode_chat_message(frame) for name, codec in CODECS.items()}
+
+
+def chat_message_event(entry):
+    """Group event fanning a saved message out to its room, built from its history entry."""
+    return {
+        'type': 'chat_message',
+        # Encoded once here rather than once per recipient
+        'frames': encode_chat_message(chat_message_frame(
+            entry['content'], entry['user']['username'], entry['user']['id'],
+            id=entry['id'],
+            timestamp=entry['timestamp'],
+        )),
+        'entry': entry,
+    }
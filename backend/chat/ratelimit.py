@@ -0,0 +1,150 @@
+"""
+Token-bucket rate limiting for chat messages.
+
+``ChatConsumer.receive`` checks every incoming message against a bucket for
+its sender and a bucket for its room before anything is written or fanned
+out. Buckets refill at ``rate`` tokens per second up to ``burst``; a rate of 0
+disables that limit.
+
+``CHAT_RATE_LIMIT_BACKEND`` selects where buckets live:
+
+* ``local`` - in this process (default). Each worker enforces the limits on
+  its own connections.
+* ``redis`` - in Redis, updated atomically by a Lua script, so the limits
+  hold across every worker.
+"""
+
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from . import metrics
+from .shared import get_redis
+
+checks = metrics.Counter(
+    'chat_rate_limit_checks_total', 'Messages checked against the rate limits')
+limited_user = metrics.Counter(
+    'chat_rate_limited_user_total', 'Messages rejected by the per-user limit')
+limited_room = metrics.Counter(
+    'chat_rate_limited_room_total', 'Messages rejected by the per-room limit')
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+    def take(self, rate, burst, now, cost=1):
+        """Take ``cost`` tokens; return 0 if allowed, otherwise seconds until allowed."""
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        return (cost - self.tokens) / rate
+
+
+class LocalRateLimiter:
+    def __init__(self, rate, burst, max_keys=100_000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    async def hit(self, key, cost=1):
+        if not self.rate:
+            return 0
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.burst, now)
+            # Forget the least recently used keys; a forgotten bucket is full
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket.take(self.rate, self.burst, now, cost)
+
+
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(retry_after)
+"""
+
+
+class RedisRateLimiter:
+    prefix = 'chat:ratelimit'
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+
+    async def hit(self, key, cost=1):
+        if not self.rate:
+            return 0
+        retry_after = await get_redis().eval(
+            TOKEN_BUCKET_SCRIPT, 1, f'{self.prefix}:{key}',
+            self.rate, self.burst, time.time(), cost,
+        )
+        return float(retry_after)
+
+
+BACKENDS = {
+    'local': LocalRateLimiter,
+    'redis': RedisRateLimiter,
+}
+
+
+class MessageRateLimits:
+    def __init__(self, user_limiter, room_limiter):
+        self.user_limiter = user_limiter
+        self.room_limiter = room_limiter
+
+    async def check(self, user_key, room_id):
+        """
+        Return ``(scope, retry_after)`` for a message about to be sent, where
+        ``scope`` is ``'user'`` or ``'room'`` if a limit was hit and ``None``
+        otherwise.
+        """
+        checks.inc()
+        retry_after = await self.user_limiter.hit(f'user:{user_key}')
+        if retry_after:
+            limited_user.inc()
+            return 'user', retry_after
+        retry_after = await self.room_limiter.hit(f'room:{room_id}')
+        if retry_after:
+            limited_room.inc()
+            return 'room', retry_after
+        return None, 0
+
+
+_limits = None
+
+
+def get_rate_limits():
+    global _limits
+    if _limits is None:
+        backend = BACKENDS[settings.CHAT_RATE_LIMIT_BACKEND]
+        _limits = MessageRateLimits(
+            backend(settings.CHAT_USER_MESSAGE_RATE, settings.CHAT_USER_MESSAGE_BURST),
+            backend(settings.CHAT_ROOM_MESSAGE_RATE, settings.CHAT_ROOM_MESSAGE_BURST),
+        )
+    return _limits
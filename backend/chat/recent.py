@@ -0,0 +1,197 @@
+"""
+Per-room buffers of the most recent messages, kept by each worker.
+
+Sockets opened with ``?history=1`` are sent the last ``CHAT_RECENT_MESSAGES``
+messages of their room in a ``{"type": "history", "messages": [...]}`` frame
+on connect, in the ``MessageSerializer`` shape, instead of the client fetching
+them over REST.
+
+A room's buffer is loaded from the database by the first socket to join it on
+this worker. After that it is kept current from the write path: the sender's
+worker adds each message once it is saved, and every other worker adds it when
+the fan-out event reaches one of its sockets. That only holds while the worker
+has a socket in the room, so the buffer is dropped when the last one leaves.
+Least recently used rooms are evicted past ``CHAT_RECENT_ROOMS``.
+
+Sockets reconnecting with ``?last_seen=<message id>`` are sent only what they
+missed, in a ``{"type": "replay", "messages": [...]}`` frame. The gap is read
+from the buffer when the buffer reaches back to ``last_seen``, and from the
+``(room, id)`` index otherwise. A client more than ``CHAT_RESUME_MAX_MESSAGES``
+behind gets the same ``resync`` frame as a slow consumer and refetches.
+"""
+
+import bisect
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+from . import metrics
+from .archive import archived_before
+from .db import database_sync_to_async
+from .models import Message
+from .serializers import MESSAGE_HISTORY_FIELDS, encode_message_rows
+
+history_hits = metrics.Counter(
+    'chat_history_buffer_hits_total', 'History frames served from a recent-message buffer')
+history_loads = metrics.Counter(
+    'chat_history_db_loads_total', 'History frames that had to read the database')
+replays_buffered = metrics.Counter(
+    'chat_resume_buffer_total', 'Reconnect gaps replayed from a recent-message buffer')
+replays_loaded = metrics.Counter(
+    'chat_resume_db_total', 'Reconnect gaps replayed from the database')
+replays_too_far = metrics.Counter(
+    'chat_resume_resync_total', 'Reconnects too far behind to replay')
+buffered_rooms = metrics.Gauge(
+    'chat_history_buffered_rooms', 'Rooms with a recent-message buffer on this worker')
+
+
+def load_recent(room_id, limit):
+    """The last ``limit`` messages of a room, oldest first, in the serializer shape."""
+    rows = (
+        Message.objects.filter(room_id=room_id)
+        .order_by('-timestamp', '-id')
+        .values(*MESSAGE_HISTORY_FIELDS)[:limit]
+    )
+    rows = list(rows)
+    if len(rows) < limit:
+        # The rest of the room's history may have been archived
+        bound = (rows[-1]['timestamp'], rows[-1]['id']) if rows else None
+        rows += archived_before(room_id, bound, limit - len(rows))[0]
+    return encode_message_rows(reversed(rows))
+
+
+def load_since(room_id, last_id, limit):
+    """Up to ``limit`` messages of a room after ``last_id``, oldest first."""
+    rows = (
+        Message.objects.filter(room_id=room_id, id__gt=last_id)
+        .order_by('id')
+        .values(*MESSAGE_HISTORY_FIELDS)[:limit]
+    )
+    return encode_message_rows(rows)
+
+
+class RoomBuffer:
+    __slots__ = ('entries', 'ids', 'loaded')
+
+    def __init__(self, size):
+        self.entries = deque(maxlen=size)
+        self.ids = deque(maxlen=size)
+        self.loaded = False
+
+    def add(self, entry):
+        message_id = entry['id']
+        if not self.ids or message_id > self.ids[-1]:
+            self.entries.append(entry)
+            self.ids.append(message_id)
+            return
+        # Fan-out from several workers can arrive slightly out of id order
+        index = bisect.bisect_left(self.ids, message_id)
+        if index < len(self.ids) and self.ids[index] == message_id:
+            return
+        if len(self.ids) == self.ids.maxlen:
+            if index == 0:
+                return
+            self.entries.popleft()
+            self.ids.popleft()
+            index -= 1
+        self.entries.insert(index, entry)
+        self.ids.insert(index, message_id)
+
+    def since(self, last_id):
+        """Entries after ``last_id``, or None if the buffer does not reach back that far."""
+        if not self.loaded:
+            return None
+        if not self.ids:
+            return []
+        # The buffer holds every message of the room from its oldest id on
+        if last_id < self.ids[0]:
+            return None
+        index = bisect.bisect_right(self.ids, last_id)
+        return [self.entries[i] for i in range(index, len(self.entries))]
+
+
+class RecentMessages:
+    def __init__(self, size=50, max_rooms=1000):
+        self.size = size
+        self.max_rooms = max_rooms
+        self._rooms = OrderedDict()
+        self._members = {}
+
+    def join(self, room_id):
+        """Note a socket joining; from now on fan-out for the room reaches this worker."""
+        self._members[room_id] = self._members.get(room_id, 0) + 1
+        if self.size and room_id not in self._rooms:
+            self._rooms[room_id] = RoomBuffer(self.size)
+            while len(self._rooms) > self.max_rooms:
+                self._rooms.popitem(last=False)
+            buffered_rooms.set(len(self._rooms))
+
+    def leave(self, room_id):
+        count = self._members.get(room_id, 0) - 1
+        if count > 0:
+            self._members[room_id] = count
+            return
+        self._members.pop(room_id, None)
+        if self._rooms.pop(room_id, None) is not None:
+            buffered_rooms.set(len(self._rooms))
+
+    def add(self, room_id, entry):
+        """Record a message for a room this worker is buffering; others are ignored."""
+        buffer = self._rooms.get(room_id)
+        if buffer is not None and entry is not None:
+            buffer.add(entry)
+
+    async def history(self, room_id):
+        """The room's recent messages, oldest first, loading the buffer if needed."""
+        if not self.size:
+            return []
+        buffer = self._rooms.get(room_id)
+        if buffer is None:
+            history_loads.inc()
+            return await database_sync_to_async(load_recent)(room_id, self.size)
+
+        self._rooms.move_to_end(room_id)
+        if not buffer.loaded:
+            history_loads.inc()
+            rows = await database_sync_to_async(load_recent)(room_id, self.size)
+            # Anything fanned out while the query ran is already in the buffer
+            for entry in rows:
+                buffer.add(entry)
+            buffer.loaded = True
+        else:
+            history_hits.inc()
+        return list(buffer.entries)
+
+    async def since(self, room_id, last_id, limit):
+        """
+        The room's messages after ``last_id``, oldest first, or None if more
+        than ``limit`` were missed.
+        """
+        buffer = self._rooms.get(room_id)
+        if buffer is not None:
+            self._rooms.move_to_end(room_id)
+            entries = buffer.since(last_id)
+            if entries is not None and len(entries) <= limit:
+                replays_buffered.inc()
+                return entries
+
+        # One row past the limit tells a gap that is too large apart
+        entries = await database_sync_to_async(load_since)(room_id, last_id, limit + 1)
+        if len(entries) > limit:
+            replays_too_far.inc()
+            return None
+        replays_loaded.inc()
+        return entries
+
+
+_recent = None
+
+
+def get_recent_messages():
+    global _recent
+    if _recent is None:
+        _recent = RecentMessages(
+            size=settings.CHAT_RECENT_MESSAGES,
+            max_rooms=settings.CHAT_RECENT_ROOMS,
+        )
+    return _recent
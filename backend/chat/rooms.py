@@ -0,0 +1,113 @@
+"""
+Process-wide cache of chat rooms keyed by name and by id.
+
+Consumers resolve their room once on connect through ``aresolve_room`` instead
+of querying ``ChatRoom`` for every message. Sockets may address a room by name
+or by id; a numeric path segment is taken as an id first, then as a name.
+Entries are dropped when a room is saved or deleted in this process (see
+``chat.signals``) and expire after ``CHAT_ROOM_CACHE_TTL`` seconds so that edits
+made by other workers are picked up eventually.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from django.conf import settings
+
+from .db import database_sync_to_async
+from .models import ChatRoom
+
+
+@dataclass(frozen=True)
+class RoomInfo:
+    id: int
+    name: str
+    description: str = ''
+
+
+class RoomCache:
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """The cached room for a name (str) or id (int)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            room, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return room
+
+    def put(self, room, key=None):
+        """Cache ``room`` under ``key``, its name by default."""
+        key = room.name if key is None else key
+        with self._lock:
+            self._entries[key] = (room, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, room_id=None, name=None):
+        """Drop the entry for ``name`` and any entry pointing at ``room_id``."""
+        with self._lock:
+            self._entries.pop(name, None)
+            if room_id is not None:
+                # Also a name-fallback entry cached under this id
+                self._entries.pop(room_id, None)
+                stale = [key for key, (room, _) in self._entries.items() if room.id == room_id]
+                for key in stale:
+                    del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+room_cache = RoomCache(
+    maxsize=settings.CHAT_ROOM_CACHE_SIZE,
+    ttl=settings.CHAT_ROOM_CACHE_TTL,
+)
+
+
+def _cache_key(name):
+    # Numeric segments are ids; the cache keeps them apart from names as ints
+    return int(name) if name.isdigit() else name
+
+
+def resolve_room(name):
+    """Return the ``RoomInfo`` for a room name or id, or ``None`` if there is no such room."""
+    key = _cache_key(name)
+    room = room_cache.get(key)
+    if room is not None:
+        return room
+
+    rooms = ChatRoom.objects.order_by('id').values('id', 'name', 'description')
+    row = rooms.filter(id=key).first() if isinstance(key, int) else None
+    if row is None:
+        row = rooms.filter(name=name).first()
+    if row is None:
+        return None
+
+    room = RoomInfo(**row)
+    room_cache.put(room, key)
+    return room
+
+
+async def aresolve_room(name):
+    """Async ``resolve_room`` that skips the thread hop on a cache hit."""
+    room = room_cache.get(_cache_key(name))
+    if room is not None:
+        return room
+    return await database_sync_to_async(resolve_room)(name)
@@ -0,0 +1,164 @@
+"""
+Full-text search over chat messages.
+
+The index lives in the database and is written in the same transaction as the
+message (see migration ``0005_message_search``):
+
+* SQLite     - the ``chat_message_fts`` FTS5 table, filled by triggers on
+  ``chat_message`` and ranked with ``bm25``.
+* PostgreSQL - the generated ``chat_message.search_vector`` column with a GIN
+  index, ranked with ``ts_rank_cd``.
+
+Other databases fall back to an unindexed ``icontains`` scan, newest first.
+
+Every word of the query must appear in a message; words are matched on their
+stems, so "replies" finds "reply". Query syntax characters are ignored rather
+than passed on to the database.
+
+Only the newest ``CHAT_SEARCH_MAX_CANDIDATES`` matches are ranked, so a word
+found in half of all messages costs about as much as a rarer one instead of
+scoring every message it appears in.
+
+Django's SQLite schema editor rebuilds ``chat_message`` for most later
+changes to ``Message``, which drops the triggers. ``repair_sqlite_index``
+runs after every ``migrate``, recreates any that are missing and rebuilds
+the index.
+"""
+
+import logging
+import re
+from importlib import import_module
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+
+from . import metrics
+from .models import Message
+from .serializers import MESSAGE_LIST_FIELDS
+
+logger = logging.getLogger(__name__)
+
+search_seconds = metrics.Histogram(
+    'chat_search_seconds', 'Time spent running message search queries',
+    labelnames=('backend',))
+
+# Words of at most this many characters, and this many words, are searched
+MAX_TERM_LENGTH = 64
+MAX_TERMS = 16
+
+# Letters and digits only, the same runs the FTS5 tokenizer makes single tokens of
+_term = re.compile(r'[^\W_]+')
+
+# The id of the oldest candidate: message ids are time-ordered, and FTS5 walks
+# matches in rowid order without scoring them
+SQLITE_OLDEST_CANDIDATE = """
+    SELECT rowid FROM chat_message_fts
+    WHERE chat_message_fts MATCH %s
+    ORDER BY rowid DESC
+    LIMIT 1 OFFSET %s
+"""
+
+# The triggers as migration 0005 creates them, by name
+SQLITE_TRIGGERS = {
+    re.search(r'CREATE TRIGGER (\w+)', statement).group(1): statement
+    for statement in import_module('chat.migrations.0005_message_search').SQLITE_FORWARD
+    if 'CREATE TRIGGER' in statement
+}
+
+SQLITE_SEARCH = """
+    SELECT rowid FROM chat_message_fts
+    WHERE chat_message_fts MATCH %s AND rowid >= %s
+    ORDER BY rank, rowid DESC
+    LIMIT %s OFFSET %s
+"""
+
+POSTGRES_SEARCH = """
+    SELECT id FROM (
+        SELECT id, search_vector FROM chat_message
+        WHERE search_vector @@ plainto_tsquery('english'::regconfig, %s) {room}
+        ORDER BY id DESC
+        LIMIT %s
+    ) candidates
+    ORDER BY ts_rank_cd(search_vector, plainto_tsquery('english'::regconfig, %s)) DESC, id DESC
+    LIMIT %s OFFSET %s
+"""
+
+
+def search_terms(query):
+    """The words of a user-entered query, without any search syntax."""
+    return [term[:MAX_TERM_LENGTH] for term in _term.findall(query)][:MAX_TERMS]
+
+
+def fts5_query(terms, room_id=None):
+    # Quoted, every term is a plain string to FTS5 whatever it contains
+    quoted = ['"%s"' % term.replace('"', '""') for term in terms]
+    match = 'content : (%s)' % ' '.join(quoted)
+    if room_id is not None:
+        match = f'room_id : "{int(room_id)}" AND {match}'
+    return match
+
+
+def search_ids(query, room_id=None, limit=20, offset=0):
+    """Ids of the messages matching ``query``, best match first."""
+    terms = search_terms(query)
+    if not terms:
+        return []
+
+    vendor = connection.vendor
+    candidates = settings.CHAT_SEARCH_MAX_CANDIDATES
+    with search_seconds.labels(vendor).time(), connection.cursor() as cursor:
+        if vendor == 'sqlite':
+            match = fts5_query(terms, room_id)
+            cursor.execute(SQLITE_OLDEST_CANDIDATE, [match, candidates - 1])
+            oldest = cursor.fetchone()
+            cursor.execute(SQLITE_SEARCH, [match, oldest[0] if oldest else 0, limit, offset])
+            return [row[0] for row in cursor.fetchall()]
+
+        if vendor == 'postgresql':
+            text = ' '.join(terms)
+            params = [text]
+            if room_id is not None:
+                params.append(room_id)
+            params += [candidates, text, limit, offset]
+            room = 'AND room_id = %s' if room_id is not None else ''
+            cursor.execute(POSTGRES_SEARCH.format(room=room), params)
+            return [row[0] for row in cursor.fetchall()]
+
+        matches = Message.objects.all()
+        for term in terms:
+            matches = matches.filter(content__icontains=term)
+        if room_id is not None:
+            matches = matches.filter(room_id=room_id)
+        matches = matches.order_by('-timestamp', '-id').values_list('id', flat=True)
+        return list(matches[offset:offset + limit])
+
+
+def search_messages(query, room_id=None, limit=20, offset=0):
+    """``MESSAGE_LIST_FIELDS`` rows of the messages matching ``query``, best match first."""
+    ids = search_ids(query, room_id, limit, offset)
+    rows = {row['id']: row for row in Message.objects.filter(id__in=ids).values(*MESSAGE_LIST_FIELDS)}
+    # Messages deleted since the search ran are skipped
+    return [rows[pk] for pk in ids if pk in rows]
+
+
+def repair_sqlite_index(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    """Recreate FTS5 triggers dropped by a rebuild of ``chat_message`` (a ``post_migrate`` receiver)."""
+    db = connections[using]
+    if db.vendor != 'sqlite':
+        return
+    with db.cursor() as cursor:
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger') "
+            "AND name LIKE 'chat_message_fts%'"
+        )
+        present = {row[0] for row in cursor.fetchall()}
+        if 'chat_message_fts' not in present:
+            # Migrated back past 0005
+            return
+        missing = [name for name in SQLITE_TRIGGERS if name not in present]
+        if not missing:
+            return
+        logger.warning('Recreating search triggers %s and rebuilding the search index', ', '.join(missing))
+        for name in missing:
+            cursor.execute(SQLITE_TRIGGERS[name])
+        cursor.execute("INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')")
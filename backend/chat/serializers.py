@@ -20,7 +20,15 @@ class UserProfileSerializer(serializers.ModelSerializer):
 class ChatRoomSerializer(serializers.ModelSerializer):
     class Meta:
         model = ChatRoom
-        fields = ['id', 'name', 'description', 'created_at', 'updated_at']
+        fields = [
+            'id', 'name', 'description', 'created_at', 'updated_at',
+            'last_message_id', 'last_message_preview', 'last_message_at',
+            'message_count', 'member_count',
+        ]
+        read_only_fields = [
+            'last_message_id', 'last_message_preview', 'last_message_at',
+            'message_count', 'member_count',
+        ]
 
 
 class MessageSerializer(serializers.ModelSerializer):
@@ -30,4 +38,102 @@ class MessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
         fields = ['id', 'room', 'user', 'content', 'timestamp']
-        read_only_fields = ['user', 'timestamp'] 
\ No newline at end of file
+        read_only_fields = ['user', 'timestamp']
+
+
+# Fast read path for message history. History pages are read with a single
+# ``.values()`` query joined to the user table and encoded with plain dict
+# building, skipping per-field serializer overhead. The room is sent once per
+# response instead of being nested in every message.
+
+MESSAGE_HISTORY_FIELDS = (
+    'id', 'room_id', 'content', 'timestamp',
+    'user_id', 'user__username', 'user__email', 'user__first_name', 'user__last_name',
+)
+
+MESSAGE_LIST_FIELDS = MESSAGE_HISTORY_FIELDS + (
+    'room__name', 'room__description', 'room__created_at', 'room__updated_at',
+)
+
+_datetime_field = serializers.DateTimeField()
+
+
+def encode_message_rows(rows):
+    """Encode ``MESSAGE_HISTORY_FIELDS`` rows in the ``MessageSerializer`` shape,
+    with ``room`` as an id."""
+    to_datetime = _datetime_field.to_representation
+    return [
+        {
+            'id': row['id'],
+            'room': row['room_id'],
+            'user': {
+                'id': row['user_id'],
+                'username': row['user__username'],
+                'email': row['user__email'],
+                'first_name': row['user__first_name'],
+                'last_name': row['user__last_name'],
+            },
+            'content': row['content'],
+            'timestamp': to_datetime(row['timestamp']),
+        }
+        for row in rows
+    ]
+
+
+def encode_message(message, user):
+    """Encode a ``Message`` just written by ``user`` the same way, without a query."""
+    return encode_message_rows([{
+        'id': message.id,
+        'room_id': message.room_id,
+        'content': message.content,
+        'timestamp': message.timestamp,
+        'user_id': user.id,
+        'user__username': user.username,
+        'user__email': user.email,
+        'user__first_name': user.first_name,
+        'user__last_name': user.last_name,
+    }])[0]
+
+
+ROOM_LIST_FIELDS = (
+    'id', 'name', 'description', 'created_at', 'updated_at',
+    'last_message_id', 'last_message_preview', 'last_message_at',
+    'message_count', 'member_count',
+)
+
+
+def encode_room_rows(rows):
+    """Encode ``ROOM_LIST_FIELDS`` rows in the ``ChatRoomSerializer`` shape."""
+    to_datetime = _datetime_field.to_representation
+    return [
+        {
+            'id': row['id'],
+            'name': row['name'],
+            'description': row['description'],
+            'created_at': to_datetime(row['created_at']),
+            'updated_at': to_datetime(row['updated_at']),
+            'last_message_id': row['last_message_id'],
+            'last_message_preview': row['last_message_preview'],
+            'last_message_at': to_datetime(row['last_message_at']) if row['last_message_at'] else None,
+            'message_count': row['message_count'],
+            'member_count': row['member_count'],
+        }
+        for row in rows
+    ]
+
+
+def encode_rooms_from_rows(rows):
+    """Collect the distinct rooms referenced by ``MESSAGE_LIST_FIELDS`` rows."""
+    to_datetime = _datetime_field.to_representation
+    rooms = {}
+    for row in rows:
+        room_id = row['room_id']
+        if room_id not in rooms:
+            rooms[room_id] = {
+                'id': room_id,
+                'name': row['room__name'],
+                'description': row['room__description'],
+                'created_at': to_datetime(row['room__created_at']),
+                'updated_at': to_datetime(row['room__updated_at']),
+            }
+    return list(rooms.values())
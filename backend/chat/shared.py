@@ -0,0 +1,29 @@
+"""
+Helpers for state shared between workers.
+
+Shared backends (presence, rate limits) talk to Redis through ``get_redis``.
+The ``redis`` package is only needed when one of them is enabled.
+"""
+
+import asyncio
+import weakref
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_redis():
+    """Return an asyncio Redis client bound to the running event loop."""
+    try:
+        from redis import asyncio as aioredis
+    except ImportError:
+        raise ImproperlyConfigured('The redis package is required for shared chat backends')
+
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = aioredis.from_url(settings.CHAT_REDIS_URL)
+        _clients[loop] = client
+    return client
@@ -0,0 +1,11 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import ChatRoom
+from .rooms import room_cache
+
+
+@receiver(post_save, sender=ChatRoom)
+@receiver(post_delete, sender=ChatRoom)
+def invalidate_room_cache(sender, instance, **kwargs):
+    room_cache.invalidate(room_id=instance.pk, name=instance.name)
@@ -0,0 +1,81 @@
+"""
+Room summaries for the room list.
+
+``ChatRoom`` carries its last message (id, preview, timestamp), its message
+count and its live member count, so ``GET /api/rooms/`` is one scan of the
+``(last_message_id, id)`` index, most recently active first, with no per-room
+message queries.
+
+``record_messages`` runs in the transaction that inserts a batch of messages
+and updates each room in the batch with one ``UPDATE``. The last message only
+moves forward, so batches committed out of order across workers leave the
+newest one in place. Archiving does not change a room's count. Deleting a
+message through the API decrements it and, if it was the last one, looks up
+the new last message.
+
+Member counts are written by presence (see ``chat.presence``) for the rooms
+whose sockets changed, on its batched flush.
+"""
+
+from collections import defaultdict
+
+from django.db.models import Case, F, Q, Value, When
+
+from .models import ChatRoom, Message
+
+PREVIEW_LENGTH = ChatRoom._meta.get_field('last_message_preview').max_length
+
+
+def _newer(message_id, value, current):
+    """``value`` if ``message_id`` is newer than the room's last message, else ``current``."""
+    return Case(
+        When(Q(last_message_id__lt=message_id), then=Value(value)),
+        default=F(current),
+        output_field=ChatRoom._meta.get_field(current),
+    )
+
+
+def record_messages(messages):
+    """Add a batch of newly written messages to their rooms' summaries."""
+    by_room = defaultdict(list)
+    for message in messages:
+        by_room[message.room_id].append(message)
+
+    # Same fixed order as the unread counts, so concurrent batches lock rooms alike
+    for room_id in sorted(by_room):
+        batch = by_room[room_id]
+        last = max(batch, key=lambda message: message.id)
+        ChatRoom.objects.filter(id=room_id).update(
+            message_count=F('message_count') + len(batch),
+            last_message_preview=_newer(last.id, last.content[:PREVIEW_LENGTH], 'last_message_preview'),
+            last_message_at=_newer(last.id, last.timestamp, 'last_message_at'),
+            last_message_id=_newer(last.id, last.id, 'last_message_id'),
+        )
+
+
+def forget_message(room_id, message_id):
+    """Take a deleted message out of its room's summary."""
+    ChatRoom.objects.filter(id=room_id, message_count__gt=0).update(
+        message_count=F('message_count') - 1)
+    room = ChatRoom.objects.filter(id=room_id, last_message_id=message_id)
+    if room.exists():
+        last = (
+            Message.objects.filter(room_id=room_id)
+            .order_by('-id')
+            .values('id', 'content', 'timestamp')
+            .first()
+        )
+        room.update(
+            last_message_id=last['id'] if last else 0,
+            last_message_preview=last['content'][:PREVIEW_LENGTH] if last else '',
+            last_message_at=last['timestamp'] if last else None,
+        )
+
+
+def write_member_counts(counts):
+    """Apply ``{room_id: member_count}`` to ``ChatRoom`` in bulk."""
+    ChatRoom.objects.bulk_update(
+        [ChatRoom(id=room_id, member_count=count) for room_id, count in counts.items()],
+        ['member_count'],
+        batch_size=500,
+    )
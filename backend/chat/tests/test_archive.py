@@ -0,0 +1,111 @@
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from chat.archive import archive_cutoff, archive_room, decode_segment
+from chat.models import ChatRoom, Message, MessageArchive
+from chat.pagination import encode_cursor
+
+
+class ArchiveTestCase(TestCase):
+    def setUp(self):
+        self.room = ChatRoom.objects.create(name='general')
+        self.user = User.objects.create_user('alice')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.now = timezone.now()
+
+    def add(self, days_ago, count):
+        # Spread within a day, well clear of midnight either side
+        start = self.now.replace(hour=10, minute=0) - timedelta(days=days_ago)
+        return [
+            Message.objects.create(
+                room=self.room, user=self.user, content=f'{days_ago}.{i}',
+                timestamp=start + timedelta(minutes=i))
+            for i in range(count)
+        ]
+
+    def archive(self):
+        return archive_room(self.room.id, archive_cutoff(1, now=self.now))
+
+    def page(self, **params):
+        response = self.client.get(f'/api/rooms/{self.room.id}/messages/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+
+class ArchiveRoomTests(ArchiveTestCase):
+    def test_moves_old_days_into_segments(self):
+        self.add(3, 2)
+        self.add(2, 3)
+        hot = self.add(0, 2)
+        self.assertEqual(self.archive(), 5)
+
+        self.assertEqual(set(Message.objects.values_list('id', flat=True)), {m.id for m in hot})
+        counts = list(MessageArchive.objects.order_by('day').values_list('message_count', flat=True))
+        self.assertEqual(counts, [2, 3])
+
+    def test_rearchiving_a_day_merges_into_its_segment(self):
+        first = self.add(2, 2)
+        self.archive()
+        # A row written late, after its day was archived
+        late = Message.objects.create(
+            room=self.room, user=self.user, content='late',
+            timestamp=first[0].timestamp + timedelta(seconds=30))
+        self.assertEqual(self.archive(), 1)
+
+        segment = MessageArchive.objects.get()
+        rows = decode_segment(segment.data)
+        self.assertEqual([row[0] for row in rows], [first[0].id, late.id, first[1].id])
+        self.assertEqual(segment.message_count, 3)
+        self.assertEqual((segment.first_id, segment.last_id), (first[0].id, first[1].id))
+        self.assertFalse(Message.objects.exists())
+
+
+class ArchivePaginationTests(ArchiveTestCase):
+    def setUp(self):
+        super().setUp()
+        self.messages = self.add(4, 3) + self.add(3, 2) + self.add(2, 3) + self.add(1, 2) + self.add(0, 2)
+        self.archive()
+        self.ids = [m.id for m in self.messages]
+
+    def test_walk_back_across_the_boundary(self):
+        seen = []
+        data = self.page(limit=3)
+        while True:
+            seen[:0] = [row['id'] for row in data['results']]
+            if data['before'] is None:
+                break
+            data = self.page(limit=3, before=data['before'])
+        self.assertEqual(seen, self.ids)
+
+    def test_walk_forward_across_the_boundary(self):
+        oldest = self.messages[0]
+        seen = [oldest.id]
+        data = self.page(limit=3, after=encode_cursor(oldest.timestamp, oldest.id))
+        while data['results']:
+            seen += [row['id'] for row in data['results']]
+            data = self.page(limit=3, after=data['after'])
+        self.assertEqual(seen, self.ids)
+
+    def test_after_cursor_inside_the_archive(self):
+        # The fourth day back is archived; its second message is the cursor
+        cursor = self.messages[1]
+        data = self.page(limit=4, after=encode_cursor(cursor.timestamp, cursor.id))
+        self.assertEqual([row['id'] for row in data['results']], self.ids[2:6])
+
+        # Reaching from the archive into the hot rows in one page
+        cursor = self.messages[6]
+        data = self.page(limit=4, after=encode_cursor(cursor.timestamp, cursor.id))
+        self.assertEqual([row['id'] for row in data['results']], self.ids[7:11])
+
+    def test_before_and_after_bound_a_window_in_the_archive(self):
+        first, last = self.messages[1], self.messages[6]
+        data = self.page(
+            limit=50,
+            after=encode_cursor(first.timestamp, first.id),
+            before=encode_cursor(last.timestamp, last.id))
+        self.assertEqual([row['id'] for row in data['results']], self.ids[2:6])
@@ -0,0 +1,95 @@
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core import signing
+from django.test import TestCase, TransactionTestCase, override_settings
+from rest_framework.test import APIClient
+
+from chat.auth import TOKEN_SALT, TokenAuthMiddleware, TokenCache, TokenUser, mint_token
+
+
+class WsTokenViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', 'alice@example.com', 'secret')
+        # The shipped client authenticates with the session, so CSRF applies
+        self.client = APIClient(enforce_csrf_checks=True)
+        self.client.force_login(self.user)
+        self.csrf_token = 'a' * 32
+        self.client.cookies['csrftoken'] = self.csrf_token
+
+    def test_mint_needs_the_csrf_header(self):
+        response = self.client.post('/api/users/ws_token/')
+        self.assertEqual(response.status_code, 403)
+
+    @override_settings(CHAT_WS_TOKEN_MAX_AGE=120)
+    def test_mint_with_the_csrf_header(self):
+        response = self.client.post('/api/users/ws_token/', HTTP_X_CSRFTOKEN=self.csrf_token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['expires_in'], 120)
+
+        fields = signing.loads(response.data['token'], salt=TOKEN_SALT)
+        self.assertEqual(fields, {'id': self.user.id, 'username': 'alice'})
+
+    def test_mint_needs_a_login(self):
+        response = APIClient().post('/api/users/ws_token/')
+        self.assertEqual(response.status_code, 403)
+
+
+# Transactional, as TokenUser.load_details reads from a database pool thread
+class TokenAuthMiddlewareTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('bob', 'bob@example.com', 'secret')
+        self.scopes = []
+
+        async def inner(scope, receive, send):
+            self.scopes.append(scope)
+
+        self.middleware = TokenAuthMiddleware(inner)
+        self.session_auth = mock.AsyncMock()
+        self.middleware.session_auth = self.session_auth
+        self.cache = TokenCache(max_age=60)
+        patcher = mock.patch('chat.auth.get_token_cache', return_value=self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def connect(self, query_string):
+        scope = {'type': 'websocket', 'query_string': query_string.encode()}
+        await self.middleware(scope, None, None)
+        return scope
+
+    async def test_valid_token(self):
+        await self.connect(f'token={mint_token(self.user)}')
+        self.assertFalse(self.session_auth.called)
+        user = self.scopes[0]['user']
+        self.assertIsInstance(user, TokenUser)
+        self.assertEqual((user.id, user.username), (self.user.id, 'bob'))
+        # Nothing but the id and username travels in the token
+        self.assertEqual(user.email, '')
+
+    async def test_token_user_loads_details_on_demand(self):
+        await self.connect(f'token={mint_token(self.user)}')
+        user = self.scopes[0]['user']
+        await user.load_details()
+        self.assertEqual(user.email, 'bob@example.com')
+
+    async def test_same_token_shares_a_user(self):
+        token = mint_token(self.user)
+        await self.connect(f'token={token}')
+        await self.connect(f'token={token}')
+        self.assertIs(self.scopes[0]['user'], self.scopes[1]['user'])
+
+    async def test_tampered_token_falls_back_to_session(self):
+        await self.connect(f'token={mint_token(self.user)}x')
+        self.assertTrue(self.session_auth.called)
+        self.assertEqual(self.scopes, [])
+
+    async def test_expired_token_falls_back_to_session(self):
+        token = mint_token(self.user)
+        with mock.patch('time.time', return_value=10 ** 10):
+            await self.connect(f'token={token}')
+        self.assertTrue(self.session_auth.called)
+        self.assertEqual(self.scopes, [])
+
+    async def test_no_token_uses_session(self):
+        await self.connect('')
+        self.assertTrue(self.session_auth.called)
@@ -0,0 +1,191 @@
+import asyncio
+from unittest import mock
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.test import TransactionTestCase, override_settings
+
+from chat.db import database_sync_to_async
+from chat.dedupe import AcceptedMessages
+from chat.models import ChatRoom, Message
+from chat.persistence import MODE_ENQUEUE, MODE_SYNC, MessageNotSaved, MessageWriter, persist_messages
+from chat.recent import RecentMessages
+from chat.routing import websocket_urlpatterns
+
+IN_MEMORY_LAYER = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+# Transactional, as the consumers reach the database from pool threads
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER)
+class ConsumerTestCase(TransactionTestCase):
+    def setUp(self):
+        self.room = ChatRoom.objects.create(name='general')
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.communicators = []
+        # Fresh per-worker state, as room ids are reused between tests
+        for name, value in (('get_recent_messages', RecentMessages()), ('get_accepted_messages', AcceptedMessages())):
+            patcher = mock.patch(f'chat.consumers.{name}', return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def close_all(self):
+        # Sockets must close on the event loop of the test that opened them
+        for communicator in self.communicators:
+            await communicator.disconnect()
+        self.communicators = []
+
+    async def connect(self, user, query=''):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f'/ws/chat/{self.room.id}/?{query}')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.communicators.append(communicator)
+        return communicator
+
+    async def disconnect(self, communicator):
+        self.communicators.remove(communicator)
+        await communicator.disconnect()
+
+    async def receive(self, communicator, frame_type=None):
+        """The next frame, skipping live chat frames if ``frame_type`` is given."""
+        while True:
+            frame = await communicator.receive_json_from(timeout=2)
+            if frame_type is None or frame.get('type') == frame_type:
+                return frame
+
+
+class UnsavedMessageTests(ConsumerTestCase):
+    async def test_unsaved_message_is_not_fanned_out_or_acked(self):
+        saved = Message(room_id=self.room.id, user_id=self.alice.id, content='hi')
+        writer = mock.Mock()
+        writer.save = mock.AsyncMock(side_effect=[MessageNotSaved(saved.id), saved])
+        with mock.patch('chat.consumers.get_message_writer', return_value=writer):
+            listener = await self.connect(self.bob)
+            sender = await self.connect(self.alice)
+
+            await sender.send_json_to({'message': 'hi', 'client_msg_id': 'c1'})
+            error = await self.receive(sender)
+            self.assertEqual(
+                (error['type'], error['code'], error['client_msg_id']), ('error', 'not_saved', 'c1'))
+            self.assertTrue(await sender.receive_nothing())
+            self.assertTrue(await listener.receive_nothing())
+
+            # Not remembered as accepted, so a retry under the same id is saved
+            await sender.send_json_to({'message': 'hi', 'client_msg_id': 'c1'})
+            ack = await self.receive(sender, 'ack')
+            self.assertEqual((ack['client_msg_id'], ack['id']), ('c1', saved.id))
+            live = await self.receive(listener)
+            self.assertEqual((live['id'], live['message']), (saved.id, 'hi'))
+            await self.close_all()
+        self.assertEqual(writer.save.await_count, 2)
+
+    async def test_malformed_frames_get_an_error(self):
+        sender = await self.connect(self.alice)
+        for frame in ('not json', '[1, 2]', '{"client_msg_id": "c1"}', '{"message": ""}'):
+            await sender.send_to(text_data=frame)
+            error = await self.receive(sender)
+            self.assertEqual((error['type'], error['code']), ('error', 'invalid_frame'))
+        await self.close_all()
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 0)
+
+
+class DisconnectTests(ConsumerTestCase):
+    async def test_disconnect_leaves_queued_messages_to_the_interval_flush(self):
+        writer = MessageWriter(mode=MODE_ENQUEUE, batch_size=100, flush_interval=0.3)
+        with mock.patch('chat.consumers.get_message_writer', return_value=writer):
+            sender = await self.connect(self.alice)
+            await sender.send_json_to({'message': 'bye', 'client_msg_id': 'c1'})
+            ack = await self.receive(sender, 'ack')
+            await self.disconnect(sender)
+
+            # The closing socket did not wait for the batch
+            self.assertEqual(writer.depth, 1)
+            for _ in range(50):
+                await asyncio.sleep(0.05)
+                if writer.depth == 0 and not writer._flush_lock.locked():
+                    break
+        exists = await database_sync_to_async(Message.objects.filter(id=ack['id']).exists)()
+        self.assertTrue(exists)
+
+
+class ResumeTests(ConsumerTestCase):
+    def send(self, count):
+        messages = [Message(room=self.room, user=self.alice, content=str(i)) for i in range(count)]
+        persist_messages(messages)
+        return [m.id for m in messages]
+
+    async def test_last_seen_replays_the_gap(self):
+        ids = await database_sync_to_async(self.send)(4)
+        communicator = await self.connect(self.bob, f'last_seen={ids[0]}')
+        replay = await self.receive(communicator)
+        self.assertEqual(replay['type'], 'replay')
+        self.assertEqual([m['id'] for m in replay['messages']], ids[1:])
+        await self.close_all()
+
+    async def test_replay_from_the_buffer(self):
+        listener = await self.connect(self.bob, 'history=1')
+        self.assertEqual((await self.receive(listener))['messages'], [])
+        sender = await self.connect(self.alice)
+        for i in range(3):
+            await sender.send_json_to({'message': str(i), 'client_msg_id': f'c{i}'})
+        acks = [(await self.receive(sender, 'ack'))['id'] for _ in range(3)]
+
+        # The buffer covers the gap, so the database is not asked
+        with mock.patch('chat.recent.load_since') as load_since:
+            resumed = await self.connect(self.bob, f'last_seen={acks[0]}')
+            replay = await self.receive(resumed, 'replay')
+        self.assertFalse(load_since.called)
+        self.assertEqual([m['id'] for m in replay['messages']], acks[1:])
+        await self.close_all()
+
+    @override_settings(CHAT_RESUME_MAX_MESSAGES=2)
+    async def test_too_far_behind_gets_a_resync(self):
+        ids = await database_sync_to_async(self.send)(4)
+        communicator = await self.connect(self.bob, f'last_seen={ids[0]}')
+        self.assertEqual(await self.receive(communicator), {'type': 'resync', 'missed': None})
+        await self.close_all()
+
+    @override_settings(CHAT_RESUME_MAX_MESSAGES=3)
+    async def test_gap_at_the_threshold_is_replayed(self):
+        ids = await database_sync_to_async(self.send)(4)
+        communicator = await self.connect(self.bob, f'last_seen={ids[0]}')
+        replay = await self.receive(communicator)
+        self.assertEqual((replay['type'], len(replay['messages'])), ('replay', 3))
+        await self.close_all()
+
+
+class DuplicateMessageTests(ConsumerTestCase):
+    async def test_retry_is_acked_again_without_a_second_save(self):
+        writer = MessageWriter(mode=MODE_SYNC)
+        with mock.patch('chat.consumers.get_message_writer', return_value=writer):
+            listener = await self.connect(self.bob)
+            sender = await self.connect(self.alice)
+
+            await sender.send_json_to({'message': 'hi', 'client_msg_id': 'c1'})
+            first = await self.receive(sender, 'ack')
+            live = await self.receive(listener)
+            self.assertEqual(live['id'], first['id'])
+
+            await sender.send_json_to({'message': 'hi', 'client_msg_id': 'c1'})
+            second = await self.receive(sender, 'ack')
+            self.assertEqual(second, first)
+            self.assertTrue(await listener.receive_nothing())
+            self.assertTrue(await sender.receive_nothing())
+            await self.close_all()
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 1)
+
+    async def test_same_tag_from_another_user_is_a_new_message(self):
+        writer = MessageWriter(mode=MODE_SYNC)
+        with mock.patch('chat.consumers.get_message_writer', return_value=writer):
+            alice = await self.connect(self.alice)
+            bob = await self.connect(self.bob)
+            await alice.send_json_to({'message': 'hi', 'client_msg_id': 'c1'})
+            await bob.send_json_to({'message': 'hi', 'client_msg_id': 'c1'})
+            first = await self.receive(alice, 'ack')
+            second = await self.receive(bob, 'ack')
+            self.assertNotEqual(first['id'], second['id'])
+            await self.close_all()
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 2)
@@ -0,0 +1,64 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from chat.ids import (
+    EPOCH, EPOCH_MS, MAX_SEQUENCE, MAX_WORKER, SEQUENCE_BITS, TIMESTAMP_SHIFT, IdGenerator, id_datetime,
+)
+
+
+def at(ms):
+    """Patch the clock to ``ms`` milliseconds after the id epoch."""
+    return mock.patch('chat.ids.time.time_ns', return_value=(EPOCH_MS + ms) * 1_000_000)
+
+
+class IdGeneratorTests(SimpleTestCase):
+    def test_ids_increase(self):
+        generate = IdGenerator(3)
+        ids = [generate() for _ in range(1000)]
+        self.assertEqual(ids, sorted(set(ids)))
+
+    def test_fields(self):
+        with at(1234):
+            message_id = IdGenerator(5)()
+        self.assertEqual(message_id >> TIMESTAMP_SHIFT, 1234)
+        self.assertEqual((message_id >> SEQUENCE_BITS) & MAX_WORKER, 5)
+        self.assertEqual(message_id & MAX_SEQUENCE, 0)
+        self.assertEqual(id_datetime(message_id), EPOCH + timedelta(milliseconds=1234))
+
+    def test_sequence_overflow_borrows_the_next_millisecond(self):
+        generate = IdGenerator(5)
+        with at(1000):
+            ids = [generate() for _ in range(MAX_SEQUENCE + 3)]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual([i >> TIMESTAMP_SHIFT for i in ids[MAX_SEQUENCE - 1:]], [1000, 1000, 1001, 1001])
+        self.assertEqual(ids[MAX_SEQUENCE + 1] & MAX_SEQUENCE, 0)
+
+        # The clock catching up to the borrowed millisecond does not reuse it
+        with at(1001):
+            after = generate()
+        self.assertGreater(after, ids[-1])
+        self.assertEqual(after >> TIMESTAMP_SHIFT, 1001)
+
+    def test_clock_going_backwards(self):
+        generate = IdGenerator(5)
+        with at(5000):
+            first = generate()
+        with at(4000):
+            second = generate()
+        self.assertGreater(second, first)
+        self.assertEqual(second >> TIMESTAMP_SHIFT, 5000)
+
+    def test_ids_fit_in_53_bits(self):
+        # The last millisecond the 41-bit field holds, with every other bit set
+        generate = IdGenerator(MAX_WORKER)
+        with at((1 << 41) - 1):
+            ids = [generate() for _ in range(MAX_SEQUENCE + 1)]
+        self.assertEqual(ids[-1], 2 ** 53 - 1)
+        self.assertTrue(all(i < 2 ** 53 for i in ids))
+
+    def test_worker_out_of_range(self):
+        for worker in (-1, MAX_WORKER + 1):
+            with self.assertRaises(ValueError):
+                IdGenerator(worker)
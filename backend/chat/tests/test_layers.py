@@ -0,0 +1,118 @@
+import asyncio
+import os
+import stat
+import tempfile
+import time
+from pathlib import Path
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from chat.layers import UnixSocketChannelLayer
+
+
+class UnixSocketChannelLayerTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = Path(directory.name) / 'layer'
+        self.layers = []
+
+    def layer(self, **kwargs):
+        # Every call looks for new workers, so a second layer is seen at once
+        layer = UnixSocketChannelLayer(path=self.path, peer_refresh=0, **kwargs)
+        self.layers.append(layer)
+        return layer
+
+    async def close_all(self):
+        # Servers must close on the event loop of the test that started them
+        for layer in self.layers:
+            await layer.close()
+
+    async def receive(self, layer, channel):
+        return await asyncio.wait_for(layer.receive(channel), 2)
+
+    async def assertNothing(self, layer, channel):
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(layer.receive(channel), 0.2)
+
+    async def test_send_to_a_channel_on_another_worker(self):
+        first, second = self.layer(), self.layer()
+        channel = await second.new_channel()
+        await first.new_channel()
+        await first.send(channel, {'type': 'hello'})
+        self.assertEqual(await self.receive(second, channel), {'type': 'hello'})
+        await self.close_all()
+
+    async def test_group_send_reaches_both_workers(self):
+        first, second = self.layer(), self.layer()
+        first_channel = await first.new_channel()
+        second_channel = await second.new_channel()
+        await first.group_add('room', first_channel)
+        await second.group_add('room', second_channel)
+
+        await first.group_send('room', {'type': 'chat', 'text': 'hi'})
+        self.assertEqual(await self.receive(first, first_channel), {'type': 'chat', 'text': 'hi'})
+        self.assertEqual(await self.receive(second, second_channel), {'type': 'chat', 'text': 'hi'})
+
+        await second.group_send('room', {'type': 'chat', 'text': 'back'})
+        self.assertEqual((await self.receive(first, first_channel))['text'], 'back')
+        self.assertEqual((await self.receive(second, second_channel))['text'], 'back')
+        await self.close_all()
+
+    async def test_group_discard(self):
+        first, second = self.layer(), self.layer()
+        first_channel = await first.new_channel()
+        second_channel = await second.new_channel()
+        await first.group_add('room', first_channel)
+        await second.group_add('room', second_channel)
+        await second.group_add('other', second_channel)
+
+        await second.group_discard('room', second_channel)
+        self.assertEqual(second.channel_groups, {second_channel: {'other'}})
+        await first.group_send('room', {'type': 'chat'})
+        self.assertEqual(await self.receive(first, first_channel), {'type': 'chat'})
+        await self.assertNothing(second, second_channel)
+
+        await second.group_discard('other', second_channel)
+        self.assertEqual(second.channel_groups, {})
+        self.assertFalse(any(second.shards))
+        await self.close_all()
+
+    async def test_expired_channel_leaves_its_groups(self):
+        layer = self.layer(expiry=10)
+        channel = await layer.new_channel()
+        listener = await layer.new_channel()
+        await layer.group_add('room', channel)
+        await layer.group_add('lobby', channel)
+        await layer.group_add('room', listener)
+        # Nobody reads from channel, so the message sits in its queue
+        await layer.send(channel, {'type': 'unread'})
+
+        with mock.patch('chat.layers.time.time', return_value=time.time() + 60):
+            await layer.group_send('room', {'type': 'chat'})
+        self.assertNotIn(channel, layer.channel_groups)
+        self.assertEqual(layer.channel_groups, {listener: {'room'}})
+        self.assertNotIn('lobby', layer._shard('lobby'))
+        self.assertEqual(set(layer._shard('room')['room']), {listener})
+        await self.close_all()
+
+    async def test_group_expiry_updates_the_reverse_index(self):
+        layer = self.layer(group_expiry=30, shards=1)
+        channel = await layer.new_channel()
+        await layer.group_add('room', channel)
+        with mock.patch('chat.layers.time.time', return_value=time.time() + 60):
+            await layer.group_send('room', {'type': 'chat'})
+        self.assertEqual(layer.channel_groups, {})
+        self.assertEqual(layer.shards, [{}])
+        await self.close_all()
+
+    async def test_socket_directory_is_private(self):
+        self.path.mkdir(mode=0o755)
+        os.chmod(self.path, 0o755)
+        layer = self.layer()
+        await layer.new_channel()
+        self.assertEqual(stat.S_IMODE(self.path.stat().st_mode), 0o700)
+        self.assertEqual(stat.S_IMODE(layer.socket_path.stat().st_mode), 0o600)
+        await self.close_all()
+        self.assertFalse(layer.socket_path.exists())
@@ -0,0 +1,136 @@
+import asyncio
+
+from django.contrib.auth.models import User
+from django.test import TransactionTestCase
+
+from chat.db import database_sync_to_async
+from chat.models import ChatRoom, Message
+from chat.persistence import (
+    MODE_ENQUEUE, MODE_FLUSH, MODE_SYNC, MessageNotSaved, MessageWriter, persist_messages,
+)
+
+
+@database_sync_to_async
+def written(*messages):
+    return set(Message.objects.filter(id__in=[m.id for m in messages]).values_list('id', flat=True))
+
+
+# Transactional, as the writer runs on the database pool's threads
+class PersistMessagesTests(TransactionTestCase):
+    def setUp(self):
+        self.room = ChatRoom.objects.create(name='general')
+        self.user = User.objects.create_user('alice')
+
+    def test_batch(self):
+        messages = [Message(room=self.room, user=self.user, content=str(i)) for i in range(3)]
+        saved, failed = persist_messages(messages)
+        self.assertEqual((len(saved), failed), (3, []))
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.message_count, 3)
+        self.assertEqual(self.room.last_message_id, messages[-1].id)
+
+    def test_bad_row_fails_alone(self):
+        good = Message(room=self.room, user=self.user, content='good')
+        bad = Message(room=self.room, user=self.user, content=None)
+        with self.assertLogs('chat.persistence', 'ERROR'):
+            saved, failed = persist_messages([good, bad])
+        self.assertEqual(saved, [good])
+        self.assertEqual(failed, [bad])
+        self.assertEqual(list(Message.objects.values_list('id', flat=True)), [good.id])
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.message_count, 1)
+
+
+class MessageWriterTests(TransactionTestCase):
+    def setUp(self):
+        self.room = ChatRoom.objects.create(name='general')
+        self.user = User.objects.create_user('alice')
+
+    def save(self, writer, content='hello'):
+        return writer.save(self.room.id, self.user.id, content)
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            MessageWriter(mode='later')
+
+    async def test_sync_writes_before_returning(self):
+        writer = MessageWriter(mode=MODE_SYNC)
+        message = await self.save(writer)
+        self.assertEqual(await written(message), {message.id})
+        self.assertEqual(writer.depth, 0)
+
+    async def test_sync_failed_row_raises(self):
+        writer = MessageWriter(mode=MODE_SYNC)
+        with self.assertLogs('chat.persistence', 'ERROR'), self.assertRaises(MessageNotSaved):
+            await self.save(writer, content=None)
+
+    async def test_enqueue_returns_before_writing(self):
+        writer = MessageWriter(mode=MODE_ENQUEUE, batch_size=10, flush_interval=60)
+        message = await self.save(writer)
+        self.assertEqual(writer.depth, 1)
+        self.assertEqual(await written(message), set())
+        await writer.close()
+        self.assertEqual(await written(message), {message.id})
+
+    async def test_enqueue_flushes_at_batch_size(self):
+        writer = MessageWriter(mode=MODE_ENQUEUE, batch_size=3, flush_interval=60)
+        messages = [await self.save(writer, str(i)) for i in range(3)]
+        # The full batch is flushed in the background rather than by the sender
+        self.assertEqual(writer.depth, 3)
+        await asyncio.sleep(0)
+        async with writer._flush_lock:
+            pass
+        self.assertEqual(writer.depth, 0)
+        self.assertEqual(await written(*messages), {m.id for m in messages})
+
+    async def test_enqueue_flushes_after_interval(self):
+        writer = MessageWriter(mode=MODE_ENQUEUE, batch_size=100, flush_interval=0.05)
+        messages = [await self.save(writer, str(i)) for i in range(2)]
+        self.assertEqual(await written(*messages), set())
+        for _ in range(50):
+            await asyncio.sleep(0.02)
+            if writer.depth == 0 and not writer._flush_lock.locked():
+                break
+        self.assertEqual(await written(*messages), {m.id for m in messages})
+
+    async def test_enqueue_failed_row_is_dropped(self):
+        writer = MessageWriter(mode=MODE_ENQUEUE, batch_size=100, flush_interval=60)
+        good = await self.save(writer)
+        # Already fanned out, so all the sender gets back is the message
+        bad = await self.save(writer, content=None)
+        with self.assertLogs('chat.persistence', 'ERROR'):
+            await writer.close()
+        self.assertEqual(await written(good, bad), {good.id})
+
+    async def test_flush_waits_for_the_batch(self):
+        writer = MessageWriter(mode=MODE_FLUSH, batch_size=2, flush_interval=60)
+        first = asyncio.ensure_future(self.save(writer, 'one'))
+        await asyncio.sleep(0)
+        self.assertFalse(first.done())
+        # Filling the batch writes it, releasing both senders
+        second = await self.save(writer, 'two')
+        first = await first
+        self.assertEqual(await written(first, second), {first.id, second.id})
+
+    async def test_flush_interval_releases_a_lone_sender(self):
+        writer = MessageWriter(mode=MODE_FLUSH, batch_size=100, flush_interval=0.05)
+        message = await asyncio.wait_for(self.save(writer), 5)
+        self.assertEqual(await written(message), {message.id})
+
+    async def test_flush_failed_row_raises_only_for_its_sender(self):
+        writer = MessageWriter(mode=MODE_FLUSH, batch_size=2, flush_interval=60)
+        bad = asyncio.ensure_future(self.save(writer, content=None))
+        await asyncio.sleep(0)
+        with self.assertLogs('chat.persistence', 'ERROR'):
+            good = await self.save(writer, 'good')
+        with self.assertRaises(MessageNotSaved):
+            await bad
+        self.assertEqual(await written(good), {good.id})
+
+    async def test_close_writes_everything_queued(self):
+        # What the lifespan shutdown hook runs before the worker exits
+        writer = MessageWriter(mode=MODE_ENQUEUE, batch_size=100, flush_interval=60)
+        messages = [await self.save(writer, str(i)) for i in range(5)]
+        await writer.close()
+        self.assertEqual(writer.depth, 0)
+        self.assertEqual(await written(*messages), {m.id for m in messages})
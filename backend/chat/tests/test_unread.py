@@ -0,0 +1,107 @@
+from django.contrib.auth.models import User
+from django.test import TestCase
+from rest_framework.test import APIClient
+
+from chat.models import ChatRoom, Message, RoomReadState
+from chat.persistence import persist_messages
+from chat.unread import mark_read, unread_counts
+
+
+class UnreadCountTests(TestCase):
+    def setUp(self):
+        self.room = ChatRoom.objects.create(name='general')
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+
+    def send(self, user, count=1):
+        messages = [Message(room=self.room, user=user, content=f'{user} {i}') for i in range(count)]
+        persist_messages(messages)
+        return messages
+
+    def unread(self, user):
+        return RoomReadState.objects.get(user=user, room=self.room).unread_count
+
+    def test_rooms_never_read_are_not_counted(self):
+        self.send(self.alice, 3)
+        self.assertEqual(unread_counts(self.bob.id), [])
+
+    def test_counts_messages_after_mark_read(self):
+        mark_read(self.bob.id, self.room.id)
+        self.send(self.alice, 3)
+        self.assertEqual(self.unread(self.bob), 3)
+
+    def test_sender_is_excluded(self):
+        mark_read(self.alice.id, self.room.id)
+        mark_read(self.bob.id, self.room.id)
+        persist_messages([
+            Message(room=self.room, user=self.alice, content='one'),
+            Message(room=self.room, user=self.bob, content='two'),
+            Message(room=self.room, user=self.alice, content='three'),
+        ])
+        self.assertEqual(self.unread(self.alice), 1)
+        self.assertEqual(self.unread(self.bob), 2)
+
+    def test_mark_read_resets_to_newest(self):
+        mark_read(self.bob.id, self.room.id)
+        messages = self.send(self.alice, 4)
+        state = mark_read(self.bob.id, self.room.id)
+        self.assertEqual(state.last_read_id, messages[-1].id)
+        self.assertEqual(state.unread_count, 0)
+
+    def test_watermark_only_moves_forward(self):
+        mark_read(self.bob.id, self.room.id)
+        messages = self.send(self.alice, 4)
+        mark_read(self.bob.id, self.room.id, messages[2].id)
+        state = mark_read(self.bob.id, self.room.id, messages[0].id)
+        self.assertEqual(state.last_read_id, messages[2].id)
+        self.assertEqual(state.unread_count, 1)
+
+    def test_mark_read_part_way_recounts_the_tail(self):
+        mark_read(self.bob.id, self.room.id)
+        first = self.send(self.alice, 2)
+        self.send(self.bob)
+        self.send(self.alice, 3)
+        state = mark_read(self.bob.id, self.room.id, first[0].id)
+        # One of alice's first two and her last three; bob's own is left out
+        self.assertEqual(state.unread_count, 4)
+
+    def test_late_row_below_watermark_is_not_counted(self):
+        # Ids are assigned up front, so a queued message can be written
+        # after a reader has marked a newer one read
+        late = Message(room=self.room, user=self.alice, content='late')
+        self.send(self.alice)
+        mark_read(self.bob.id, self.room.id)
+        persist_messages([late])
+        self.assertEqual(self.unread(self.bob), 0)
+
+    def test_batch_straddling_watermark_counts_only_past_it(self):
+        older = Message(room=self.room, user=self.alice, content='older')
+        middle = Message(room=self.room, user=self.alice, content='middle')
+        newer = Message(room=self.room, user=self.alice, content='newer')
+        persist_messages([middle])
+        mark_read(self.bob.id, self.room.id)
+        persist_messages([older, newer])
+        self.assertEqual(self.unread(self.bob), 1)
+
+
+class UnreadViewTests(TestCase):
+    def setUp(self):
+        self.room = ChatRoom.objects.create(name='general')
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.client = APIClient()
+        self.client.force_authenticate(self.bob)
+
+    def test_read_then_unread(self):
+        response = self.client.post(f'/api/rooms/{self.room.id}/read/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['unread'], 0)
+
+        persist_messages([Message(room=self.room, user=self.alice, content=str(i)) for i in range(2)])
+        response = self.client.get('/api/rooms/unread/')
+        self.assertEqual(response.data['total'], 2)
+        self.assertEqual(response.data['rooms'][0]['room'], self.room.id)
+
+    def test_read_rejects_a_bad_message_id(self):
+        response = self.client.post(f'/api/rooms/{self.room.id}/read/', {'message_id': 'x'})
+        self.assertEqual(response.status_code, 400)
@@ -0,0 +1,98 @@
+"""
+Unread message counts per user and room.
+
+A user's ``RoomReadState`` for a room holds the id of the last message they
+read and the number of messages that have arrived since. The count is kept up
+to date on the write path rather than counted on read: ``count_unread`` runs in
+the transaction that inserts a batch of messages and bumps the count of every
+reader of each room in the batch with one ``UPDATE`` per room, leaving out a
+sender's own messages. Reading all of a user's counts is then one index range
+over their read states.
+
+A read state is created the first time the user marks the room read
+(``POST /api/rooms/{id}/read/``); rooms a user has never opened are not
+counted. Marking a room read moves the watermark forward only, to the given
+message or to the newest one, and resets the count to what is left after it.
+
+Message ids are assigned before the row is written, so with write-behind
+persistence a message can be inserted after a reader's watermark has already
+moved past it. ``count_unread`` only counts a message for readers whose
+``last_read_id`` is below it, so such late rows are treated as read rather
+than inflating the count.
+"""
+
+from collections import Counter, defaultdict
+
+from django.db import models, transaction
+from django.db.models import Case, F, Value, When
+
+from . import metrics
+from .models import Message, RoomReadState
+
+unread_updates = metrics.Counter(
+    'chat_unread_updates_total', 'Rooms whose read states were bumped by the write path')
+
+
+def count_unread(messages):
+    """Add a batch of newly written messages to the unread counts of their rooms' readers."""
+    by_room = defaultdict(list)
+    for message in messages:
+        by_room[message.room_id].append(message)
+
+    # Rooms in a fixed order, so concurrent batches lock read states in the same order
+    for room_id in sorted(by_room):
+        batch = by_room[room_id]
+        first = min(message.id for message in batch)
+        senders = Counter(message.user_id for message in batch)
+        increment = Case(
+            *(When(user_id=user_id, then=Value(len(batch) - own)) for user_id, own in senders.items()),
+            default=Value(len(batch)),
+            output_field=models.PositiveIntegerField(),
+        )
+        states = RoomReadState.objects.filter(room_id=room_id)
+        states.filter(last_read_id__lt=first).update(unread_count=F('unread_count') + increment)
+
+        # Readers who already marked part of the batch read count only what is past their mark
+        behind = states.filter(last_read_id__gte=first).select_for_update()
+        for state_id, user_id, last_read_id in behind.values_list('id', 'user_id', 'last_read_id'):
+            unread = sum(1 for message in batch if message.id > last_read_id and message.user_id != user_id)
+            if unread:
+                RoomReadState.objects.filter(id=state_id).update(unread_count=F('unread_count') + unread)
+    unread_updates.inc(len(by_room))
+
+
+def mark_read(user_id, room_id, message_id=None):
+    """
+    Mark a room read up to ``message_id``, or up to its newest message if None,
+    and return the user's ``RoomReadState`` for it.
+    """
+    with transaction.atomic():
+        state, _ = RoomReadState.objects.select_for_update().get_or_create(user_id=user_id, room_id=room_id)
+        newest = (
+            Message.objects.filter(room_id=room_id)
+            .order_by('-id')
+            .values_list('id', flat=True)
+            .first()
+        ) or 0
+
+        if message_id is None or message_id >= newest:
+            state.last_read_id = max(state.last_read_id, newest)
+            state.unread_count = 0
+        else:
+            state.last_read_id = max(state.last_read_id, message_id)
+            state.unread_count = (
+                Message.objects.filter(room_id=room_id, id__gt=state.last_read_id)
+                .exclude(user_id=user_id)
+                .count()
+            )
+        state.save(update_fields=['last_read_id', 'unread_count', 'updated_at'])
+    return state
+
+
+def unread_counts(user_id):
+    """``(room_id, last_read_id, unread_count)`` for every room the user has read state in."""
+    return list(
+        RoomReadState.objects.filter(user_id=user_id)
+        .order_by('room_id')
+        .values_list('room_id', 'last_read_id', 'unread_count')
+    )
@@ -1,37 +1,160 @@
 from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
 from django.utils.decorators import method_decorator
+from . import metrics
+from .auth import mint_token
 from .models import ChatRoom, Message, UserProfile
+from .pagination import ArchiveKeysetPagination, KeysetPagination, RoomKeysetPagination
+from .presence import get_presence
+from .protocol import chat_message_event
+from .search import search_messages
 from .serializers import (
     ChatRoomSerializer, MessageSerializer, 
-    UserSerializer, UserProfileSerializer
+    UserSerializer, UserProfileSerializer,
+    MESSAGE_HISTORY_FIELDS, MESSAGE_LIST_FIELDS, ROOM_LIST_FIELDS,
+    encode_message, encode_message_rows, encode_room_rows, encode_rooms_from_rows,
 )
+from .summaries import forget_message, record_messages
+from .unread import count_unread, mark_read, unread_counts
 
 
 class ChatRoomViewSet(viewsets.ModelViewSet):
-    queryset = ChatRoom.objects.all()
+    # Most recently active first, straight off chat_room_last_msg_idx
+    queryset = ChatRoom.objects.order_by('-last_message_id', '-id')
     serializer_class = ChatRoomSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = RoomKeysetPagination
+    
+    def list(self, request, *args, **kwargs):
+        rows = self.filter_queryset(self.get_queryset()).values(*ROOM_LIST_FIELDS)
+        page = self.paginate_queryset(rows)
+        return self.paginator.get_paginated_response(encode_room_rows(page))
     
     @action(detail=True, methods=['get'])
     def messages(self, request, pk=None):
         room = self.get_object()
-        messages = room.messages.all()
-        serializer = MessageSerializer(messages, many=True)
-        return Response(serializer.data)
+        paginator = ArchiveKeysetPagination(room.id)
+        rows = room.messages.values(*MESSAGE_HISTORY_FIELDS)
+        page = paginator.paginate_queryset(rows, request, view=self)
+        return paginator.get_paginated_response(
+            encode_message_rows(page),
+            room=ChatRoomSerializer(room).data,
+        )
+    
+    @action(detail=True, methods=['get'])
+    def online(self, request, pk=None):
+        room = self.get_object()
+        user_ids = async_to_sync(get_presence().room_members)(room.id)
+        return Response({
+            'room': room.id,
+            'count': len(user_ids),
+            'user_ids': sorted(user_ids),
+        })
+    
+    @action(detail=True, methods=['post'])
+    def read(self, request, pk=None):
+        room = self.get_object()
+        message_id = request.data.get('message_id')
+        if message_id is not None:
+            try:
+                message_id = int(message_id)
+            except (TypeError, ValueError):
+                return Response(
+                    {'error': 'message_id must be an integer'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+        state = mark_read(request.user.id, room.id, message_id)
+        return Response({
+            'room': room.id,
+            'last_read_id': state.last_read_id,
+            'unread': state.unread_count,
+        })
+    
+    @action(detail=False, methods=['get'])
+    def unread(self, request):
+        counts = unread_counts(request.user.id)
+        return Response({
+            'total': sum(unread for _, _, unread in counts),
+            'rooms': [
+                {'room': room_id, 'last_read_id': last_read_id, 'unread': unread}
+                for room_id, last_read_id, unread in counts
+            ],
+        })
 
 
 class MessageViewSet(viewsets.ModelViewSet):
-    queryset = Message.objects.all()
+    queryset = Message.objects.select_related('room', 'user')
     serializer_class = MessageSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = KeysetPagination
+    
+    def list(self, request, *args, **kwargs):
+        rows = self.filter_queryset(self.get_queryset()).values(*MESSAGE_LIST_FIELDS)
+        page = self.paginate_queryset(rows)
+        return self.paginator.get_paginated_response(
+            encode_message_rows(page),
+            rooms=encode_rooms_from_rows(page),
+        )
     
+    @transaction.atomic
     def perform_create(self, serializer):
-        serializer.save(user=self.request.user)
+        message = serializer.save(user=self.request.user)
+        count_unread([message])
+        record_messages([message])
+        # Fanned out like a socket message, so sockets and every worker's
+        # recent-message buffer see it too
+        event = chat_message_event(encode_message(message, self.request.user))
+        transaction.on_commit(lambda: async_to_sync(get_channel_layer().group_send)(
+            f'chat_{message.room_id}', event))
+    
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        room_id, message_id = instance.room_id, instance.id
+        instance.delete()
+        forget_message(room_id, message_id)
+    
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response(
+                {'error': 'A search query is required'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            room = request.query_params.get('room')
+            room = int(room) if room else None
+            limit = min(int(request.query_params.get('limit', 20)), 100)
+            offset = int(request.query_params.get('offset', 0))
+        except ValueError:
+            return Response(
+                {'error': 'room, limit and offset must be integers'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if limit < 1 or offset < 0:
+            return Response(
+                {'error': 'limit must be positive and offset not negative'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        # One row past the page tells whether there is another
+        rows = search_messages(query, room_id=room, limit=limit + 1, offset=offset)
+        page = rows[:limit]
+        return Response({
+            'results': encode_message_rows(page),
+            'rooms': encode_rooms_from_rows(page),
+            'next': offset + limit if len(rows) > limit else None,
+        })
 
 
 class UserViewSet(viewsets.ModelViewSet):
@@ -60,6 +183,13 @@ class UserViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_401_UNAUTHORIZED
             )
     
+    @action(detail=False, methods=['post'])
+    def ws_token(self, request):
+        return Response({
+            'token': mint_token(request.user),
+            'expires_in': settings.CHAT_WS_TOKEN_MAX_AGE,
+        })
+    
     @action(detail=False, methods=['post'])
     def logout(self, request):
         logout(request)
@@ -89,4 +219,18 @@ class UserProfileViewSet(viewsets.ModelViewSet):
         profile.is_online = request.data.get('is_online', True)
         profile.save()
         serializer = self.get_serializer(profile)
-        return Response(serializer.data) 
\ No newline at end of file
+        return Response(serializer.data) 
+
+
+# Clients allowed to scrape without a token, and only with DEBUG on
+LOCAL_ADDRESSES = {'127.0.0.1', '::1'}
+
+
+def prometheus_metrics(request):
+    token = settings.CHAT_METRICS_TOKEN
+    if token:
+        if not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            return HttpResponse(status=401)
+    elif not (settings.DEBUG and request.META.get('REMOTE_ADDR') in LOCAL_ADDRESSES):
+        return HttpResponse(status=403)
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
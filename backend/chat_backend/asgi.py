@@ -11,16 +11,20 @@ import os
 
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
-from chat.routing import websocket_urlpatterns
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chat_backend.settings')
+django_asgi_app = get_asgi_application()
+
+from chat.auth import TokenAuthMiddleware
+from chat.lifespan import LifespanApp
+from chat.routing import websocket_urlpatterns
 
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
-    "websocket": AuthMiddlewareStack(
+    "http": django_asgi_app,
+    "websocket": TokenAuthMiddleware(
         URLRouter(
             websocket_urlpatterns
         )
     ),
+    "lifespan": LifespanApp(),
 }) 
\ No newline at end of file
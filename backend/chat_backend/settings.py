@@ -41,6 +41,7 @@ except ImportError:
     pass
 
 MIDDLEWARE = [
+    'chat.middleware.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -75,10 +76,25 @@ ASGI_APPLICATION = 'chat_backend.asgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
+# Async database work runs on a pool of CHAT_DB_POOL_SIZE threads per worker,
+# each keeping its connection open for CHAT_DB_CONN_MAX_AGE seconds (checked
+# before reuse), with CHAT_DB_POOL_MIN of them connected at startup. Other
+# threads, such as the ones running HTTP views, close theirs after each request
+CHAT_DB_POOL_SIZE = config('CHAT_DB_POOL_SIZE', default=10, cast=int)
+CHAT_DB_POOL_MIN = config('CHAT_DB_POOL_MIN', default=2, cast=int)
+CHAT_DB_CONN_MAX_AGE = config('CHAT_DB_CONN_MAX_AGE', default=600, cast=int)
+
+# Seconds a SQLite connection waits for a lock before giving up. The chat
+# SQLite backend begins transactions IMMEDIATE so writers queue on this
+CHAT_SQLITE_BUSY_TIMEOUT = config('CHAT_SQLITE_BUSY_TIMEOUT', default=20.0, cast=float)
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'chat.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            'timeout': CHAT_SQLITE_BUSY_TIMEOUT,
+        },
     }
 }
 
@@ -143,6 +159,95 @@ if os.environ.get('RAILWAY_ENVIRONMENT'):
         },
     }
 
+# Several ASGI workers on one host, joined over Unix domain sockets
+if config('CHANNEL_LAYER', default='') == 'unix':
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "chat.layers.UnixSocketChannelLayer",
+            "CONFIG": {
+                "path": config('CHANNEL_LAYER_PATH', default='/tmp/chat-channel-layer'),
+            },
+        },
+    }
+
+# Chat message persistence
+# 'sync' writes each message before fan-out, 'enqueue' fans out as soon as the
+# message is queued, 'flush' fans out once the batch holding it is committed
+CHAT_PERSISTENCE_MODE = config('CHAT_PERSISTENCE_MODE', default='sync')
+CHAT_WRITE_BATCH_SIZE = config('CHAT_WRITE_BATCH_SIZE', default=100, cast=int)
+CHAT_WRITE_FLUSH_INTERVAL = config('CHAT_WRITE_FLUSH_INTERVAL', default=0.05, cast=float)
+
+# Room name -> id cache used by the consumers
+CHAT_ROOM_CACHE_SIZE = config('CHAT_ROOM_CACHE_SIZE', default=1024, cast=int)
+CHAT_ROOM_CACHE_TTL = config('CHAT_ROOM_CACHE_TTL', default=300, cast=int)
+
+# Redis used by the shared chat backends below
+CHAT_REDIS_URL = config('REDIS_URL', default='redis://localhost:6379/0')
+
+# Presence: 'local' keeps connection counts in-process, 'redis' shares them
+# between workers. UserProfile writes are batched every flush interval
+CHAT_PRESENCE_BACKEND = config('CHAT_PRESENCE_BACKEND', default='local')
+CHAT_PRESENCE_FLUSH_INTERVAL = config('CHAT_PRESENCE_FLUSH_INTERVAL', default=2.0, cast=float)
+
+# Outbound frame coalescing for sockets opened with ?batch=1
+CHAT_COALESCE_WINDOW_MS = config('CHAT_COALESCE_WINDOW_MS', default=10, cast=int)
+CHAT_COALESCE_MAX_MESSAGES = config('CHAT_COALESCE_MAX_MESSAGES', default=50, cast=int)
+
+# Per-socket outbound queue bound and what to do with clients that fill it:
+# 'drop_oldest', 'resync' (tell the client to refetch) or 'disconnect'
+CHAT_OUTBOUND_QUEUE_SIZE = config('CHAT_OUTBOUND_QUEUE_SIZE', default=256, cast=int)
+CHAT_SLOW_CONSUMER_POLICY = config('CHAT_SLOW_CONSUMER_POLICY', default='resync')
+
+# Token-bucket limits on chat messages (tokens per second and bucket size;
+# a rate of 0 disables the limit). 'redis' shares the buckets between workers
+CHAT_RATE_LIMIT_BACKEND = config('CHAT_RATE_LIMIT_BACKEND', default='local')
+CHAT_USER_MESSAGE_RATE = config('CHAT_USER_MESSAGE_RATE', default=5.0, cast=float)
+CHAT_USER_MESSAGE_BURST = config('CHAT_USER_MESSAGE_BURST', default=10, cast=int)
+CHAT_ROOM_MESSAGE_RATE = config('CHAT_ROOM_MESSAGE_RATE', default=50.0, cast=float)
+CHAT_ROOM_MESSAGE_BURST = config('CHAT_ROOM_MESSAGE_BURST', default=100, cast=int)
+
+# Recent messages per room sent to sockets opened with ?history=1, and how
+# many rooms each worker keeps them in memory for
+CHAT_RECENT_MESSAGES = config('CHAT_RECENT_MESSAGES', default=50, cast=int)
+CHAT_RECENT_ROOMS = config('CHAT_RECENT_ROOMS', default=1000, cast=int)
+# Sockets reconnecting with ?last_seen=<id> are replayed at most this many
+# missed messages; further behind they are told to resync
+CHAT_RESUME_MAX_MESSAGES = config('CHAT_RESUME_MAX_MESSAGES', default=500, cast=int)
+
+# Worker id (0-127) embedded in message ids; every process writing messages
+# needs its own. runchat workers get this plus their index (from 0 if unset),
+# other servers must set it per process
+CHAT_ID_WORKER = config('CHAT_ID_WORKER', default='')
+
+# How long a client_msg_id is remembered, so retries of it are acknowledged
+# instead of sent twice
+CHAT_CLIENT_MSG_ID_TTL = config('CHAT_CLIENT_MSG_ID_TTL', default=300, cast=int)
+
+# Prometheus scrapes /metrics with 'Authorization: Bearer <token>'. Without
+# a token it is only served to local clients, and only when DEBUG is on
+CHAT_METRICS_TOKEN = config('CHAT_METRICS_TOKEN', default='')
+
+# Admission control, per worker: at most CHAT_MAX_CONNECTIONS open sockets and
+# CHAT_CONNECT_RATE new ones per second (bursts up to CHAT_CONNECT_BURST); 0
+# turns a limit off. Rejected sockets are told to retry after the wait plus up
+# to CHAT_ADMISSION_RETRY_JITTER random seconds
+CHAT_MAX_CONNECTIONS = config('CHAT_MAX_CONNECTIONS', default=10000, cast=int)
+CHAT_CONNECT_RATE = config('CHAT_CONNECT_RATE', default=200.0, cast=float)
+CHAT_CONNECT_BURST = config('CHAT_CONNECT_BURST', default=400, cast=int)
+CHAT_ADMISSION_RETRY_AFTER = config('CHAT_ADMISSION_RETRY_AFTER', default=2.0, cast=float)
+CHAT_ADMISSION_RETRY_JITTER = config('CHAT_ADMISSION_RETRY_JITTER', default=10.0, cast=float)
+
+# Lifetime in seconds of the WebSocket connection tokens minted by
+# /api/users/ws_token/
+CHAT_WS_TOKEN_MAX_AGE = config('CHAT_WS_TOKEN_MAX_AGE', default=300, cast=int)
+
+# archive_messages moves messages older than this many days into compressed
+# per-room daily segments; room history reads through to them
+CHAT_ARCHIVE_AFTER_DAYS = config('CHAT_ARCHIVE_AFTER_DAYS', default=90, cast=int)
+
+# Message search ranks only the newest matches, up to this many
+CHAT_SEARCH_MAX_CANDIDATES = config('CHAT_SEARCH_MAX_CANDIDATES', default=2000, cast=int)
+
 # REST Framework
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
@@ -5,6 +5,7 @@ from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User
 import json
+from chat.views import prometheus_metrics
 
 def health_check(request):
     return HttpResponse("""
@@ -745,6 +746,7 @@ urlpatterns = [
     path('api/', include('chat.urls')),
     path('api/docs/', api_docs, name='api_docs'),
     path('health/', health_check, name='health_check'),
+    path('metrics', prometheus_metrics, name='metrics'),
     path('login/', login_api, name='login_api'),
     path('register/', register_api, name='register_api'),
 ]
@@ -1,106 +1,313 @@
 import { defineStore } from 'pinia'
-import { ref, computed } from 'vue'
+import { ref, computed, toRaw } from 'vue'
 import axios from 'axios'
 
 // API base URL - using Railway backend (update with your Railway URL)
 const API_BASE_URL = 'https://your-railway-app.railway.app'
 const WS_BASE_URL = 'wss://your-railway-app.railway.app'
 
+// Close code for sockets turned away by an overloaded server
+const OVERLOADED = 4503
+// Milliseconds to wait for a sent message's ack, and how often a message the
+// server could not save is sent again before giving up
+const ACK_TIMEOUT = 10000
+const SAVE_ATTEMPTS = 3
+// Milliseconds between read marker updates while messages keep arriving
+const READ_DELAY = 1000
+
 export const useChatStore = defineStore('chat', () => {
   const messages = ref([])
   const rooms = ref([])
+  // Cursor for the next page of rooms, null once every room is listed
+  const roomsCursor = ref(null)
   const currentRoom = ref(null)
   const ws = ref(null)
   const isConnected = ref(false)
 
+  // Newest message id we have, so a dropped socket can resume from it
+  let lastSeenId = null
+  let reconnectTimer = null
+  let reconnectDelay = 1000
+  // Seconds an overloaded server asked us to wait before reconnecting
+  let retryHint = null
+  // Signed connection token, which spares the server a session lookup per connect
+  let wsToken = null
+  let wsTokenExpires = 0
+  let connectAttempt = 0
+  // Whether the room's history has arrived, over the socket or REST
+  let historyLoaded = false
+  // Sent messages waiting for their ack, by client_msg_id
+  const pending = new Map()
+  // Pending update of the open room's read marker, and the last id sent
+  let readTimer = null
+  let lastReadId = null
+
   // Computed properties
   const currentMessages = computed(() => {
     if (!currentRoom.value) return []
     return messages.value.filter(msg => msg.room === currentRoom.value.id)
   })
 
+  const hasMoreRooms = computed(() => roomsCursor.value !== null)
+
   // API functions
+  // Session-authenticated POSTs must echo Django's CSRF cookie in its header
   const api = axios.create({
     baseURL: API_BASE_URL,
-    withCredentials: true
+    withCredentials: true,
+    xsrfCookieName: 'csrftoken',
+    xsrfHeaderName: 'X-CSRFToken'
   })
 
+  const newClientMsgId = () => `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`
+
+  const sendPending = (clientMsgId) => {
+    const entry = pending.get(clientMsgId)
+    if (!entry || !ws.value || ws.value.readyState !== WebSocket.OPEN) return
+    clearTimeout(entry.timer)
+    entry.timer = setTimeout(
+      () => settle(clientMsgId, { success: false, error: 'The server did not confirm the message' }),
+      ACK_TIMEOUT
+    )
+    ws.value.send(JSON.stringify({ message: entry.content, client_msg_id: clientMsgId }))
+  }
+
+  const settle = (clientMsgId, result) => {
+    const entry = pending.get(clientMsgId)
+    if (!entry) return
+    clearTimeout(entry.timer)
+    pending.delete(clientMsgId)
+    // A failed message keeps its id, so sending it again cannot duplicate it
+    entry.resolve({ ...result, clientMsgId })
+  }
+
+  // Tell the server the room has been read up to messageId, or up to its
+  // newest message; this also starts its unread count for us
+  const markRead = async (roomId, messageId = null) => {
+    try {
+      await api.post(`/api/rooms/${roomId}/read/`, messageId === null ? {} : { message_id: messageId })
+    } catch (error) {
+      console.error('Error marking room read:', error)
+    }
+  }
+
+  // Messages shown in the open room move its read marker, once per READ_DELAY
+  const scheduleMarkRead = (roomId) => {
+    if (readTimer !== null) return
+    readTimer = setTimeout(() => {
+      readTimer = null
+      if (currentRoom.value && currentRoom.value.id === roomId && lastSeenId !== lastReadId) {
+        lastReadId = lastSeenId
+        markRead(roomId, lastSeenId)
+      }
+    }, READ_DELAY)
+  }
+
+  const trackSeen = (id) => {
+    if (id != null && (lastSeenId === null || id > lastSeenId)) {
+      lastSeenId = id
+    }
+  }
+
+  const getWsToken = async () => {
+    if (!wsToken || Date.now() > wsTokenExpires) {
+      try {
+        const response = await api.post('/api/users/ws_token/')
+        wsToken = response.data.token
+        // Renew a little early so a reconnect never presents a stale token
+        wsTokenExpires = Date.now() + (response.data.expires_in - 30) * 1000
+      } catch (error) {
+        // Connect with the session cookie instead
+        console.error('Error fetching connection token:', error)
+        wsToken = null
+      }
+    }
+    return wsToken
+  }
+
   // WebSocket connection
-  const connectWebSocket = (roomId) => {
+  const connectWebSocket = async (roomId, resume = false) => {
+    clearTimeout(reconnectTimer)
     if (ws.value) {
+      // Cleared first so its close handler does not schedule a reconnect
       ws.value.close()
+      ws.value = null
+    }
+    if (!resume) {
+      lastSeenId = null
+      historyLoaded = false
+      // Messages still waiting belong to the room we are leaving
+      for (const clientMsgId of [...pending.keys()]) {
+        settle(clientMsgId, { success: false, error: 'Left the room before the message was confirmed' })
+      }
+    }
+
+    const attempt = ++connectAttempt
+    const token = await getWsToken()
+    if (attempt !== connectAttempt) {
+      // Another connect or a disconnect happened while we waited
+      return
     }
 
-    const wsUrl = `${WS_BASE_URL}/ws/chat/${roomId}/`
-    ws.value = new WebSocket(wsUrl)
+    // batch=1 lets the server coalesce bursts of messages into one frame;
+    // history=1 has it send the room's recent messages as soon as we join,
+    // and last_seen replays only what we missed while disconnected
+    const since = resume && lastSeenId !== null ? `last_seen=${lastSeenId}` : 'history=1'
+    const auth = token ? `&token=${encodeURIComponent(token)}` : ''
+    const wsUrl = `${WS_BASE_URL}/ws/chat/${roomId}/?batch=1&${since}${auth}`
+    const socket = new WebSocket(wsUrl)
+    ws.value = socket
 
-    ws.value.onopen = () => {
+    socket.onopen = () => {
       console.log('WebSocket connected')
       isConnected.value = true
+      reconnectDelay = 1000
+      // Whatever was not acked before the drop goes again under the same id;
+      // the server only acks again the ones it already has
+      pending.forEach((entry, clientMsgId) => sendPending(clientMsgId))
+    }
+
+    const handleFrame = (data) => {
+      if (data.type === undefined) {
+        // Live chat frames carry no type; store them in the history shape
+        messages.value.push({
+          id: data.id,
+          room: roomId,
+          user: { id: data.user_id, username: data.username },
+          content: data.message,
+          timestamp: data.timestamp
+        })
+      } else if (data.type === 'history') {
+        historyLoaded = true
+        messages.value = data.messages
+        data.messages.forEach(message => trackSeen(message.id))
+      } else if (data.type === 'replay') {
+        historyLoaded = true
+        messages.value.push(...data.messages)
+        data.messages.forEach(message => trackSeen(message.id))
+      } else if (data.type === 'ack') {
+        settle(data.client_msg_id, { success: true, id: data.id })
+      } else if (data.type === 'error' && data.code === 'not_saved') {
+        const entry = pending.get(data.client_msg_id)
+        if (entry && ++entry.attempts < SAVE_ATTEMPTS) {
+          clearTimeout(entry.timer)
+          entry.timer = setTimeout(() => sendPending(data.client_msg_id), 1000 * entry.attempts)
+        } else {
+          settle(data.client_msg_id, { success: false, error: 'The message could not be saved, try again' })
+        }
+      } else if (data.type === 'error' && data.code === 'rate_limited') {
+        settle(data.client_msg_id, {
+          success: false,
+          error: `Sending too fast, try again in ${Math.ceil(data.retry_after)}s`,
+          retryAfter: data.retry_after
+        })
+      } else if (data.type === 'error' && data.code === 'overloaded') {
+        retryHint = data.retry_after
+      } else if (data.type === 'resync' && currentRoom.value) {
+        // We fell behind and the server dropped frames; refetch the history
+        getMessages(currentRoom.value.id)
+      }
     }
 
-    ws.value.onmessage = (event) => {
+    socket.onmessage = (event) => {
       const data = JSON.parse(event.data)
-      if (data.type === 'chat_message') {
-        messages.value.push(data.message)
+      const frames = data.type === 'batch' ? data.messages : [data]
+      frames.forEach(frame => {
+        trackSeen(frame.id)
+        handleFrame(frame)
+      })
+      if (lastSeenId !== null && currentRoom.value && currentRoom.value.id === roomId) {
+        scheduleMarkRead(roomId)
       }
     }
 
-    ws.value.onclose = () => {
+    socket.onclose = (event) => {
       console.log('WebSocket disconnected')
       isConnected.value = false
+      // A server shedding load would only see us again on the REST path, so
+      // after an overloaded close the reconnect delivers the history instead
+      if (!historyLoaded && event.code !== OVERLOADED && currentRoom.value && currentRoom.value.id === roomId) {
+        // The socket never delivered the history; load it over REST instead
+        historyLoaded = true
+        getMessages(roomId)
+      }
+      // Reconnect unless we closed it ourselves or moved to another room
+      if (toRaw(ws.value) === socket && currentRoom.value && currentRoom.value.id === roomId) {
+        if (event.code === OVERLOADED && retryHint !== null) {
+          // The server already spread its hint out, so use it as given
+          reconnectTimer = setTimeout(() => connectWebSocket(roomId, true), retryHint * 1000)
+        } else {
+          reconnectTimer = setTimeout(() => connectWebSocket(roomId, true), reconnectDelay)
+          reconnectDelay = Math.min(reconnectDelay * 2, 30000)
+        }
+      }
+      retryHint = null
     }
 
-    ws.value.onerror = (error) => {
+    socket.onerror = (error) => {
       console.error('WebSocket error:', error)
       isConnected.value = false
     }
   }
 
-  // Send message
-  const sendMessage = async (content) => {
-    try {
-      if (!currentRoom.value) {
-        return { success: false, error: 'No room selected' }
-      }
-
-      const response = await api.post('/api/messages/', {
-        content,
-        room: currentRoom.value.id
-      })
-      
-      if (ws.value && ws.value.readyState === WebSocket.OPEN) {
-        ws.value.send(JSON.stringify({
-          type: 'chat_message',
-          message: response.data
-        }))
-      }
-      
-      return { success: true, data: response.data }
-    } catch (error) {
-      console.error('Error sending message:', error)
-      return { success: false, error: error.response?.data?.message || 'Failed to send message' }
+  // Send a message and wait for the server to ack it. The server saves it and
+  // sends it back to the room as a live frame; client_msg_id lets it recognise
+  // a retry of the same message, so pass back the clientMsgId of a failed
+  // result to send that message again
+  const sendMessage = (content, clientMsgId = newClientMsgId()) => {
+    if (!currentRoom.value) {
+      return Promise.resolve({ success: false, error: 'No room selected', clientMsgId })
+    }
+    if (!ws.value || ws.value.readyState !== WebSocket.OPEN) {
+      return Promise.resolve({ success: false, error: 'Not connected', clientMsgId })
     }
+    if (pending.has(clientMsgId)) {
+      return Promise.resolve({ success: false, error: 'Message is already being sent', clientMsgId })
+    }
+
+    return new Promise(resolve => {
+      pending.set(clientMsgId, { content, resolve, attempts: 0, timer: null })
+      sendPending(clientMsgId)
+    })
   }
 
   // Get messages for a room
   const getMessages = async (roomId) => {
     try {
-      const response = await api.get(`/api/chatrooms/${roomId}/messages/`)
-      messages.value = response.data
-      return { success: true, data: response.data }
+      const response = await api.get(`/api/rooms/${roomId}/messages/`)
+      messages.value = response.data.results
+      return { success: true, data: response.data.results }
     } catch (error) {
       console.error('Error fetching messages:', error)
       return { success: false, error: error.response?.data?.message || 'Failed to fetch messages' }
     }
   }
 
-  // Get all rooms
+  // Get the first page of rooms, most recently active first
   const fetchRooms = async () => {
     try {
-      const response = await api.get('/api/chatrooms/')
-      rooms.value = response.data
-      return { success: true, data: response.data }
+      const response = await api.get('/api/rooms/')
+      rooms.value = response.data.results
+      roomsCursor.value = response.data.before
+      return { success: true, data: response.data.results }
+    } catch (error) {
+      console.error('Error fetching rooms:', error)
+      return { success: false, error: error.response?.data?.message || 'Failed to fetch rooms' }
+    }
+  }
+
+  // Get the next page of less recently active rooms
+  const fetchMoreRooms = async () => {
+    if (!roomsCursor.value) {
+      return { success: true, data: [] }
+    }
+    try {
+      const response = await api.get('/api/rooms/', { params: { before: roomsCursor.value } })
+      // A room that became active since the first page may already be listed
+      const listed = new Set(rooms.value.map(room => room.id))
+      rooms.value.push(...response.data.results.filter(room => !listed.has(room.id)))
+      roomsCursor.value = response.data.before
+      return { success: true, data: response.data.results }
     } catch (error) {
       console.error('Error fetching rooms:', error)
       return { success: false, error: error.response?.data?.message || 'Failed to fetch rooms' }
@@ -110,7 +317,7 @@ export const useChatStore = defineStore('chat', () => {
   // Create a new room
   const createRoom = async (roomData) => {
     try {
-      const response = await api.post('/api/chatrooms/', {
+      const response = await api.post('/api/rooms/', {
         name: roomData.name,
         description: roomData.description || ''
       })
@@ -128,9 +335,15 @@ export const useChatStore = defineStore('chat', () => {
   // Set current room
   const setCurrentRoom = (room) => {
     currentRoom.value = room
+    clearTimeout(readTimer)
+    readTimer = null
+    lastReadId = null
     if (room) {
+      // The socket sends the recent history on connect, falling back to
+      // REST if it closes before doing so
+      messages.value = []
       connectWebSocket(room.id)
-      getMessages(room.id)
+      markRead(room.id)
     }
   }
 
@@ -141,6 +354,12 @@ export const useChatStore = defineStore('chat', () => {
 
   // Disconnect WebSocket
   const disconnect = () => {
+    clearTimeout(reconnectTimer)
+    connectAttempt++
+    wsToken = null
+    for (const clientMsgId of [...pending.keys()]) {
+      settle(clientMsgId, { success: false, error: 'Disconnected before the message was confirmed' })
+    }
     if (ws.value) {
       ws.value.close()
       ws.value = null
@@ -157,6 +376,8 @@ export const useChatStore = defineStore('chat', () => {
     sendMessage,
     getMessages,
     fetchRooms,
+    fetchMoreRooms,
+    hasMoreRooms,
     createRoom,
     setCurrentRoom,
     joinRoom,